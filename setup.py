@@ -73,7 +73,10 @@ setup(
     ),
     install_requires=[
         'setuptools',
-        'transaction',
+        'BTrees',
+        'persistent',
+        'transaction>=2.4',
+        'ZODB>=5',
         'zope.component',
         'zope.security',
     ],
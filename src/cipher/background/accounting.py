@@ -0,0 +1,288 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Per-site and per-user accounting of the resources used by background work.
+
+Example::
+
+    class MyWorker(BackgroundWorkerThread):
+        accounting = accounting   # the process-wide ResourceAccounting
+
+    ...
+
+    for (site_name, user_name), usage in accounting.top(5, 'cpu_time'):
+        print(site_name, user_name, usage)
+
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+log = logging.getLogger(__name__)
+
+
+def _rusage_thread_time():
+    usage = resource.getrusage(resource.RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+# CPU time of the current thread, or None if we can't measure it
+if hasattr(time, 'thread_time'):
+    # Python 3.7+
+    thread_time = time.thread_time
+elif hasattr(resource, 'RUSAGE_THREAD'):
+    # Linux
+    thread_time = _rusage_thread_time
+else:
+    thread_time = None
+
+
+class Usage(object):
+    """Resources used by one or more iterations of background work.
+
+    ``cpu_time`` is None if the CPU time of threads can't be measured on
+    this platform.
+    """
+
+    fields = ('iterations', 'cpu_time', 'wall_time', 'loads', 'stores',
+              'bytes_written', 'commits')
+
+    def __init__(self, **kw):
+        for field in self.fields:
+            setattr(self, field, kw.pop(field, 0))
+        if kw:
+            raise TypeError('unexpected keyword arguments: %s'
+                            % ', '.join(sorted(kw)))
+
+    def add(self, other):
+        for field in self.fields:
+            value, other_value = getattr(self, field), getattr(other, field)
+            if value is None or other_value is None:
+                setattr(self, field, None)
+            else:
+                setattr(self, field, value + other_value)
+        return self
+
+    def copy(self):
+        return Usage().add(self)
+
+    def __repr__(self):
+        return '<Usage %s>' % ' '.join(
+            '%s=%s' % (field, getattr(self, field)) for field in self.fields)
+
+    def __str__(self):
+        if self.cpu_time is None:
+            cpu = 'unknown'
+        else:
+            cpu = '%.3fs' % self.cpu_time
+        return ('%d iterations, %s CPU, %.3fs wall, %d loads, %d stores,'
+                ' %d bytes written, %d commits' % (
+                    self.iterations, cpu, self.wall_time, self.loads,
+                    self.stores, self.bytes_written, self.commits))
+
+
+class _WriteCounter(object):
+    """Counts bytes stored and transactions committed through a storage."""
+
+    def __init__(self, storage):
+        self.bytes_written = 0
+        self.commits = 0
+        self._store = storage.store
+        self._tpc_finish = storage.tpc_finish
+
+    def store(self, oid, serial, data, version, transaction):
+        self.bytes_written += len(data)
+        return self._store(oid, serial, data, version, transaction)
+
+    def tpc_finish(self, *args, **kw):
+        result = self._tpc_finish(*args, **kw)
+        self.commits += 1
+        return result
+
+
+def getWriteCounter(conn):
+    """Return a _WriteCounter for a ZODB connection.
+
+    The counter is installed into the connection's storage instance the
+    first time; connections (and their storage instances) are reused, so
+    callers should look at differences, not absolute values.  Returns None
+    if the storage can't be instrumented.
+    """
+    storage = conn._storage
+    counter = getattr(storage, '_cipher_write_counter', None)
+    if counter is None:
+        try:
+            counter = _WriteCounter(storage)
+            storage.store = counter.store
+            storage.tpc_finish = counter.tpc_finish
+            storage._cipher_write_counter = counter
+        except AttributeError:
+            return None
+    return counter
+
+
+class ResourceAccounting(object):
+    """Resource usage of background work, aggregated by site and user.
+
+    Thread-safe.  Usage is kept in memory until it's reset or rolled up.
+    """
+
+    def __init__(self, clock=time.time):
+        self._lock = threading.Lock()
+        self._usage = {}
+        self._clock = clock
+        self.since = clock()
+
+    def record(self, site_name, user_name, usage):
+        with self._lock:
+            total = self._usage.get((site_name, user_name))
+            if total is None:
+                total = self._usage[site_name, user_name] = Usage()
+            total.add(usage)
+
+    @contextmanager
+    def measure(self, site_name, user_name, conn=None):
+        """Measure the resources used by a block of code.
+
+        Pass a ZODB connection to count objects loaded and stored, bytes
+        written and commits.
+        """
+        counter = getWriteCounter(conn) if conn is not None else None
+        if conn is not None:
+            loads, stores = conn.getTransferCounts()
+        if counter is not None:
+            bytes_written, commits = counter.bytes_written, counter.commits
+        cpu = thread_time() if thread_time is not None else None
+        wall = self._clock()
+        try:
+            yield
+        finally:
+            usage = Usage(iterations=1, wall_time=self._clock() - wall)
+            if cpu is None:
+                usage.cpu_time = None
+            else:
+                usage.cpu_time = thread_time() - cpu
+            if conn is not None:
+                new_loads, new_stores = conn.getTransferCounts()
+                # the counts may have been cleared in the meantime
+                usage.loads = max(0, new_loads - loads)
+                usage.stores = max(0, new_stores - stores)
+            if counter is not None:
+                usage.bytes_written = counter.bytes_written - bytes_written
+                usage.commits = counter.commits - commits
+            self.record(site_name, user_name, usage)
+
+    def usage(self, site_name=None, user_name=None):
+        """Total usage of a site and/or user (or of everything)."""
+        total = Usage()
+        with self._lock:
+            for (site, user), usage in self._usage.items():
+                if site_name is not None and site != site_name:
+                    continue
+                if user_name is not None and user != user_name:
+                    continue
+                total.add(usage)
+        return total
+
+    def snapshot(self):
+        """Return a dict mapping (site_name, user_name) to Usage."""
+        with self._lock:
+            return dict((key, usage.copy())
+                        for key, usage in self._usage.items())
+
+    def bySite(self):
+        """Return a dict mapping site names to Usage."""
+        result = {}
+        for (site_name, user_name), usage in self.snapshot().items():
+            result.setdefault(site_name, Usage()).add(usage)
+        return result
+
+    def byUser(self):
+        """Return a dict mapping user names to Usage."""
+        result = {}
+        for (site_name, user_name), usage in self.snapshot().items():
+            result.setdefault(user_name, Usage()).add(usage)
+        return result
+
+    def top(self, n=10, field='cpu_time'):
+        """Return the n heaviest (site_name, user_name) pairs with usage."""
+        # unknown values (None) sort last
+        items = sorted(self.snapshot().items(),
+                       key=lambda item: (getattr(item[1], field) is not None,
+                                         getattr(item[1], field) or 0),
+                       reverse=True)
+        return items[:n]
+
+    def reset(self):
+        with self._lock:
+            self._usage = {}
+            self.since = self._clock()
+
+    def rollup(self):
+        """Return a snapshot and reset, atomically.
+
+        Returns a tuple (since, until, snapshot).
+        """
+        with self._lock:
+            usage, self._usage = self._usage, {}
+            since, self.since = self.since, self._clock()
+        return since, self.since, usage
+
+
+accounting = ResourceAccounting()
+
+
+def logRollup(since, until, usage):
+    """Default RollupThread callback: log the usage of every site and user."""
+    for (site_name, user_name), total in sorted(usage.items()):
+        log.info("Background work for %s by %s in the last %.0f seconds: %s"
+                 % (site_name, user_name, until - since, total))
+
+
+class RollupThread(threading.Thread):
+    """Rolls up a ResourceAccounting periodically.
+
+    Calls ``callback(since, until, usage)`` every ``interval`` seconds,
+    where ``usage`` maps (site_name, user_name) to Usage.
+    """
+
+    def __init__(self, accounting=accounting, interval=3600.0,
+                 callback=logRollup):
+        super(RollupThread, self).__init__(name='resource accounting rollup')
+        self.setDaemon(True)
+        self.accounting = accounting
+        self.interval = interval
+        self.callback = callback
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def rollupOnce(self):
+        try:
+            self.callback(*self.accounting.rollup())
+        except Exception:
+            log.exception("Exception in %s" % self.name)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.rollupOnce()
@@ -0,0 +1,138 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Adaptive batch sizing for background workers."""
+
+import threading
+
+from transaction.interfaces import TransientError
+
+from .thread import BackgroundWorkerThread
+
+
+class AdaptiveBatchSize(object):
+    """Batch size controller using additive increase/multiplicative decrease.
+
+    Feed it the measured duration of every transaction with ``success()``
+    and every conflict with ``conflict()``; read the recommended number of
+    items for the next transaction from ``size``.
+
+    Example::
+
+        batch = AdaptiveBatchSize(target_duration=0.5)
+        while True:
+            items = getItems(batch.size)
+            ...
+            batch.success(elapsed, len(items))
+
+    """
+
+    def __init__(self, target_duration=1.0, initial=1, minimum=1,
+                 maximum=1000, increase=1, decrease=0.5):
+        self.target_duration = target_duration
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.size = max(minimum, min(maximum, initial))
+        self.last_duration = None
+        self.conflicts = 0
+        self._lock = threading.Lock()
+
+    def success(self, duration, items=None):
+        """Record a committed transaction that took ``duration`` seconds.
+
+        Pass the number of ``items`` the transaction processed: the size
+        only grows after full batches, so that idle polls and partial
+        batches don't ramp it up to the maximum.
+        """
+        with self._lock:
+            self.last_duration = duration
+            if duration > self.target_duration:
+                self._shrink()
+            elif items is None or items >= self.size:
+                self.size = min(self.maximum, self.size + self.increase)
+
+    def conflict(self):
+        """Record a transaction that failed with a conflict."""
+        with self._lock:
+            self.conflicts += 1
+            self._shrink()
+
+    def _shrink(self):
+        self.size = max(self.minimum, int(self.size * self.decrease))
+
+
+class BatchWorkerThread(BackgroundWorkerThread):
+    """A background thread that processes items in adaptively sized batches.
+
+    Subclasses ought to override getNextBatch() and processItem() instead
+    of doWork().  The number of items requested per transaction grows while
+    transactions finish under ``target_duration`` seconds and shrinks when
+    they take longer or run into conflicts.  The current value is available
+    as ``batch_size``.
+    """
+
+    target_duration = 1.0
+    initial_batch_size = 1
+    min_batch_size = 1
+    max_batch_size = 1000
+
+    def __init__(self, *args, **kw):
+        super(BatchWorkerThread, self).__init__(*args, **kw)
+        self.batch_controller = AdaptiveBatchSize(
+            target_duration=self.target_duration,
+            initial=self.initial_batch_size,
+            minimum=self.min_batch_size,
+            maximum=self.max_batch_size)
+
+    @property
+    def batch_size(self):
+        return self.batch_controller.size
+
+    def getStatus(self):
+        status = super(BatchWorkerThread, self).getStatus()
+        status['batch_size'] = self.batch_size
+        return status
+
+    # number of items processed by the last doWork()
+    batch_items = None
+
+    def doWorkInTransaction(self):
+        self.batch_items = None
+        start = self._clock()
+        try:
+            super(BatchWorkerThread, self).doWorkInTransaction()
+        except TransientError:
+            self.batch_controller.conflict()
+            raise
+        # time spent waiting for the write limiter says nothing about the
+        # batch size
+        duration = self._clock() - start - self.throttle_time
+        self.batch_controller.success(duration, self.batch_items)
+
+    def doWork(self):
+        self.batch_items = 0
+        for item in self.getNextBatch(self.batch_size):
+            self.processItem(item)
+            self.batch_items += 1
+
+    def getNextBatch(self, size):
+        """Return up to ``size`` items to process in this transaction."""
+        return []
+
+    def processItem(self, item):
+        """Process a single item.
+
+        Called with a local site set and a working ZODB connection.
+        """
@@ -0,0 +1,220 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Backing off background workers while something they depend on is down."""
+
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+from ZODB.POSException import ConflictError
+
+from .thread import BackgroundWorkerThread
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """Stops work after too many consecutive failures.
+
+    The breaker starts closed.  After ``failure_threshold`` consecutive
+    failures it opens for ``reset_timeout`` seconds, and then lets one
+    trial through (half-open).  If the trial succeeds the breaker closes,
+    otherwise it opens again for ``multiplier`` times longer, up to
+    ``max_reset_timeout`` seconds.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=1.0,
+                 max_reset_timeout=300.0, multiplier=2.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.multiplier = multiplier
+        self.state = CLOSED
+        self.failures = 0
+        self.timeout = reset_timeout
+        self.opened = None
+
+    _clock = staticmethod(time.time)
+
+    def retryIn(self):
+        """Return the number of seconds until work is allowed again."""
+        if self.state != OPEN:
+            return 0
+        return max(0, self.opened + self.timeout - self._clock())
+
+    def allow(self):
+        """Can we try to do some work now?
+
+        Moves an open breaker whose timeout expired to half-open.
+        """
+        if self.state == OPEN and self.retryIn() <= 0:
+            self.state = HALF_OPEN
+        return self.state != OPEN
+
+    def success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.timeout = self.reset_timeout
+
+    def failure(self):
+        """Record a failure.  Returns True if the breaker opened."""
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self.timeout = min(self.max_reset_timeout,
+                               self.timeout * self.multiplier)
+        elif self.failures < self.failure_threshold:
+            return False
+        self.state = OPEN
+        self.opened = self._clock()
+        return True
+
+
+class TracebackThrottle(object):
+    """Rate-limits logging of identical tracebacks.
+
+    Tracebacks are identical when the exception type and message and the
+    code locations in the traceback are the same.
+    """
+
+    max_keys = 1000
+
+    def __init__(self, interval=60.0):
+        self.interval = interval
+        self._last_logged = {}
+        self._suppressed = {}
+
+    _clock = staticmethod(time.time)
+
+    def key(self, exc_info):
+        exc_type, exc_value, tb = exc_info
+        locations = tuple((filename, lineno, name)
+                          for filename, lineno, name, line
+                          in traceback.extract_tb(tb))
+        return (exc_type, str(exc_value), locations)
+
+    def check(self, exc_info):
+        """Should an exception be logged?
+
+        Returns None if it should not, or the number of identical
+        tracebacks that were not logged since the last time.
+        """
+        key = self.key(exc_info)
+        now = self._clock()
+        last = self._last_logged.get(key)
+        if last is not None and now - last < self.interval:
+            self._suppressed[key] = self._suppressed.get(key, 0) + 1
+            return None
+        if len(self._last_logged) >= self.max_keys:
+            self._forgetOld(now)
+        self._last_logged[key] = now
+        return self._suppressed.pop(key, 0)
+
+    def _forgetOld(self, now):
+        for key, last in list(self._last_logged.items()):
+            if now - last >= self.interval:
+                del self._last_logged[key]
+                self._suppressed.pop(key, None)
+
+
+class CircuitBreakerWorkerThread(BackgroundWorkerThread):
+    """A background thread that backs off after repeated failures.
+
+    When an iteration fails ``failure_threshold`` times in a row (whether
+    in doWork(), the commit, or while opening the connection), the thread
+    stops doing work for ``reset_timeout`` seconds, then tries again once;
+    every time that trial fails too, the pause doubles (up to
+    ``max_reset_timeout``).  Conflict errors don't count as failures, but
+    other transient errors (like ZEO's ClientDisconnected) do.  Unlike
+    a plain BackgroundWorkerThread, the thread doesn't terminate when it
+    can't open a connection or prepare its work.
+
+    Identical tracebacks are logged at most once per
+    ``repeat_log_interval`` seconds.
+
+    Make scheduleNextWork() return False once ``stopped`` is set.
+    """
+
+    failure_threshold = 5
+    reset_timeout = 1.0
+    max_reset_timeout = 300.0
+    repeat_log_interval = 60.0
+
+    stopped = False
+
+    def __init__(self, *args, **kw):
+        super(CircuitBreakerWorkerThread, self).__init__(*args, **kw)
+        self.breaker = CircuitBreaker(
+            failure_threshold=self.failure_threshold,
+            reset_timeout=self.reset_timeout,
+            max_reset_timeout=self.max_reset_timeout)
+        self.throttle = TracebackThrottle(self.repeat_log_interval)
+        self._wakeup = threading.Event()
+
+    def stop(self):
+        """Ask the thread to terminate, even if it's backing off."""
+        self.stopped = True
+        self._wakeup.set()
+
+    def waitForBreaker(self):
+        """Sleep while the circuit breaker is open."""
+        while not self.breaker.allow() and not self.stopped:
+            self._wakeup.wait(self.breaker.retryIn())
+
+    @contextmanager
+    def workSlot(self):
+        self.waitForBreaker()
+        with super(CircuitBreakerWorkerThread, self).workSlot():
+            try:
+                yield
+            except:
+                # e.g. the storage is down and we couldn't open a connection;
+                # the base class would terminate the thread
+                self.iterationFailed()
+
+    def doWorkInTransaction(self):
+        if self.stopped:
+            return
+        super(CircuitBreakerWorkerThread, self).doWorkInTransaction()
+
+    def iterationFailed(self):
+        if not isinstance(sys.exc_info()[1], ConflictError):
+            if self.breaker.failure():
+                self.log.warning(
+                    "Circuit breaker opened in %s after %d failures,"
+                    " pausing for %.0f seconds"
+                    % (self.name, self.breaker.failures, self.breaker.timeout))
+        super(CircuitBreakerWorkerThread, self).iterationFailed()
+
+    def iterationSucceeded(self):
+        if self.breaker.failures:
+            if self.breaker.state == HALF_OPEN:
+                self.log.warning("Circuit breaker closed in %s" % self.name)
+            self.breaker.success()
+        super(CircuitBreakerWorkerThread, self).iterationSucceeded()
+
+    def logException(self):
+        suppressed = self.throttle.check(sys.exc_info())
+        if suppressed is None:
+            return
+        if suppressed:
+            self.log.exception(
+                "Exception in %s (%d identical exceptions not logged)"
+                % (self.name, suppressed))
+        else:
+            self.log.exception("Exception in %s" % self.name)
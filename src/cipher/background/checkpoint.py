@@ -0,0 +1,221 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Resumable long-running jobs."""
+
+import time
+
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+from zope.component import hooks
+
+from .thread import BackgroundWorkerThread
+
+
+CHECKPOINTS_KEY = 'cipher.background.checkpoints'
+
+
+class Checkpoint(Persistent):
+    """Progress of a long-running job, updated after every chunk."""
+
+    cursor = None
+    processed = 0
+    total = None
+    started = None
+    updated = None
+    finished = None
+
+    def __init__(self, name):
+        self.name = name
+
+
+def getCheckpoint(root, name):
+    """Look up (or create) a checkpoint in the database root."""
+    checkpoints = root.get(CHECKPOINTS_KEY)
+    if checkpoints is None:
+        checkpoints = root[CHECKPOINTS_KEY] = OOBTree()
+    checkpoint = checkpoints.get(name)
+    if checkpoint is None:
+        checkpoint = checkpoints[name] = Checkpoint(name)
+    return checkpoint
+
+
+def deleteCheckpoint(root, name):
+    """Forget a checkpoint, so the job starts from scratch next time."""
+    checkpoints = root.get(CHECKPOINTS_KEY)
+    if checkpoints is not None and name in checkpoints:
+        del checkpoints[name]
+
+
+class Progress(object):
+    """A snapshot of the progress of a checkpointed job."""
+
+    def __init__(self, processed, total, rate):
+        self.processed = processed
+        self.total = total
+        self.rate = rate  # items per second since this run started
+
+    @property
+    def fraction(self):
+        if not self.total:
+            return None
+        return min(1.0, float(self.processed) / self.total)
+
+    @property
+    def eta(self):
+        """Estimated number of seconds left, or None if unknown."""
+        if self.total is None or not self.rate:
+            return None
+        return max(0, self.total - self.processed) / self.rate
+
+    def __str__(self):
+        if self.fraction is None:
+            return '%d items' % self.processed
+        result = '%d/%d items (%.0f%%)' % (self.processed, self.total,
+                                           self.fraction * 100)
+        if self.eta is not None:
+            result += ', %.0f seconds left' % self.eta
+        return result
+
+
+class CheckpointedWorkerThread(BackgroundWorkerThread):
+    """A background thread for jobs that walk over lots of objects.
+
+    The job is done in chunks, one transaction per chunk.  After every
+    chunk its cursor is stored in a persistent checkpoint in the same
+    transaction, so when the thread is restarted (or a chunk fails) the
+    job resumes where it left off.
+
+    Subclasses ought to override processChunk() instead of doWork(), and
+    may override estimateTotal() to get an ETA.  The thread terminates
+    once the job is finished; remove the checkpoint with restart() to run
+    the job again.
+
+    When a chunk fails, the thread waits ``retry_delay`` seconds before
+    retrying it, twice as long after every consecutive failure, up to
+    ``max_retry_delay`` seconds.
+    """
+
+    checkpoint_name = None
+    chunk_size = 100
+    progress_interval = 60.0
+    retry_delay = 1.0
+    max_retry_delay = 300.0
+
+    finished = False
+    progress = None
+    consecutive_failures = 0
+
+    _sleep = staticmethod(time.sleep)
+
+    def __init__(self, *args, **kw):
+        super(CheckpointedWorkerThread, self).__init__(*args, **kw)
+        self._run_started = None
+        self._run_processed = None
+        self._last_report = None
+        self._pending = None
+
+    def getCheckpointName(self):
+        if self.checkpoint_name is not None:
+            return self.checkpoint_name
+        return '%s.%s for %s' % (self.__class__.__module__,
+                                 self.__class__.__name__, self.site_name)
+
+    def getCheckpoint(self):
+        root = hooks.getSite()._p_jar.root()
+        return getCheckpoint(root, self.getCheckpointName())
+
+    def restart(self):
+        """Forget the checkpoint (call within a transaction)."""
+        root = hooks.getSite()._p_jar.root()
+        deleteCheckpoint(root, self.getCheckpointName())
+        self.finished = False
+
+    def scheduleNextWork(self):
+        if self.consecutive_failures and not self.finished:
+            self._sleep(self.getRetryDelay())
+        return not self.finished
+
+    def getRetryDelay(self):
+        """Seconds to wait before retrying after the last failure."""
+        return min(self.max_retry_delay,
+                   self.retry_delay * 2 ** (self.consecutive_failures - 1))
+
+    def iterationFailed(self):
+        self.consecutive_failures += 1
+        super(CheckpointedWorkerThread, self).iterationFailed()
+
+    def iterationSucceeded(self):
+        self.consecutive_failures = 0
+        super(CheckpointedWorkerThread, self).iterationSucceeded()
+
+    def doWork(self):
+        self._pending = None
+        checkpoint = self.getCheckpoint()
+        now = self._clock()
+        if checkpoint.finished is not None:
+            self.finished = True
+            return
+        if checkpoint.started is None:
+            checkpoint.started = now
+            checkpoint.total = self.estimateTotal()
+        if self._run_started is None:
+            self._run_started = now
+            self._run_processed = checkpoint.processed
+        cursor, count = self.processChunk(checkpoint.cursor, self.chunk_size)
+        checkpoint.cursor = cursor
+        checkpoint.processed += count
+        checkpoint.updated = now
+        if cursor is None:
+            checkpoint.finished = now
+        elapsed = self._clock() - self._run_started
+        done = checkpoint.processed - self._run_processed
+        rate = float(done) / elapsed if elapsed > 0 else None
+        progress = Progress(checkpoint.processed, checkpoint.total, rate)
+        self._pending = (progress, cursor is None)
+
+    def doWorkInTransaction(self):
+        super(CheckpointedWorkerThread, self).doWorkInTransaction()
+        # the checkpoint counts only once it's committed
+        if self._pending is not None:
+            self.progress, self.finished = self._pending
+            self._pending = None
+            self.reportProgress()
+
+    def reportProgress(self):
+        now = self._clock()
+        if self.finished:
+            self.log.info("%s finished: %s" % (self.name, self.progress))
+        elif (self._last_report is None
+                or now - self._last_report >= self.progress_interval):
+            self._last_report = now
+            self.log.info("%s progress: %s" % (self.name, self.progress))
+
+    def estimateTotal(self):
+        """Estimate the number of items the job will process.
+
+        Called with a local site set when the job starts.  Returns None
+        (unknown) by default.
+        """
+
+    def processChunk(self, cursor, size):
+        """Process up to ``size`` items after ``cursor``.
+
+        ``cursor`` is None when the job starts.  Return a tuple
+        (new_cursor, number of items processed); return None as the new
+        cursor when there is nothing left to do.  Cursors are stored in the
+        ZODB, so they have to be picklable.
+
+        Called with a local site set and a working ZODB connection.
+        """
+        return None, 0
@@ -18,11 +18,13 @@ from contextlib import contextmanager, closing
 
 import transaction
 from zope.component import hooks
-from zope.security.management import newInteraction, endInteraction
+from zope.security.management import (ExistingInteraction, endInteraction,
+                                      newInteraction, queryInteraction,
+                                      thread_local)
 
 
 @contextmanager
-def ZopeInteraction(*participations):
+def ZopeInteraction(*participations, **kw):
     """Perform work within an interaction.
 
     Raises an error if the calling thread already has an interaction.
@@ -32,16 +34,29 @@ def ZopeInteraction(*participations):
         with ZopeInteraction():
             doStuff()
 
+    Pass ``interaction`` to resume an existing interaction (e.g. one that
+    was started in a different thread) instead of starting a new one.
     """
-    newInteraction(*participations)
+    interaction = kw.pop('interaction', None)
+    if kw:
+        raise TypeError('unexpected keyword arguments: %s'
+                        % ', '.join(sorted(kw)))
+    if interaction is None:
+        newInteraction(*participations)
+    elif queryInteraction() is not None:
+        raise ExistingInteraction("ZopeInteraction called"
+                                  " while another interaction is active.")
+    else:
+        thread_local.interaction = interaction
     try:
-        yield None
+        yield queryInteraction()
     finally:
         endInteraction()
 
 
 @contextmanager
-def ZodbConnection(db):
+def ZodbConnection(db, at=None, before=None, prefetch=None,
+                   transaction_manager=None):
     """Perform work with a ZODB connection.
 
     Example::
@@ -49,8 +64,25 @@ def ZodbConnection(db):
         with ZodbConnection(DB(FileStorage('Data.fs'))) as conn:
             doStuff(conn.root())
 
+    Pass ``at`` or ``before`` (a datetime or a transaction id) to get a
+    read-only historical connection that sees the database as it was at
+    that point in time.
+
+    Pass a list of OIDs (or persistent objects) as ``prefetch`` to ask the
+    storage to prefetch them, if it supports that (ZEO does).
+
+    Pass ``transaction_manager`` to join the connection to transactions of
+    that transaction manager instead of the current thread's.
     """
-    with closing(db.open()) as conn:
+    kw = {}
+    if at is not None or before is not None:
+        kw.update(at=at, before=before)
+    if transaction_manager is not None:
+        kw.update(transaction_manager=transaction_manager)
+    conn = db.open(**kw)
+    with closing(conn):
+        if prefetch:
+            conn.prefetch(prefetch)
         yield conn
 
 
@@ -73,7 +105,33 @@ def ZopeSite(site):
 
 
 @contextmanager
-def ZopeTransaction(user=None, note=None, path="/"):
+def CurrentTransactionManager(transaction_manager):
+    """Make a transaction manager the current thread's one.
+
+    Within the block transaction.get(), transaction.commit() etc. use
+    ``transaction_manager``.  Lets code that uses the thread-local
+    transaction API run on behalf of different logical workers in turn on
+    the same thread.
+
+    Example::
+
+        tm = transaction.TransactionManager()
+        with CurrentTransactionManager(tm):
+            doStuff()
+            transaction.commit()
+
+    """
+    thread_manager = transaction.manager
+    previous = thread_manager.manager
+    thread_manager.manager = transaction_manager
+    try:
+        yield transaction_manager
+    finally:
+        thread_manager.manager = previous
+
+
+@contextmanager
+def ZopeTransaction(user=None, note=None, path="/", transaction_manager=None):
     """Perform work within a new fresh transaction.
 
     Commits on success, aborts on exception.
@@ -84,16 +142,22 @@ def ZopeTransaction(user=None, note=None, path="/"):
             txn.setExtendedInfo('foo', 'bar')
             doStuff()
 
+    Pass ``transaction_manager`` to use it instead of the current thread's
+    transaction manager.
+
     WARNING: the "new fresh transaction" in the description above means that
     any previous but not yet committed transaction will be aborted!
     """
+    tm = transaction_manager
+    if tm is None:
+        tm = transaction.manager
     # XXX Note that transaction.begin() acts the same as transaction.abort(),
     # i.e.  discards the previous transaction.  This is desired in some
     # circumstances but surprising and painful in others.  I think it'd be nice
     # to have an explicit assertion verifying that the current transaction is
     # empty -- let the users call transaction.abort() explicitly if they want
     # that.
-    txn = transaction.begin()
+    txn = tm.begin()
     try:
         if user:
             txn.setUser(user, path)
@@ -102,8 +166,8 @@ def ZopeTransaction(user=None, note=None, path="/"):
         yield txn
         # don't use txn -- it may have already been committed or aborted,
         # and a new transaction started
-        transaction.commit()
+        tm.commit()
     except:
-        transaction.abort()
+        tm.abort()
         raise
 
@@ -0,0 +1,180 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Background workers triggered by changes to watched objects."""
+
+import threading
+import time
+
+from ZODB.mvccadapter import MVCCAdapter
+from ZODB.POSException import POSKeyError, ReadConflictError
+from ZODB.utils import get_pickle_metadata
+
+from .thread import BackgroundWorkerThread
+
+
+def _className(cls):
+    if isinstance(cls, str):
+        return cls
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+class InvalidationWatcher(object):
+    """Collect invalidations of interesting objects from a ZODB database.
+
+    Objects are interesting if their OID is in ``oids``, or if their class
+    is in ``classes`` (given as classes or as dotted names; subclasses don't
+    count).  Checking the class requires loading the object's pickle from
+    the storage, but no connection is needed and nothing is unpickled.
+
+    Storages that implement IMVCCStorage themselves (e.g. RelStorage) are
+    not supported and raise TypeError.
+
+    Example::
+
+        watcher = InvalidationWatcher(db, oids=[folder._p_oid])
+        while watcher.wait(timeout=60):
+            for oid in watcher.poll():
+                ...
+
+    """
+
+    def __init__(self, db, oids=(), classes=()):
+        self.oids = set(oids)
+        self.classes = set(_className(cls) for cls in classes)
+        self._event = threading.Event()
+        # DB has no public API for listening to invalidations, but its MVCC
+        # storage adapter notifies every instance it hands out, which is
+        # exactly what connections rely on.
+        mvcc_storage = getattr(db, '_mvcc_storage', None)
+        if not isinstance(mvcc_storage, MVCCAdapter):
+            raise TypeError("InvalidationWatcher doesn't support %s, only"
+                            " storages that ZODB wraps in an MVCCAdapter"
+                            % mvcc_storage.__class__.__name__)
+        self._storage = mvcc_storage.new_instance()
+        self._hookInstance(self._storage)
+        self._storage.poll_invalidations()
+
+    def _hookInstance(self, instance):
+        invalidate = instance._invalidate
+        invalidateCache = instance._invalidateCache
+
+        def _invalidate(tid, oids):
+            invalidate(tid, oids)
+            self._event.set()
+
+        def _invalidateCache():
+            invalidateCache()
+            self._event.set()
+
+        instance._invalidate = _invalidate
+        instance._invalidateCache = _invalidateCache
+
+    def wait(self, timeout=None):
+        """Wait until something changes in the database.
+
+        Returns False if the timeout expired with no changes.  Storages
+        don't always report all changes, so call poll() anyway every now
+        and then.
+        """
+        return self._event.wait(timeout)
+
+    def wakeup(self):
+        """Wake up the thread that is blocked in wait()."""
+        self._event.set()
+
+    def poll(self):
+        """Return the set of interesting OIDs changed since the last poll.
+
+        Returns None if the storage lost track of invalidations (e.g. after
+        a reconnection), in which case any object may have changed.
+        """
+        self._event.clear()
+        changed = self._storage.poll_invalidations()
+        if changed is None:
+            return None
+        return set(oid for oid in changed if self.isInteresting(oid))
+
+    def isInteresting(self, oid):
+        if oid in self.oids:
+            return True
+        if not self.classes:
+            return False
+        try:
+            data = self._storage.load(oid)[0]
+        except (POSKeyError, ReadConflictError):
+            # deleted (e.g. by a pack) before we could look at it
+            return False
+        return '.'.join(get_pickle_metadata(data)) in self.classes
+
+    def close(self):
+        self._storage.release()
+
+
+class InvalidationWorkerThread(BackgroundWorkerThread):
+    """A background thread that wakes up when watched objects change.
+
+    Instead of polling the database, list the OIDs (``watched_oids``)
+    and/or classes (``watched_classes``) you are interested in.  doWork()
+    is called with ``changed_oids`` set to the OIDs that changed since
+    the last run, collected over ``coalesce_delay`` seconds, or None if
+    the storage couldn't tell which objects changed.
+
+    Call stop() to terminate the thread.
+    """
+
+    watched_oids = ()
+    watched_classes = ()
+
+    coalesce_delay = 0.1
+    # some storages don't report all invalidations, so poll anyway
+    poll_interval = 60.0
+
+    changed_oids = None
+    watcher = None
+    stopped = False
+
+    def getWatcher(self):
+        if self.watcher is None:
+            self.watcher = InvalidationWatcher(self.site_db,
+                                               oids=self.watched_oids,
+                                               classes=self.watched_classes)
+        return self.watcher
+
+    def closeWatcher(self):
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+
+    def stop(self):
+        """Ask the thread to terminate."""
+        self.stopped = True
+        if self.watcher is not None:
+            self.watcher.wakeup()
+
+    def run(self):
+        try:
+            super(InvalidationWorkerThread, self).run()
+        finally:
+            self.closeWatcher()
+
+    def scheduleNextWork(self):
+        watcher = self.getWatcher()
+        while not self.stopped:
+            if watcher.wait(self.poll_interval) and not self.stopped:
+                time.sleep(self.coalesce_delay)
+            changed = watcher.poll()
+            if (changed is None or changed) and not self.stopped:
+                self.changed_oids = changed
+                return True
+        return False
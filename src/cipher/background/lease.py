@@ -0,0 +1,257 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Cluster-wide leases stored in the ZODB."""
+
+import os
+import socket
+import threading
+import time
+from contextlib import closing
+
+import transaction
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+from transaction.interfaces import TransientError
+
+from .thread import BackgroundWorkerThread
+
+
+LEASES_KEY = 'cipher.background.leases'
+
+
+def defaultNodeId():
+    """Identify this process in the cluster."""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class Lease(Persistent):
+    """A named lease, held by at most one node until it expires."""
+
+    holder = None
+    expires = 0
+
+    def __init__(self, name):
+        self.name = name
+
+    def isHeldBy(self, node_id, now):
+        return self.holder == node_id and self.expires > now
+
+    def isAvailableTo(self, node_id, now):
+        return self.holder in (None, node_id) or self.expires <= now
+
+
+def getLease(root, name, create=False):
+    """Look up a lease in the database root.
+
+    Returns None if the lease doesn't exist, unless ``create`` is true.
+    Every lease is a separate persistent object, so working with one lease
+    doesn't conflict with another.
+    """
+    leases = root.get(LEASES_KEY)
+    if leases is None:
+        if not create:
+            return None
+        leases = root[LEASES_KEY] = OOBTree()
+    lease = leases.get(name)
+    if lease is None and create:
+        lease = leases[name] = Lease(name)
+    return lease
+
+
+class LeaseLost(Exception):
+    """The lease expired before the transaction could commit."""
+
+
+class LeaseManager(object):
+    """Acquire, renew and release leases on behalf of a node.
+
+    All methods use a separate connection and transaction manager, so
+    they can be called while the calling thread has a transaction of its
+    own in progress.
+
+    Expiry times use the local clock of every node, so keep the clocks in
+    sync and the lease durations much longer than any clock skew.
+    """
+
+    _clock = staticmethod(time.time)
+
+    def __init__(self, db, node_id=None, duration=30.0):
+        self.db = db
+        self.node_id = node_id or defaultNodeId()
+        self.duration = duration
+
+    def _run(self, fn, note=None):
+        txn_manager = transaction.TransactionManager()
+        with closing(self.db.open(transaction_manager=txn_manager)) as conn:
+            txn = txn_manager.begin()
+            try:
+                result = fn(conn.root(), self._clock())
+                if note is None:
+                    txn_manager.abort()
+                else:
+                    txn.note(note)
+                    txn_manager.commit()
+                return result
+            except TransientError:
+                txn_manager.abort()
+                return None
+            except:
+                txn_manager.abort()
+                raise
+
+    def acquire(self, name):
+        """Acquire or renew a lease.
+
+        Returns the new expiry time, or None if another node holds
+        the lease.
+        """
+        def acquire(root, now):
+            lease = getLease(root, name, create=True)
+            if not lease.isAvailableTo(self.node_id, now):
+                return None
+            lease.holder = self.node_id
+            lease.expires = now + self.duration
+            return lease.expires
+        return self._run(acquire, 'lease %s for %s' % (name, self.node_id))
+
+    def release(self, name):
+        """Give up a lease, if held by this node."""
+        def release(root, now):
+            lease = getLease(root, name)
+            if lease is not None and lease.holder == self.node_id:
+                lease.holder = None
+                lease.expires = 0
+        self._run(release, 'lease %s released by %s' % (name, self.node_id))
+
+    def holders(self, prefix=''):
+        """Return a mapping of lease names to the nodes holding them.
+
+        Only unexpired leases with names starting with ``prefix`` are
+        included.
+        """
+        def holders(root, now):
+            leases = root.get(LEASES_KEY)
+            if leases is None:
+                return {}
+            result = {}
+            for name, lease in leases.items(min=prefix):
+                if not name.startswith(prefix):
+                    break
+                if lease.holder is not None and lease.expires > now:
+                    result[name] = lease.holder
+            return result
+        return self._run(holders)
+
+    def holder(self, name):
+        """Return the node currently holding a lease, or None."""
+        def holder(root, now):
+            lease = getLease(root, name)
+            if lease is not None and lease.expires > now:
+                return lease.holder
+        return self._run(holder)
+
+
+class LeaseWorkerThread(BackgroundWorkerThread):
+    """Base class for background threads that hold leases.
+
+    renewLeases() is called before the thread starts working and then
+    every ``lease_duration / 3`` seconds from a heartbeat thread;
+    releaseLeases() is called when the thread terminates.
+    """
+
+    lease_duration = 30.0
+    node_id = None
+
+    def __init__(self, *args, **kw):
+        super(LeaseWorkerThread, self).__init__(*args, **kw)
+        self.leases = LeaseManager(self.site_db, self.node_id,
+                                   self.lease_duration)
+        self._stop_heartbeat = threading.Event()
+
+    def renewLeases(self):
+        """Acquire or renew the leases this thread needs."""
+
+    def releaseLeases(self):
+        """Give up all leases held by this thread."""
+
+    def heartbeat(self):
+        while not self._stop_heartbeat.wait(self.lease_duration / 3.0):
+            try:
+                self.renewLeases()
+            except Exception:
+                self.log.exception("Could not renew leases in %s" % self.name)
+
+    def run(self):
+        """Main loop of the thread."""
+        try:
+            self.renewLeases()
+        except Exception:
+            self.log.exception("Could not acquire leases in %s" % self.name)
+        heartbeat = threading.Thread(target=self.heartbeat,
+                                     name='%s heartbeat' % self.name)
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            super(LeaseWorkerThread, self).run()
+        finally:
+            self._stop_heartbeat.set()
+            heartbeat.join()
+            self.releaseLeases()
+
+
+class SingletonWorkerThread(LeaseWorkerThread):
+    """A background thread that does its work on only one node at a time.
+
+    Every node runs the thread, but only the one holding the lease (see
+    getLeaseName()) calls doWork(); the others skip their jobs.  If the
+    leader dies, another node takes over once the lease expires.  Work
+    that is still running when the lease expires is not committed.
+    """
+
+    lease_expires = None
+
+    def getLeaseName(self):
+        """Name of the lease; one leader per class and site by default."""
+        return '%s.%s for %s' % (self.__class__.__module__,
+                                 self.__class__.__name__, self.site_name)
+
+    def holdsLease(self):
+        return (self.lease_expires is not None
+                and self._clock() < self.lease_expires)
+
+    def renewLeases(self):
+        try:
+            self.lease_expires = self.leases.acquire(self.getLeaseName())
+        except Exception:
+            self.lease_expires = None
+            raise
+
+    def releaseLeases(self):
+        if self.lease_expires is not None:
+            self.lease_expires = None
+            self.leases.release(self.getLeaseName())
+
+    def checkLease(self):
+        if not self.holdsLease():
+            raise LeaseLost(self.getLeaseName())
+
+    def doWorkInTransaction(self):
+        if not self.holdsLease():
+            self.log.debug("%s is not the leader, skipping work" % self.name)
+            return
+        super(SingletonWorkerThread, self).doWorkInTransaction()
+
+    def beginWork(self):
+        super(SingletonWorkerThread, self).beginWork()
+        transaction.get().addBeforeCommitHook(self.checkLease)
@@ -0,0 +1,224 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Running many logical background workers on a few threads.
+
+Example::
+
+    executor = CooperativeExecutor(threads=2)
+    for site in sites:
+        executor.add(MyMultiplexedWorker.forSite(site, 'admin'))
+    executor.start()
+    ...
+    executor.stop()
+
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import transaction
+
+from .registry import IDLE, SCHEDULING, STOPPED, registry
+from .thread import BackgroundWorkerThread
+
+
+log = logging.getLogger(__name__)
+
+
+class MultiplexedWorker(BackgroundWorkerThread):
+    """A logical background worker run by a CooperativeExecutor.
+
+    It's never started as a thread of its own.  Instead the executor
+    calls step() from one of its threads whenever the worker is due.
+    Every worker has its own transaction manager, which is the current one
+    while it does its work, and its own ZODB connection; the interaction
+    and the site are set up anew for every step.
+
+    Subclasses ought to override pollForWork() instead of
+    scheduleNextWork(), and must never block for long in any method.
+    """
+
+    poll_interval = 1.0
+
+    stopped = False
+
+    def __init__(self, *args, **kw):
+        super(MultiplexedWorker, self).__init__(*args, **kw)
+        self.transaction_manager = transaction.TransactionManager()
+
+    def pollForWork(self):
+        """Return True if there is work to do right now.
+
+        Must not block.  If it returns False, the worker is polled again
+        after ``poll_interval`` seconds.  Called without a ZODB connection.
+        """
+        return False
+
+    def stop(self):
+        """Ask the executor to drop this worker."""
+        self.stopped = True
+
+    def step(self):
+        """Do one unit of work, if there is any.
+
+        Returns the number of seconds until the worker wants to be called
+        again, or None if it should be dropped.
+        """
+        if self.stopped:
+            return None
+        if self._pollForWork():
+            self.runIteration()
+            return 0
+        return self.poll_interval
+
+    def _pollForWork(self):
+        self.setState(SCHEDULING)
+        try:
+            return self.pollForWork()
+        finally:
+            self.setState(IDLE)
+
+    def scheduleNextWork(self):
+        # used only if somebody starts the worker as a thread after all
+        while not self.stopped:
+            if self._pollForWork():
+                return True
+            time.sleep(self.poll_interval)
+        return False
+
+    def getStatus(self):
+        status = super(MultiplexedWorker, self).getStatus()
+        status['alive'] = not self.stopped
+        return status
+
+
+class CooperativeExecutor(object):
+    """Runs the steps of many MultiplexedWorkers on a pool of threads.
+
+    Every worker runs on at most one thread at a time; workers that are
+    due are served in order of their due time.
+    """
+
+    log = log  # let subclasses use a different logger if they want
+
+    _clock = staticmethod(time.time)
+
+    def __init__(self, threads=2, name='cooperative executor'):
+        self.threads = threads
+        self.name = name
+        self.workers = set()
+        self.running = 0
+        self._due = []  # heap of (due time, sequence number, worker)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+
+    def add(self, worker, delay=0):
+        """Add a worker; its first step is due after ``delay`` seconds."""
+        with self._cond:
+            self.workers.add(worker)
+            self._schedule(worker, delay)
+        registry.register(worker)
+
+    def _schedule(self, worker, delay):
+        heapq.heappush(self._due,
+                       (self._clock() + delay, next(self._seq), worker))
+        self._cond.notify()
+
+    def _drop(self, worker):
+        self.workers.discard(worker)
+        worker.setState(STOPPED)
+        registry.unregister(worker)
+
+    def start(self):
+        """Start the threads."""
+        self._stopping = False
+        registry.register(self)
+        for n in range(self.threads):
+            thread = threading.Thread(target=self._loop,
+                                      name='%s thread %d' % (self.name, n))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Stop the threads, letting steps in progress finish."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        registry.unregister(self)
+
+    def _next(self):
+        """Wait for a worker to be due and return it (None to terminate)."""
+        with self._cond:
+            while not self._stopping:
+                if self._due:
+                    wait = self._due[0][0] - self._clock()
+                    if wait <= 0:
+                        worker = heapq.heappop(self._due)[2]
+                        if worker not in self.workers:
+                            continue  # removed
+                        self.running += 1
+                        return worker
+                else:
+                    wait = None
+                self._cond.wait(wait)
+            return None
+
+    def _loop(self):
+        while True:
+            worker = self._next()
+            if worker is None:
+                return
+            self.runStep(worker)
+
+    def runStep(self, worker):
+        """Run one step of a worker and schedule the next one."""
+        try:
+            delay = worker.step()
+        except Exception:
+            self.log.exception("Exception in %s, dropping %s"
+                               % (self.name, worker.name))
+            delay = None
+        with self._cond:
+            self.running -= 1
+            if delay is None or worker not in self.workers:
+                self._drop(worker)
+            else:
+                self._schedule(worker, delay)
+
+    def remove(self, worker):
+        """Drop a worker (after its current step, if it's running)."""
+        with self._cond:
+            if worker in self.workers:
+                self._drop(worker)
+
+    def getStatus(self):
+        """Return a dict describing the executor (see registry)."""
+        with self._cond:
+            return dict(
+                name=self.name,
+                class_name=self.__class__.__name__,
+                threads=len(self._threads),
+                workers=len(self.workers),
+                running=self.running,
+                queue_depth=len(self._due),
+            )
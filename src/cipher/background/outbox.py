@@ -0,0 +1,175 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Side effects dispatched after a successful commit."""
+
+import logging
+import threading
+import time
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    # Python 2 BBB
+    from Queue import Queue, Empty
+
+import transaction
+
+from .registry import registry
+
+
+log = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class Outbox(object):
+    """Send messages after the transaction that produced them commits.
+
+    Messages added during a transaction are dropped if the transaction
+    aborts.  After a successful commit they are handed, in batches of up
+    to ``batch_size``, to ``transport.send(messages)`` from a pool of
+    ``threads`` sender threads, so slow remote I/O doesn't hold up the
+    worker or lengthen its transaction.  Failed batches are retried up to
+    ``max_attempts`` times with exponential backoff, starting at
+    ``retry_delay`` seconds.
+
+    Example::
+
+        outbox = Outbox(WebhookTransport(url))
+        outbox.start()
+
+        with ZopeTransaction(user='root', note='publishing'):
+            document.publish()
+            outbox.add(dict(event='published', oid=document._p_oid))
+
+        outbox.stop()
+
+    """
+
+    log = log  # let subclasses use a different logger if they want
+
+    _sleep = staticmethod(time.sleep)
+
+    def __init__(self, transport, threads=1, batch_size=10, max_attempts=3,
+                 retry_delay=1.0):
+        self.transport = transport
+        self.threads = threads
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.sent = 0
+        self.failed = 0
+        self._queue = Queue()
+        self._senders = []
+        self._lock = threading.Lock()
+
+    def add(self, message, txn=None):
+        """Send message once the transaction commits.
+
+        Uses the current transaction unless you pass ``txn``.
+        """
+        if txn is None:
+            txn = transaction.get()
+        try:
+            messages = txn.data(self)
+        except KeyError:
+            messages = []
+            txn.set_data(self, messages)
+            txn.addAfterCommitHook(self._afterCommit, (messages, ))
+        messages.append(message)
+
+    def _afterCommit(self, status, messages):
+        if status:
+            for message in messages:
+                self._queue.put(message)
+
+    def getStatus(self):
+        """Return a dict describing the outbox (see registry)."""
+        return dict(
+            name='outbox (%s)' % self.transport.__class__.__name__,
+            class_name=self.__class__.__name__,
+            threads=len(self._senders),
+            queue_depth=self._queue.qsize(),
+            sent=self.sent,
+            failed=self.failed,
+        )
+
+    def start(self):
+        """Start the sender threads."""
+        registry.register(self)
+        for n in range(self.threads):
+            sender = threading.Thread(target=self._sendLoop,
+                                      name='outbox sender %d' % n)
+            sender.daemon = True
+            sender.start()
+            self._senders.append(sender)
+
+    def flush(self):
+        """Wait until all committed messages are sent (or given up on)."""
+        self._queue.join()
+
+    def stop(self, timeout=None):
+        """Send all pending messages and stop the sender threads."""
+        for sender in self._senders:
+            self._queue.put(_STOP)
+        for sender in self._senders:
+            sender.join(timeout)
+        self._senders = []
+        registry.unregister(self)
+
+    def _sendLoop(self):
+        while True:
+            message = self._queue.get()
+            if message is _STOP:
+                self._queue.task_done()
+                return
+            batch = [message]
+            while len(batch) < self.batch_size:
+                try:
+                    message = self._queue.get_nowait()
+                except Empty:
+                    break
+                if message is _STOP:
+                    # leave it for the next iteration
+                    self._queue.put(_STOP)
+                    self._queue.task_done()
+                    break
+                batch.append(message)
+            try:
+                self.deliver(batch)
+            finally:
+                for message in batch:
+                    self._queue.task_done()
+
+    def deliver(self, batch):
+        """Send a batch of messages, retrying on failure."""
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.transport.send(batch)
+            except Exception:
+                if attempt >= self.max_attempts:
+                    self.log.exception(
+                        "Giving up on %d messages after %d attempts",
+                        len(batch), attempt)
+                    with self._lock:
+                        self.failed += len(batch)
+                    return
+                self.log.warning(
+                    "Failed to send %d messages (attempt %d), retrying",
+                    len(batch), attempt)
+                self._sleep(self.retry_delay * 2 ** (attempt - 1))
+            else:
+                with self._lock:
+                    self.sent += len(batch)
+                return
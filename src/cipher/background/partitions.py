@@ -0,0 +1,236 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Durable job queues shared by several nodes."""
+
+import random
+import threading
+import time
+import zlib
+
+import transaction
+from BTrees.LOBTree import LOBTree
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+from zope.component import hooks
+
+from .lease import LeaseLost, LeaseWorkerThread
+from .tracing import Traced
+
+
+QUEUES_KEY = 'cipher.background.queues'
+
+
+class JobPartition(Persistent):
+    """A part of a job queue, processed by one node at a time.
+
+    Jobs are kept in a BTree keyed by enqueue time, so producers adding
+    jobs and the node removing them from the other end rarely conflict.
+    """
+
+    _clock = staticmethod(time.time)
+
+    def __init__(self):
+        self.jobs = LOBTree()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def put(self, job):
+        key = int(self._clock() * 1000000)
+        if self.jobs and key <= self.jobs.maxKey():
+            key = self.jobs.maxKey() + 1
+        self.jobs[key] = job
+
+    def pop(self):
+        """Remove and return the oldest job, or None."""
+        if not self.jobs:
+            return None
+        return self.jobs.pop(self.jobs.minKey())
+
+
+class PartitionedJobQueue(Persistent):
+    """A durable job queue split into a fixed number of partitions."""
+
+    def __init__(self, partitions=16):
+        self.partitions = tuple(JobPartition() for n in range(partitions))
+
+    def __len__(self):
+        return sum(len(partition) for partition in self.partitions)
+
+    def put(self, job, key=None, trace=None):
+        """Add a job.
+
+        Jobs with the same ``key`` go to the same partition, and are
+        therefore processed in order by a single node.  Jobs without a key
+        go to a random partition.
+
+        Pass a TraceContext (e.g. from ``Tracer.enqueue()``) as ``trace`` to
+        trace the job through the worker that processes it.
+        """
+        if trace is not None:
+            job = Traced(job, trace)
+        if key is None:
+            idx = random.randrange(len(self.partitions))
+        else:
+            # don't use hash(), it's randomized per process
+            idx = zlib.crc32(str(key).encode('UTF-8')) % len(self.partitions)
+        self.partitions[idx].put(job)
+
+
+def getJobQueue(root, name, partitions=16):
+    """Look up (or create) a job queue in the database root."""
+    queues = root.get(QUEUES_KEY)
+    if queues is None:
+        queues = root[QUEUES_KEY] = OOBTree()
+    queue = queues.get(name)
+    if queue is None:
+        queue = queues[name] = PartitionedJobQueue(partitions)
+    return queue
+
+
+class PartitionedWorkerThread(LeaseWorkerThread):
+    """A background thread that processes jobs from a shared queue.
+
+    Every node runs the thread.  The partitions of the queue are divided
+    between the live nodes using leases, so every node only removes jobs
+    from its own partitions and nodes don't conflict with each other.
+    When a node dies its partitions are taken over by the others once the
+    leases expire; when a node joins, the others release partitions until
+    everyone has a fair share.
+
+    Producers add jobs with ``getJobQueue(root, queue_name).put(job)``.
+
+    Subclasses ought to override processJob() instead of doWork().  Call
+    stop() to terminate the thread.
+    """
+
+    queue_name = None
+    partitions = 16
+    poll_interval = 1.0
+
+    idle = False
+    stopped = False
+
+    def __init__(self, *args, **kw):
+        super(PartitionedWorkerThread, self).__init__(*args, **kw)
+        self.owned = {}  # partition index -> lease expiry time
+        self._wakeup = threading.Event()
+        self._next_partition = 0
+
+    def getQueueName(self):
+        if self.queue_name is not None:
+            return self.queue_name
+        return '%s.%s for %s' % (self.__class__.__module__,
+                                 self.__class__.__name__, self.site_name)
+
+    def getPartitionLeaseName(self, idx):
+        return '%s partition %d' % (self.getQueueName(), idx)
+
+    def getNodeLeaseName(self):
+        return '%s node %s' % (self.getQueueName(), self.leases.node_id)
+
+    def renewLeases(self):
+        queue_name = self.getQueueName()
+        self.leases.acquire(self.getNodeLeaseName())
+        nodes = self.leases.holders('%s node ' % queue_name) or {}
+        share = -(-self.partitions // max(1, len(nodes)))
+        owned = {}
+        for idx in sorted(self.owned):
+            name = self.getPartitionLeaseName(idx)
+            if len(owned) >= share:
+                self.leases.release(name)
+                continue
+            expires = self.leases.acquire(name)
+            if expires is not None:
+                owned[idx] = expires
+        if len(owned) < share:
+            # a conflict while renewing may have dropped partitions that
+            # we still hold, so those count as available
+            taken = self.leases.holders('%s partition ' % queue_name) or {}
+            for idx in range(self.partitions):
+                if len(owned) >= share:
+                    break
+                name = self.getPartitionLeaseName(idx)
+                if idx in owned:
+                    continue
+                if taken.get(name, self.leases.node_id) != self.leases.node_id:
+                    continue
+                expires = self.leases.acquire(name)
+                if expires is not None:
+                    owned[idx] = expires
+        self.owned = owned
+
+    def releaseLeases(self):
+        owned, self.owned = self.owned, {}
+        for idx in owned:
+            self.leases.release(self.getPartitionLeaseName(idx))
+        self.leases.release(self.getNodeLeaseName())
+
+    def holdsPartition(self, idx):
+        expires = self.owned.get(idx)
+        return expires is not None and self._clock() < expires
+
+    def checkPartition(self, idx):
+        if not self.holdsPartition(idx):
+            raise LeaseLost(self.getPartitionLeaseName(idx))
+
+    def stop(self):
+        """Ask the thread to terminate."""
+        self.stopped = True
+        self._wakeup.set()
+
+    def scheduleNextWork(self):
+        if self.idle and not self.stopped:
+            self._wakeup.wait(self.poll_interval)
+        return not self.stopped
+
+    def claimJob(self):
+        """Remove the next job from one of our partitions.
+
+        Returns a tuple (partition index, job), or None if there are no
+        jobs in our partitions.  Partitions are visited round-robin.
+        """
+        root = hooks.getSite()._p_jar.root()
+        queue = getJobQueue(root, self.getQueueName(), self.partitions)
+        owned = sorted(idx for idx in self.owned if self.holdsPartition(idx))
+        if not owned:
+            return None
+        start = self._next_partition % len(owned)
+        for idx in owned[start:] + owned[:start]:
+            job = queue.partitions[idx].pop()
+            if job is not None:
+                self._next_partition = owned.index(idx) + 1
+                return idx, job
+        return None
+
+    def doWork(self):
+        claimed = self.claimJob()
+        self.idle = claimed is None
+        if claimed is None:
+            return
+        idx, job = claimed
+        if isinstance(job, Traced):
+            self.traceJob(job.context)
+            job = job.job
+        self.current_job = 'job from partition %d: %r' % (idx, job)
+        # make sure nobody else took over the partition in the meantime
+        transaction.get().addBeforeCommitHook(self.checkPartition, (idx, ))
+        self.processJob(job)
+
+    def processJob(self, job):
+        """Process a single job.
+
+        Called with a local site set and a working ZODB connection, in the
+        same transaction that removes the job from the queue.
+        """
@@ -0,0 +1,149 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Background workers that keep computation out of ZODB transactions."""
+
+import transaction
+
+from .contextmanagers import ZopeInteraction, ZodbConnection, ZopeSite
+from .registry import PREPARING
+from .thread import BackgroundWorkerThread
+
+
+class TwoPhaseWorkerThread(BackgroundWorkerThread):
+    """A background thread that splits every job into read, compute and
+    write phases.
+
+    Only the read and the write phases hold a ZODB connection, so a slow
+    computation doesn't keep a stale snapshot open (and doesn't make the
+    final commit likely to conflict).
+
+    Subclasses ought to override the following methods instead of doWork():
+
+      - readData -- extract plain (non-persistent) data from the database;
+        runs with a site and a connection in a transaction that is
+        always aborted
+
+      - compute -- do the heavy lifting on the data returned by readData();
+        runs with no ZODB connection open, in ``executor`` if one is set
+        (or set ``computeFunction`` instead, see below)
+
+      - validateResult -- check, in the write transaction, that the
+        result still applies; return False to discard it
+
+      - applyResult -- store the result in a fresh, short transaction
+
+    ``executor`` can be anything with a concurrent.futures-style
+    ``submit()`` method, e.g. a ThreadPoolExecutor.  compute() is a method
+    of the thread, which can't be pickled, so to use a ProcessPoolExecutor
+    set ``computeFunction`` to a module-level function (wrapped in
+    staticmethod()); it's called with the data instead of compute(), and
+    it, the data and the result must be picklable.
+    """
+
+    read_transaction_note = "%(thread_name)s read"
+
+    executor = None
+    computeFunction = None
+
+    def getReadNote(self):
+        """Note for the (never committed) read transaction."""
+        return self.read_transaction_note % dict(
+                    thread_name=self.name,
+                    class_name=self.__class__.__name__,
+                    site_name=self.site_name,
+                    user_name=self.user_name)
+
+    data = result = None
+    prepared = False  # did the read and compute phases of this job succeed?
+
+    def prepareWork(self):
+        """Run the read and the compute phases."""
+        self.data = self.result = None
+        self.prepared = False
+        self.setState(PREPARING)
+        try:
+            self.data = self.runReadPhase()
+            self.result = self.computePhase(self.data)
+        except:
+            self.iterationFailed()
+        else:
+            self.prepared = True
+
+    def doWorkInTransaction(self):
+        # skip the write phase if the read or the compute phase failed
+        if self.prepared:
+            super(TwoPhaseWorkerThread, self).doWorkInTransaction()
+
+    def doWork(self):
+        """Run the write phase."""
+        if not self.validateResult(self.data, self.result):
+            self.log.warning("Discarding stale result in %s" % self.name)
+            return
+        self.applyResult(self.data, self.result)
+
+    def runInSite(self, fn, *args):
+        """Call fn(*args) with an interaction, a connection and a site."""
+        with ZopeInteraction():
+            with ZodbConnection(
+                    self.site_db,
+                    transaction_manager=self.transaction_manager) as conn:
+                with ZopeSite(self.getSite(conn)):
+                    return fn(*args)
+
+    def runReadPhase(self):
+        """Run the read phase and return the data it extracted."""
+        return self.runInSite(self.readPhase)
+
+    def readPhase(self):
+        txn = transaction.begin()
+        try:
+            txn.note(self.getReadNote())
+            return self.readData()
+        finally:
+            transaction.abort()
+
+    def computePhase(self, data):
+        compute = self.computeFunction
+        if compute is None:
+            compute = self.compute
+        if self.executor is not None:
+            return self.executor.submit(compute, data).result()
+        return compute(data)
+
+    def readData(self):
+        """Extract the data needed for the computation.
+
+        Return plain Python objects, not persistent ones: the connection
+        is closed before compute() is called.
+        """
+
+    def compute(self, data):
+        """Perform the computation and return the result.
+
+        Called with no ZODB connection, site or interaction.
+        """
+
+    def validateResult(self, data, result):
+        """Check that the result can still be applied.
+
+        Called in the write transaction.  Returns True by default.
+        """
+        return True
+
+    def applyResult(self, data, result):
+        """Store the result.
+
+        Called with a local site set and a fresh ZODB connection, in a
+        transaction that is committed right afterwards.
+        """
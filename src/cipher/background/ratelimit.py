@@ -0,0 +1,260 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Limiting the rate at which background work writes to the storage.
+
+Example::
+
+    from cipher.background.ratelimit import Budget, write_limiter
+    from cipher.background.thread import BackgroundWorkerThread
+
+    # throttle all background workers in the process
+    BackgroundWorkerThread.write_limiter = write_limiter
+    write_limiter.setBudget(None, Budget(commit_rate=20, byte_rate=2e6))
+    write_limiter.setBudget('ReindexWorker', Budget(commit_rate=2))
+
+    # optionally, slow down while foreground requests are slow
+    write_limiter.target_latency = 0.5
+    ...
+    write_limiter.reportLatency(request_duration)
+
+"""
+
+import threading
+import time
+
+from .accounting import getWriteCounter
+
+
+class Budget(object):
+    """How much background work may write.
+
+    ``commit_rate`` limits commits per second, ``byte_rate`` limits bytes
+    written per second; None means unlimited.  Up to ``burst`` seconds
+    worth of unused budget (but at least one commit) can be saved up.
+    """
+
+    def __init__(self, commit_rate=None, byte_rate=None, burst=1.0):
+        self.commit_rate = commit_rate
+        self.byte_rate = byte_rate
+        self.burst = burst
+
+
+class _Bucket(object):
+    """A token bucket; the tokens may go negative (i.e. into debt)."""
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.refilled = now
+
+    def refill(self, now, factor):
+        self.tokens = min(self.capacity, self.tokens
+                          + (now - self.refilled) * self.rate * factor)
+        self.refilled = now
+
+    def dueIn(self, needed, factor):
+        """Seconds until there are ``needed`` tokens."""
+        # allow for rounding errors, or we might never stop waiting
+        if self.tokens >= needed - 1e-9:
+            return 0
+        return (needed - self.tokens) / (self.rate * factor)
+
+
+class _Limit(object):
+    """The commit and byte buckets of a budget, and their usage."""
+
+    def __init__(self, budget, now):
+        self.budget = budget
+        self.commits = self.bytes = None
+        if budget.commit_rate is not None:
+            self.commits = _Bucket(budget.commit_rate,
+                                   max(1.0, budget.commit_rate * budget.burst),
+                                   now)
+        if budget.byte_rate is not None:
+            self.bytes = _Bucket(budget.byte_rate,
+                                 budget.byte_rate * budget.burst, now)
+
+    def buckets(self):
+        return [b for b in (self.commits, self.bytes) if b is not None]
+
+
+class WriteRateLimiter(object):
+    """Token-bucket limits on the commits and bytes written by background
+    work, process-wide and per worker class.
+
+    Thread-safe.  Worker threads call throttle() right before committing;
+    it waits until both the process-wide budget and the budget of the
+    worker's class allow one more commit.  The bytes a commit writes are
+    only known afterwards, so they're charged after the fact: a big commit
+    makes the following ones wait until the debt is paid off.
+
+    If ``target_latency`` is set, foreground code can report its latency
+    with reportLatency(), and all the rates are scaled down (by
+    ``backoff``, but never below ``min_factor``) while the smoothed latency
+    is above the target, and back up (by ``recovery``) while it's not.
+    """
+
+    target_latency = None
+    latency_smoothing = 0.2
+    adjust_interval = 1.0
+    min_factor = 0.1
+    backoff = 0.5
+    recovery = 0.1
+
+    _clock = staticmethod(time.time)
+    _sleep = staticmethod(time.sleep)
+
+    def __init__(self, budget=None):
+        self._lock = threading.Lock()
+        self._limits = {}
+        self._stats = {}
+        self.factor = 1.0
+        self.latency = None
+        self._adjusted = None
+        if budget is not None:
+            self.setBudget(None, budget)
+
+    def setBudget(self, class_name, budget):
+        """Set the budget of a worker class (or process-wide, if None).
+
+        Pass None as ``budget`` to remove the limit.
+        """
+        with self._lock:
+            if budget is None:
+                self._limits.pop(class_name, None)
+            else:
+                self._limits[class_name] = _Limit(budget, self._clock())
+
+    def getBudget(self, class_name=None):
+        limit = self._limits.get(class_name)
+        return limit.budget if limit is not None else None
+
+    def _getLimits(self, class_name):
+        keys = [None] if class_name is None else [None, class_name]
+        return [self._limits[key] for key in keys if key in self._limits]
+
+    def _getStats(self, class_name):
+        stats = self._stats.get(class_name)
+        if stats is None:
+            stats = self._stats[class_name] = dict(
+                commits=0, bytes_written=0, waits=0, waited=0.0)
+        return stats
+
+    def wait(self, class_name=None):
+        """Wait until a commit is allowed, and take a commit token.
+
+        Returns the number of seconds waited.
+        """
+        started = self._clock()
+        while True:
+            with self._lock:
+                now = self._clock()
+                limits = self._getLimits(class_name)
+                delay = 0
+                for limit in limits:
+                    if limit.commits is not None:
+                        limit.commits.refill(now, self.factor)
+                        delay = max(delay,
+                                    limit.commits.dueIn(1, self.factor))
+                    if limit.bytes is not None:
+                        limit.bytes.refill(now, self.factor)
+                        delay = max(delay, limit.bytes.dueIn(0, self.factor))
+                if delay <= 0:
+                    for limit in limits:
+                        if limit.commits is not None:
+                            limit.commits.tokens -= 1
+                    waited = now - started
+                    if waited > 0:
+                        stats = self._getStats(class_name)
+                        stats['waits'] += 1
+                        stats['waited'] += waited
+                    return waited
+            self._sleep(delay)
+
+    def charge(self, class_name=None, bytes_written=0, commits=1):
+        """Record a commit and the bytes it wrote."""
+        with self._lock:
+            for limit in self._getLimits(class_name):
+                if limit.bytes is not None:
+                    limit.bytes.tokens -= bytes_written
+            stats = self._getStats(class_name)
+            stats['commits'] += commits
+            stats['bytes_written'] += bytes_written
+
+    def throttle(self, conn, class_name=None, txn=None):
+        """Wait for budget before committing ``txn`` (by default the
+        current transaction) on a ZODB connection.
+
+        Read-only transactions don't touch the storage, and don't wait.
+        Returns the number of seconds waited.
+        """
+        # there's no public API for asking whether a connection has changes
+        if not getattr(conn, '_registered_objects', True):
+            return 0
+        if txn is None:
+            txn = conn.transaction_manager.get()
+        waited = self.wait(class_name)
+        counter = getWriteCounter(conn)
+        start = counter.bytes_written if counter is not None else 0
+        txn.addAfterCommitHook(self._committed,
+                               (class_name, counter, start))
+        return waited
+
+    def _committed(self, status, class_name, counter, start):
+        if not status:
+            return
+        bytes_written = 0
+        if counter is not None:
+            bytes_written = counter.bytes_written - start
+        self.charge(class_name, bytes_written)
+
+    def reportLatency(self, latency):
+        """Report the latency of a foreground request (in seconds).
+
+        Does nothing unless ``target_latency`` is set.
+        """
+        if self.target_latency is None:
+            return
+        with self._lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.latency_smoothing * (latency
+                                                          - self.latency)
+            now = self._clock()
+            if (self._adjusted is not None
+                    and now - self._adjusted < self.adjust_interval):
+                return
+            self._adjusted = now
+            for limit in self._limits.values():
+                for bucket in limit.buckets():
+                    bucket.refill(now, self.factor)
+            if self.latency > self.target_latency:
+                self.factor = max(self.min_factor, self.factor * self.backoff)
+            else:
+                self.factor = min(1.0, self.factor + self.recovery)
+
+    def stats(self):
+        """Return a dict mapping worker class names to usage dicts.
+
+        Every dict has the number of commits, bytes written, number of
+        waits and total seconds waited.
+        """
+        with self._lock:
+            return dict((class_name, dict(stats))
+                        for class_name, stats in self._stats.items())
+
+
+write_limiter = WriteRateLimiter()
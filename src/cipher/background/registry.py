@@ -0,0 +1,78 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Process-wide registry of running background workers.
+
+Example (e.g. in a status view)::
+
+    from cipher.background.registry import registry
+
+    for status in registry.snapshot():
+        print('%(name)s: %(state)s' % status)
+
+"""
+
+import threading
+import weakref
+
+
+# Worker states
+IDLE = 'idle'
+SCHEDULING = 'scheduling'
+PREPARING = 'preparing'
+OPENING = 'opening connection'
+WORKING = 'working'
+THROTTLED = 'waiting for write budget'
+COMMITTING = 'committing'
+CLEANING_UP = 'cleaning up'
+STOPPED = 'stopped'
+
+
+class WorkerRegistry(object):
+    """Keeps track of running workers and worker pools.
+
+    Anything with a getStatus() method returning a dict can be registered.
+    BackgroundWorkerThreads register themselves while they run; so does
+    the Outbox while its sender threads are running.  Objects are held
+    weakly.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._workers = weakref.WeakKeyDictionary()
+        self._counter = 0
+
+    def register(self, worker):
+        with self._lock:
+            self._counter += 1
+            self._workers[worker] = self._counter
+
+    def unregister(self, worker):
+        with self._lock:
+            self._workers.pop(worker, None)
+
+    def workers(self):
+        """Return the registered workers in registration order."""
+        with self._lock:
+            items = list(self._workers.items())
+        return [worker for worker, n in sorted(items, key=lambda i: i[1])]
+
+    def snapshot(self):
+        """Return a list of status dicts of all registered workers.
+
+        Cheap: doesn't touch the ZODB, only copies a few attributes.
+        """
+        return [worker.getStatus() for worker in self.workers()]
+
+
+registry = WorkerRegistry()
@@ -0,0 +1,202 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Durable delayed retries and dead letters for failing jobs."""
+
+import transaction
+from BTrees.LOBTree import LOBTree
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+from transaction.interfaces import TransientError
+from zope.component import hooks
+
+from .thread import BackgroundWorkerThread
+
+
+RETRIES_KEY = 'cipher.background.retries'
+
+
+def _key(now):
+    return int(now * 1000000)
+
+
+def _insert(tree, key, value):
+    while key in tree:
+        key += 1
+    tree[key] = value
+    return key
+
+
+class FailedJob(Persistent):
+    """A job that failed at least once."""
+
+    attempts = 0
+    first_failure = None
+    last_failure = None
+    last_error = None
+
+    def __init__(self, job):
+        self.job = job
+
+    def failed(self, error, now):
+        self.attempts += 1
+        if self.first_failure is None:
+            self.first_failure = now
+        self.last_failure = now
+        self.last_error = error
+
+
+class RetryQueue(Persistent):
+    """Failed jobs waiting for a retry, and jobs that failed too many times.
+
+    ``scheduled`` maps due times (in microseconds) to FailedJob objects,
+    ``dead`` maps the time jobs were given up on to FailedJob objects.
+    """
+
+    def __init__(self):
+        self.scheduled = LOBTree()
+        self.dead = LOBTree()
+
+    def popDue(self, now):
+        """Remove and return the first failed job that is due, or None."""
+        if not self.scheduled:
+            return None
+        key = self.scheduled.minKey()
+        if key > _key(now):
+            return None
+        return self.scheduled.pop(key)
+
+    def nextDue(self):
+        """Return the time the next retry is due, or None."""
+        if not self.scheduled:
+            return None
+        return self.scheduled.minKey() / 1000000.0
+
+    def failed(self, entry, error, now, max_attempts=5, delay=60.0,
+               max_delay=3600.0):
+        """Record a failure of a job.
+
+        Schedules a retry with exponential backoff and returns True, or
+        moves the job to the dead letters and returns False after
+        ``max_attempts`` failures.
+        """
+        entry.failed(error, now)
+        if entry.attempts >= max_attempts:
+            _insert(self.dead, _key(now), entry)
+            return False
+        backoff = min(max_delay, delay * 2 ** (entry.attempts - 1))
+        _insert(self.scheduled, _key(now + backoff), entry)
+        return True
+
+    def replay(self, key, now):
+        """Move a dead letter back to the retry queue, due now.
+
+        The attempt counter is reset.
+        """
+        entry = self.dead.pop(key)
+        entry.attempts = 0
+        _insert(self.scheduled, _key(now), entry)
+        return entry
+
+    def discard(self, key):
+        """Forget a dead letter."""
+        return self.dead.pop(key)
+
+
+def getRetryQueue(root, name):
+    """Look up (or create) a retry queue in the database root."""
+    queues = root.get(RETRIES_KEY)
+    if queues is None:
+        queues = root[RETRIES_KEY] = OOBTree()
+    queue = queues.get(name)
+    if queue is None:
+        queue = queues[name] = RetryQueue()
+    return queue
+
+
+class RetryingWorkerThread(BackgroundWorkerThread):
+    """A background thread that retries failed jobs later.
+
+    Subclasses ought to override getNextJob() and processJob() instead of
+    doWork().  Every doWork() first takes a failed job whose retry is due,
+    and only then asks getNextJob() for a new one.
+
+    When processJob() raises, its changes are rolled back (to a savepoint)
+    and the job is stored in a retry queue in the same transaction, so the
+    failure is recorded atomically with the removal of the job from its
+    source.  Retries back off exponentially starting at ``retry_delay``
+    seconds; after ``max_attempts`` failures the job is moved to the dead
+    letters, where it can be inspected and replayed.  Conflict errors are
+    not counted as failures; the whole transaction is aborted as usual.
+
+    Make sure scheduleNextWork() returns every now and then even when there
+    is no new work, so that retries get processed when they're due.
+    """
+
+    max_attempts = 5
+    retry_delay = 60.0
+    max_retry_delay = 3600.0
+    retry_queue_name = None
+
+    def getRetryQueueName(self):
+        if self.retry_queue_name is not None:
+            return self.retry_queue_name
+        return '%s.%s for %s' % (self.__class__.__module__,
+                                 self.__class__.__name__, self.site_name)
+
+    def getRetryQueue(self):
+        root = hooks.getSite()._p_jar.root()
+        return getRetryQueue(root, self.getRetryQueueName())
+
+    def doWork(self):
+        queue = self.getRetryQueue()
+        now = self._clock()
+        entry = queue.popDue(now)
+        if entry is not None:
+            job = entry.job
+        else:
+            job = self.getNextJob()
+            if job is None:
+                return
+        self.current_job = repr(job)
+        savepoint = transaction.savepoint()
+        try:
+            self.processJob(job)
+        except TransientError:
+            raise
+        except Exception as e:
+            savepoint.rollback()
+            self.log.exception("Job failed in %s" % self.name)
+            if entry is None:
+                entry = FailedJob(job)
+            error = '%s: %s' % (e.__class__.__name__, e)
+            if not queue.failed(entry, error, now,
+                                max_attempts=self.max_attempts,
+                                delay=self.retry_delay,
+                                max_delay=self.max_retry_delay):
+                self.log.error("Giving up on job in %s after %d attempts"
+                               % (self.name, entry.attempts))
+
+    def getNextJob(self):
+        """Return the next job, or None.
+
+        Called with a local site set and a working ZODB connection.  If the
+        job is removed from a persistent queue, the removal is committed
+        even if processJob() fails.
+        """
+
+    def processJob(self, job):
+        """Process a job.
+
+        Called with a local site set and a working ZODB connection.
+        """
@@ -0,0 +1,255 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Fair sharing of background work capacity between tenants.
+
+A tenant is a (site_name, user_name) pair.  Worker threads of all tenants
+ask one FairScheduler for a slot before every iteration; when there are
+more of them than slots, deficit round-robin decides whose turn it is.
+"""
+
+import collections
+import threading
+import time
+from contextlib import contextmanager
+
+from .thread import BackgroundWorkerThread
+
+
+class Quota(object):
+    """Scheduling parameters of a tenant.
+
+    ``weight`` (> 0) is the relative share of capacity the tenant gets when
+    others are waiting too, ``max_concurrent`` limits the number of slots
+    it may hold at once, and ``rate`` limits the cost of the work it may
+    start per second (with bursts of up to ``burst``).
+    """
+
+    def __init__(self, weight=1.0, max_concurrent=None, rate=None,
+                 burst=1.0):
+        if not weight > 0:
+            raise ValueError('weight must be positive, got %r' % (weight, ))
+        self.weight = weight
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst
+
+
+class _Tenant(object):
+
+    def __init__(self, key, quota, now):
+        self.key = key
+        self.quota = quota
+        self.waiters = collections.deque()
+        self.deficit = 0.0
+        self.running = 0
+        self.served = 0
+        self.tokens = quota.burst
+        self.refilled = now
+
+    def refill(self, now):
+        if self.quota.rate is not None:
+            self.tokens = min(self.quota.burst, self.tokens
+                              + (now - self.refilled) * self.quota.rate)
+        self.refilled = now
+
+    def eligible(self, cost):
+        if (self.quota.max_concurrent is not None
+                and self.running >= self.quota.max_concurrent):
+            return False
+        if (self.quota.rate is not None
+                and self.tokens < min(cost, self.quota.burst)):
+            return False
+        return True
+
+    def tokensDueIn(self, cost):
+        """Seconds until the rate quota allows work of a given cost."""
+        if self.quota.rate is None:
+            return 0
+        needed = min(cost, self.quota.burst) - self.tokens
+        return max(0, needed / self.quota.rate)
+
+
+class _Waiter(object):
+
+    def __init__(self, cost):
+        self.cost = cost
+        self.granted = False
+
+
+class FairScheduler(object):
+    """Shares ``capacity`` slots between tenants with deficit round-robin.
+
+    Thread-safe.  Every tenant gets ``quantum * weight`` of credit per
+    round, so over time tenants that always have work waiting get slots
+    in proportion to their weights, however much work each one queues.
+    """
+
+    def __init__(self, capacity=4, quantum=1.0, default_quota=None):
+        self.capacity = capacity
+        self.quantum = quantum
+        self.default_quota = default_quota or Quota()
+        self.quotas = {}
+        self._tenants = {}
+        self._active = collections.deque()  # tenants with waiters
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+    _clock = staticmethod(time.time)
+
+    def setQuota(self, site_name, user_name=None, quota=None):
+        """Set the quota of a tenant.
+
+        Leave out ``user_name`` to set the quota of all users of a site.
+        """
+        with self._cond:
+            self.quotas[site_name, user_name] = quota
+            for tenant in self._tenants.values():
+                tenant.quota = self.getQuota(*tenant.key)
+            self._dispatch()
+
+    def getQuota(self, site_name, user_name):
+        quota = self.quotas.get((site_name, user_name))
+        if quota is None:
+            quota = self.quotas.get((site_name, None))
+        if quota is None:
+            quota = self.default_quota
+        return quota
+
+    def _getTenant(self, key):
+        tenant = self._tenants.get(key)
+        if tenant is None:
+            tenant = self._tenants[key] = _Tenant(key, self.getQuota(*key),
+                                                  self._clock())
+        return tenant
+
+    def _credit(self):
+        """Give the tenant whose turn it is its quantum of credit."""
+        if self._active:
+            tenant = self._active[0]
+            if tenant.eligible(tenant.waiters[0].cost):
+                tenant.deficit += self.quantum * tenant.quota.weight
+
+    def _dispatch(self):
+        """Hand out free slots to waiters (call with the lock held)."""
+        now = self._clock()
+        while self._in_use < self.capacity and self._active:
+            for tenant in self._active:
+                tenant.refill(now)
+            if not any(tenant.eligible(tenant.waiters[0].cost)
+                       for tenant in self._active):
+                return
+            while True:
+                tenant = self._active[0]
+                waiter = tenant.waiters[0]
+                if (tenant.eligible(waiter.cost)
+                        and tenant.deficit >= waiter.cost):
+                    break
+                self._active.rotate(-1)
+                self._credit()
+            tenant.waiters.popleft()
+            tenant.deficit -= waiter.cost
+            if tenant.quota.rate is not None:
+                tenant.tokens -= waiter.cost
+            tenant.running += 1
+            tenant.served += 1
+            self._in_use += 1
+            waiter.granted = True
+            self._cond.notify_all()
+            if not tenant.waiters:
+                # idle tenants don't save up credit
+                tenant.deficit = 0.0
+                self._active.popleft()
+                self._credit()
+
+    def _nextRefill(self):
+        delays = [tenant.tokensDueIn(tenant.waiters[0].cost)
+                  for tenant in self._active]
+        delays = [delay for delay in delays if delay > 0]
+        return min(delays) if delays else None
+
+    def acquire(self, site_name, user_name, cost=1.0, timeout=None):
+        """Wait for a slot.  Returns False if ``timeout`` expired."""
+        key = (site_name, user_name)
+        waiter = _Waiter(cost)
+        deadline = None if timeout is None else self._clock() + timeout
+        with self._cond:
+            tenant = self._getTenant(key)
+            tenant.waiters.append(waiter)
+            if len(tenant.waiters) == 1:
+                self._active.append(tenant)
+                if len(self._active) == 1:
+                    self._credit()
+            self._dispatch()
+            while not waiter.granted:
+                wait = self._nextRefill()
+                if deadline is not None:
+                    remaining = deadline - self._clock()
+                    if remaining <= 0:
+                        tenant.waiters.remove(waiter)
+                        if not tenant.waiters:
+                            tenant.deficit = 0.0
+                            head = self._active[0]
+                            self._active.remove(tenant)
+                            if head is tenant:
+                                self._credit()
+                        return False
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(wait)
+                self._dispatch()
+        return True
+
+    def release(self, site_name, user_name):
+        """Give back a slot."""
+        with self._cond:
+            self._tenants[site_name, user_name].running -= 1
+            self._in_use -= 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, site_name, user_name, cost=1.0):
+        """Hold a slot while executing a block of code."""
+        self.acquire(site_name, user_name, cost)
+        try:
+            yield
+        finally:
+            self.release(site_name, user_name)
+
+    def stats(self):
+        """Return a dict mapping tenants to (running, waiting, served)."""
+        with self._cond:
+            return dict((key, (tenant.running, len(tenant.waiters),
+                               tenant.served))
+                        for key, tenant in self._tenants.items())
+
+
+class FairShareWorkerThread(BackgroundWorkerThread):
+    """A background thread that takes turns with other tenants.
+
+    Set ``scheduler`` to a FairScheduler shared by the worker threads of
+    all sites.  Every iteration of the main loop (including the connection
+    it opens) waits for a slot in it.  Override getWorkCost() if some
+    iterations are more expensive than others.
+    """
+
+    scheduler = None
+
+    def getWorkCost(self):
+        """Return the cost of the next iteration (after scheduleNextWork)."""
+        return 1.0
+
+    def workSlot(self):
+        if self.scheduler is None:
+            return super(FairShareWorkerThread, self).workSlot()
+        return self.scheduler.slot(self.site_name, self.user_name,
+                                   self.getWorkCost())
@@ -0,0 +1,129 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Background workers that read from a fixed database snapshot."""
+
+import threading
+
+from .contextmanagers import ZopeInteraction, ZodbConnection, ZopeSite
+from .phased import TwoPhaseWorkerThread
+
+
+class SnapshotWorkerThread(TwoPhaseWorkerThread):
+    """A background thread for long-running reports.
+
+    The data is read from historical (read-only) connections that all see
+    the database as of the same transaction, so the report is consistent
+    no matter what gets committed while it runs.  The result is then
+    stored in a tiny separate transaction, which is unlikely to conflict.
+
+    Subclasses ought to override the following methods:
+
+      - getChunks -- split the scan into chunks, e.g. key ranges;
+        return a list of plain (non-persistent) objects
+
+      - scanChunk -- scan one chunk and return plain data
+
+      - compute -- combine the list of scanChunk() results (in chunk
+        order) into the result
+
+      - applyResult -- store the result (see TwoPhaseWorkerThread)
+
+    ``snapshot_at`` can be set to a datetime or a transaction id; by
+    default every job reads the last committed transaction as of the time
+    it starts.  With ``scan_threads`` > 1 the chunks are scanned in
+    parallel, each thread using its own snapshot connection.
+    """
+
+    snapshot_at = None
+    scan_threads = 1
+
+    snapshot = None  # the snapshot used by the current job
+
+    def getSnapshotTime(self):
+        """Return the point in time the next job should see."""
+        if self.snapshot_at is not None:
+            return self.snapshot_at
+        return self.site_db.lastTransaction()
+
+    def runInSnapshot(self, fn, *args):
+        """Call fn(*args) with a historical connection and a site."""
+        with ZopeInteraction():
+            with ZodbConnection(self.site_db, at=self.snapshot) as conn:
+                with ZopeSite(self.getSite(conn)):
+                    return fn(*args)
+
+    def runReadPhase(self):
+        self.snapshot = self.getSnapshotTime()
+        chunks = list(self.runInSnapshot(self.getChunks))
+        if self.scan_threads <= 1 or len(chunks) <= 1:
+            return self.runInSnapshot(self.scanChunks, chunks)
+        return self.scanInParallel(chunks)
+
+    def scanChunks(self, chunks):
+        return [self.scanChunk(chunk) for chunk in chunks]
+
+    def scanInParallel(self, chunks):
+        results = [None] * len(chunks)
+        pending = list(enumerate(chunks))
+        errors = []
+        lock = threading.Lock()
+
+        def scan():
+            while True:
+                with lock:
+                    if not pending or errors:
+                        return
+                    idx, chunk = pending.pop(0)
+                results[idx] = self.scanChunk(chunk)
+
+        def scanner():
+            try:
+                self.runInSnapshot(scan)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=scanner,
+                                    name='%s scanner %d' % (self.name, n))
+                   for n in range(min(self.scan_threads, len(chunks)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def getChunks(self):
+        """Split the scan into chunks.
+
+        Called with a local site set and a snapshot connection.  The default
+        implementation returns a single chunk, None.
+        """
+        return [None]
+
+    def scanChunk(self, chunk):
+        """Scan one chunk and return plain (non-persistent) data.
+
+        Called with a local site set and a snapshot connection, possibly
+        from several threads at once.
+        """
+
+    def compute(self, data):
+        """Combine the list of scanChunk() results.
+
+        Called with no ZODB connection, site or interaction.  Returns the
+        data unchanged by default.
+        """
+        return data
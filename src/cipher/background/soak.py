@@ -0,0 +1,369 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Soak test harness for background workers.
+
+Runs many BackgroundWorkerThreads against an in-memory or FileStorage
+database while injecting faults into the storage and into the workers,
+and reports throughput, latency, lost and duplicated jobs, and connection
+leaks.
+
+Usage::
+
+    python -m cipher.background.soak --workers 8 --jobs 10000 \\
+        --conflict-rate 0.05 --slow-commit-rate 0.01
+
+"""
+from __future__ import print_function
+
+import logging
+import optparse
+import random
+import threading
+import time
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    # Python 2 BBB
+    from Queue import Queue, Empty
+
+import transaction
+from BTrees.IIBTree import IIBTree
+from persistent import Persistent
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.MappingStorage import MappingStorage
+from ZODB.POSException import ConflictError, StorageError
+from zope.component import hooks
+
+from .thread import BackgroundWorkerThread
+
+
+class Faults(object):
+    """Fault injection settings; all rates are probabilities (0..1)."""
+
+    def __init__(self, conflict_rate=0.0, load_error_rate=0.0,
+                 commit_error_rate=0.0, slow_commit_rate=0.0,
+                 slow_commit_delay=0.05, cleanup_error_rate=0.0, seed=None):
+        self.conflict_rate = conflict_rate
+        self.load_error_rate = load_error_rate
+        self.commit_error_rate = commit_error_rate
+        self.slow_commit_rate = slow_commit_rate
+        self.slow_commit_delay = slow_commit_delay
+        self.cleanup_error_rate = cleanup_error_rate
+        self.random = random.Random(seed)
+        self.injected = {}
+        self._lock = threading.Lock()
+
+    def happens(self, kind):
+        """Decide whether to inject a fault of a kind now."""
+        rate = getattr(self, '%s_rate' % kind)
+        if not rate:
+            return False
+        with self._lock:
+            if self.random.random() >= rate:
+                return False
+            self.injected[kind] = self.injected.get(kind, 0) + 1
+            return True
+
+
+class FaultInjectingStorage(object):
+    """Storage wrapper that injects faults into loads and commits."""
+
+    def __init__(self, storage, faults):
+        self._storage = storage
+        self._faults = faults
+        self.enabled = False
+
+    def __getattr__(self, name):
+        return getattr(self._storage, name)
+
+    def __len__(self):
+        return len(self._storage)
+
+    def loadBefore(self, oid, tid):
+        if self.enabled and self._faults.happens('load_error'):
+            raise StorageError('injected load error')
+        return self._storage.loadBefore(oid, tid)
+
+    def store(self, oid, serial, data, version, transaction):
+        if self.enabled and self._faults.happens('conflict'):
+            raise ConflictError(oid=oid, message='injected conflict')
+        return self._storage.store(oid, serial, data, version, transaction)
+
+    def tpc_vote(self, transaction):
+        if self.enabled and self._faults.happens('slow_commit'):
+            time.sleep(self._faults.slow_commit_delay)
+        if self.enabled and self._faults.happens('commit_error'):
+            raise StorageError('injected commit error')
+        return self._storage.tpc_vote(transaction)
+
+
+class CountingDB(object):
+    """DB wrapper that counts opened and closed connections."""
+
+    def __init__(self, db):
+        self._db = db
+        self.opened = self.closed = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def open(self, *args, **kw):
+        conn = self._db.open(*args, **kw)
+        with self._lock:
+            self.opened += 1
+        conn.onCloseCallback(self._closed)
+        return conn
+
+    def _closed(self):
+        with self._lock:
+            self.closed += 1
+
+
+class SoakSite(Persistent):
+    """The site the soak workers work in."""
+
+    __name__ = 'soak'
+
+    def __init__(self):
+        self.done = IIBTree()  # job id -> number of commits
+
+    def getSiteManager(self):
+        return None
+
+
+class SoakWorker(BackgroundWorkerThread):
+    """A worker that records every job it commits in the site."""
+
+    def __init__(self, harness, *args, **kw):
+        self.harness = harness
+        self.job = None
+        self.job_committed = False
+        super(SoakWorker, self).__init__(*args, **kw)
+
+    def scheduleNextWork(self):
+        while not self.harness.finished():
+            try:
+                self.job = self.harness.queue.get(timeout=0.05)
+            except Empty:
+                continue
+            return True
+        return False
+
+    def runIteration(self):
+        # Faults can strike anywhere in the iteration (e.g. a load error
+        # while getting the site), not only in the work transaction
+        self.job_committed = False
+        try:
+            super(SoakWorker, self).runIteration()
+        finally:
+            if self.job_committed:
+                self.harness.committed(self.job)
+            else:
+                self.harness.failed(self.job)
+
+    def doWorkInTransaction(self):
+        super(SoakWorker, self).doWorkInTransaction()
+        self.job_committed = True
+
+    def doWork(self):
+        done = hooks.getSite().done
+        done[self.job] = done.get(self.job, 0) + 1
+
+    def doCleanup(self):
+        if self.harness.faults.happens('cleanup_error'):
+            raise Exception('injected cleanup error')
+
+
+class SoakResult(object):
+    """Results of a soak run."""
+
+    def __init__(self, jobs, elapsed, latencies, retries, given_up, lost,
+                 duplicated, opened, closed, injected):
+        self.jobs = jobs
+        self.elapsed = elapsed
+        self.latencies = sorted(latencies)
+        self.retries = retries
+        self.given_up = given_up
+        self.lost = lost
+        self.duplicated = duplicated
+        self.opened = opened
+        self.closed = closed
+        self.injected = injected
+
+    @property
+    def throughput(self):
+        return len(self.latencies) / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def leaked(self):
+        return self.opened - self.closed
+
+    def percentile(self, p):
+        if not self.latencies:
+            return None
+        idx = min(len(self.latencies) - 1,
+                  int(round(p / 100.0 * (len(self.latencies) - 1))))
+        return self.latencies[idx]
+
+    def report(self):
+        lines = [
+            'jobs:           %d' % self.jobs,
+            'committed:      %d' % len(self.latencies),
+            'retries:        %d' % self.retries,
+            'given up:       %d' % self.given_up,
+            'lost:           %d' % self.lost,
+            'duplicated:     %d' % self.duplicated,
+            'throughput:     %.1f jobs/s' % self.throughput,
+        ]
+        for p in (50, 95, 99):
+            latency = self.percentile(p)
+            if latency is not None:
+                lines.append('latency p%d:    %.1f ms' % (p, latency * 1000))
+        lines.append('connections:    %d opened, %d closed, %d leaked'
+                     % (self.opened, self.closed, self.leaked))
+        for kind, count in sorted(self.injected.items()):
+            lines.append('injected:       %d %s' % (count, kind))
+        return '\n'.join(lines)
+
+
+class SoakHarness(object):
+    """Drives ``jobs`` jobs through ``workers`` SoakWorkers.
+
+    Failed jobs are put back into the queue, up to ``max_attempts`` times.
+    The workers stop after ``timeout`` seconds even if some jobs are not
+    done yet; those are reported as lost.
+    """
+
+    worker_class = SoakWorker
+
+    def __init__(self, storage=None, workers=4, jobs=1000, faults=None,
+                 max_attempts=10, timeout=300.0):
+        self.faults = faults if faults is not None else Faults()
+        self.storage = FaultInjectingStorage(
+            storage if storage is not None else MappingStorage(), self.faults)
+        self.workers = workers
+        self.jobs = jobs
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.queue = Queue()
+        self._lock = threading.Lock()
+        self._enqueued = {}
+        self._attempts = {}
+        self._latencies = []
+        self._retries = 0
+        self._given_up = 0
+        self._outstanding = jobs
+        self._deadline = None
+
+    def finished(self):
+        if self._deadline is not None and time.time() >= self._deadline:
+            return True
+        return self._outstanding <= 0
+
+    def committed(self, job):
+        with self._lock:
+            self._latencies.append(time.time() - self._enqueued[job])
+            self._outstanding -= 1
+
+    def failed(self, job):
+        with self._lock:
+            self._attempts[job] = self._attempts.get(job, 0) + 1
+            if self._attempts[job] >= self.max_attempts:
+                self._given_up += 1
+                self._outstanding -= 1
+                return
+            self._retries += 1
+        self.queue.put(job)
+
+    def run(self):
+        """Run the soak test and return a SoakResult."""
+        db = CountingDB(DB(self.storage))
+        try:
+            conn = db.open()
+            site = conn.root()['site'] = SoakSite()
+            transaction.commit()
+            site_oid = site._p_oid
+            conn.close()
+            threads = [self.worker_class(self, db, site_oid, 'soak', 'soak')
+                       for n in range(self.workers)]
+            self.storage.enabled = True
+            start = time.time()
+            if self.timeout is not None:
+                self._deadline = start + self.timeout
+            for thread in threads:
+                thread.start()
+            for job in range(self.jobs):
+                self._enqueued[job] = time.time()
+                self.queue.put(job)
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+            self.storage.enabled = False
+            conn = db.open()
+            done = conn.root()['site'].done
+            committed = dict(done.items())
+            conn.close()
+        finally:
+            db.close()
+        lost = len([job for job in range(self.jobs)
+                    if job not in committed]) - self._given_up
+        duplicated = len([job for job, count in committed.items()
+                          if count > 1])
+        return SoakResult(self.jobs, elapsed, self._latencies, self._retries,
+                          self._given_up, lost, duplicated, db.opened,
+                          db.closed, dict(self.faults.injected))
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        description='Soak test background workers with injected faults.')
+    parser.add_option('--workers', type='int', default=4)
+    parser.add_option('--jobs', type='int', default=1000)
+    parser.add_option('--filestorage', metavar='PATH',
+                      help='use a FileStorage instead of a MappingStorage')
+    parser.add_option('--conflict-rate', type='float', default=0.0)
+    parser.add_option('--load-error-rate', type='float', default=0.0)
+    parser.add_option('--commit-error-rate', type='float', default=0.0)
+    parser.add_option('--slow-commit-rate', type='float', default=0.0)
+    parser.add_option('--slow-commit-delay', type='float', default=0.05)
+    parser.add_option('--cleanup-error-rate', type='float', default=0.0)
+    parser.add_option('--max-attempts', type='int', default=10)
+    parser.add_option('--timeout', type='float', default=300.0,
+                      help='give up on unfinished jobs after this many'
+                           ' seconds')
+    parser.add_option('--seed', type='int')
+    parser.add_option('-v', '--verbose', action='store_true',
+                      help='log the exceptions caused by injected faults')
+    opts, args = parser.parse_args(args)
+    logging.basicConfig(
+        level=logging.WARNING if opts.verbose else logging.CRITICAL)
+    faults = Faults(conflict_rate=opts.conflict_rate,
+                    load_error_rate=opts.load_error_rate,
+                    commit_error_rate=opts.commit_error_rate,
+                    slow_commit_rate=opts.slow_commit_rate,
+                    slow_commit_delay=opts.slow_commit_delay,
+                    cleanup_error_rate=opts.cleanup_error_rate,
+                    seed=opts.seed)
+    storage = FileStorage(opts.filestorage) if opts.filestorage else None
+    harness = SoakHarness(storage, workers=opts.workers, jobs=opts.jobs,
+                          faults=faults, max_attempts=opts.max_attempts,
+                          timeout=opts.timeout)
+    print(harness.run().report())
+
+
+if __name__ == '__main__':
+    main()
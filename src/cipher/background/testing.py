@@ -12,8 +12,14 @@
 #
 ##############################################################################
 """Test Support"""
+from __future__ import print_function
 import logging
 
+import transaction
+from persistent import Persistent
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+
 try:
     # Python 2 BBB
     from cStringIO import StringIO
@@ -21,6 +27,9 @@ except ImportError:
     from io import StringIO
 
 
+log = logging.getLogger(__name__)
+
+
 def setUpLogging(logger, level=logging.DEBUG):
     buf = StringIO()
     handler = logging.StreamHandler(buf)
@@ -41,3 +50,181 @@ def tearDownLogging(logger):
             logger.setLevel(handler._old_level_)
             break
 
+
+class FakeClock(object):
+    """A clock for the ``_clock`` hooks that only moves when told.
+
+    Set ``now`` to move it.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class SiteStub(object):
+    __name__ = 'testsite'
+    def __init__(self, name=''):
+        self._p_jar = ConnectionStub(DbStub())
+        self._p_oid = 42
+        self._p_jar._db._objects[self._p_oid] = self
+        self._name = name
+        self.patients = {}
+    def getSiteManager(self):
+        return None
+    def __repr__(self):
+        return 'SiteStub(%s)' % repr(self._name)
+
+class ConnectionStub(object):
+    def __init__(self, db, verbose=False):
+        self._db = db
+        self._db.opened += 1
+        self._verbose = verbose
+        if self._verbose:
+            print('Connection opened')
+    def db(self):
+        return self._db
+    def get(self, oid):
+        return self._db._objects[oid]
+    def close(self):
+        self._db.closed += 1
+        if self._verbose:
+            print('Connection closed')
+    def prefetch(self, oids):
+        log.info('prefetching %s', oids)
+    def __repr__(self):
+        return '<ConnectionStub>'
+
+class DbStub(object):
+    opened = closed = 0
+    def __init__(self, verbose=False):
+        self._verbose = verbose
+        self._objects = {}
+    def open(self, at=None, before=None, transaction_manager=None):
+        if self._verbose and (at or before):
+            print('Historical connection at=%s before=%s' % (at, before))
+        if self._verbose and transaction_manager is not None:
+            print('Connection with a private transaction manager')
+        return ConnectionStub(self, verbose=self._verbose)
+
+
+class DataManagerStub(object):
+    def __init__(self):
+        self.log = []
+    def abort(self, t):
+        print('aborted')
+        self.log.append('aborted')
+    def tpc_begin(self, t):
+        pass
+    def commit(self, t):
+        print('committed')
+        self.log.append('committed')
+    def tpc_vote(self, t):
+        pass
+    def tpc_finish(self, t):
+        pass
+
+
+class Site(Persistent):
+    __name__ = 'testsite'
+    def getSiteManager(self):
+        return None
+
+
+def createDatabase(storage=None, **attrs):
+    """Create a database with a Site, with ``attrs`` set, in the root.
+
+    Returns the database and an open connection.
+    """
+    if storage is None:
+        storage = MappingStorage()
+    db = DB(storage)
+    conn = db.open()
+    site = conn.root()['site'] = Site()
+    for name, value in attrs.items():
+        setattr(site, name, value)
+    transaction.commit()
+    return db, conn
+
+
+def createDatabases(n=2):
+    """Create ``n`` databases sharing a storage with a Site in the root.
+
+    Like ZEO clients on ``n`` different nodes (see SharedStorage).
+    """
+    storage = SharedStorage(MappingStorage())
+    dbs = [DB(storage) for i in range(n)]
+    conn = dbs[0].open()
+    conn.root()['site'] = Site()
+    transaction.commit()
+    conn.close()
+    return dbs
+
+
+class TransportStub(object):
+    """Outbox transport that collects the messages it is asked to send.
+
+    Fails the first ``failures`` attempts to help test retries.
+    """
+
+    def __init__(self, failures=0):
+        self.batches = []
+        self.failures = failures
+
+    def send(self, messages):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('transport failure')
+        self.batches.append(list(messages))
+
+    @property
+    def messages(self):
+        return [message for batch in self.batches for message in batch]
+
+
+class SharedStorage(object):
+    """Storage wrapper that lets several DB instances share one storage.
+
+    Like ZEO clients on different nodes, every DB gets invalidations for
+    the transactions committed through the others.
+
+    Example::
+
+        storage = SharedStorage(MappingStorage())
+        node1, node2 = DB(storage), DB(storage)
+
+    """
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._dbs = []
+        self._oids = []
+
+    def __getattr__(self, name):
+        return getattr(self._storage, name)
+
+    def __len__(self):
+        return len(self._storage)
+
+    def registerDB(self, db):
+        self._dbs.append(db)
+
+    def tpc_begin(self, transaction, *args):
+        self._storage.tpc_begin(transaction, *args)
+        self._oids = []
+
+    def store(self, oid, serial, data, version, transaction):
+        self._oids.append(oid)
+        return self._storage.store(oid, serial, data, version, transaction)
+
+    def tpc_finish(self, transaction, func=lambda tid: None):
+        oids = self._oids
+
+        def invalidate(tid):
+            func(tid)
+            for db in self._dbs:
+                db.invalidate(tid, oids)
+
+        return self._storage.tpc_finish(transaction, invalidate)
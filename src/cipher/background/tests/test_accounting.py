@@ -0,0 +1,230 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+
+import transaction
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+from zope.component.hooks import getSite, setSite
+from zope.security.management import endInteraction
+
+from cipher.background import accounting as accounting_module
+from cipher.background import testing
+from cipher.background.accounting import (ResourceAccounting, RollupThread,
+                                          Usage)
+from cipher.background.testing import FakeClock, Site
+from cipher.background.thread import BackgroundWorkerThread
+
+
+def doctest_Usage():
+    """Test for Usage
+
+        >>> usage = Usage(iterations=1, cpu_time=0.5, commits=1)
+        >>> usage.add(Usage(iterations=2, stores=3, bytes_written=100))
+        <Usage iterations=3 cpu_time=0.5 wall_time=0 loads=0 stores=3
+               bytes_written=100 commits=1>
+        >>> print(usage)
+        3 iterations, 0.500s CPU, 0.000s wall, 0 loads, 3 stores,
+        100 bytes written, 1 commits
+
+        >>> Usage(cpu=1)
+        Traceback (most recent call last):
+          ...
+        TypeError: unexpected keyword arguments: cpu
+
+    """
+
+
+def doctest_ResourceAccounting_measure_without_thread_time():
+    """Test for ResourceAccounting.measure
+
+    Some platforms can't tell us how much CPU time a thread used
+
+        >>> accounting_module.thread_time = None
+        >>> accounting = ResourceAccounting(clock=FakeClock())
+        >>> with accounting.measure('site', 'user'):
+        ...     pass
+
+    so we report it as unknown rather than zero
+
+        >>> usage = accounting.usage()
+        >>> print(usage.cpu_time)
+        None
+        >>> print(usage)
+        1 iterations, unknown CPU, 0.000s wall, 0 loads, 0 stores,
+        0 bytes written, 0 commits
+
+        >>> accounting.record('other', 'user', Usage(cpu_time=1.5))
+        >>> [key for key, usage in accounting.top(2)]
+        [('other', 'user'), ('site', 'user')]
+
+    """
+
+
+def doctest_ResourceAccounting():
+    """Test for ResourceAccounting
+
+        >>> clock = FakeClock()
+        >>> accounting = ResourceAccounting(clock=clock)
+        >>> accounting.record('site1', 'alice', Usage(iterations=1, commits=1))
+        >>> accounting.record('site1', 'bob', Usage(iterations=2, commits=2))
+        >>> accounting.record('site2', 'alice', Usage(iterations=4))
+
+    You can query usage per site and/or user
+
+        >>> accounting.usage().iterations
+        7
+        >>> accounting.usage('site1').commits
+        3
+        >>> accounting.usage(user_name='alice').iterations
+        5
+        >>> accounting.usage('site2', 'bob').iterations
+        0
+
+        >>> sorted((k, v.iterations) for k, v in accounting.bySite().items())
+        [('site1', 3), ('site2', 4)]
+        >>> sorted((k, v.iterations) for k, v in accounting.byUser().items())
+        [('alice', 5), ('bob', 2)]
+        >>> [key for key, usage in accounting.top(2, 'iterations')]
+        [('site2', 'alice'), ('site1', 'bob')]
+
+    Rolling up returns everything and starts over
+
+        >>> clock.now = 60.0
+        >>> since, until, usage = accounting.rollup()
+        >>> since, until, sorted(usage)
+        (0.0, 60.0, [('site1', 'alice'), ('site1', 'bob'), ('site2', 'alice')])
+        >>> accounting.usage().iterations
+        0
+
+    """
+
+
+def doctest_ResourceAccounting_measure():
+    """Test for ResourceAccounting.measure
+
+        >>> db = DB(MappingStorage())
+        >>> conn = db.open()
+        >>> accounting = ResourceAccounting()
+
+        >>> with accounting.measure('site', 'user', conn):
+        ...     conn.root()['data'] = Site()
+        ...     transaction.commit()
+
+        >>> usage = accounting.usage()
+        >>> usage.iterations, usage.stores, usage.commits
+        (1, 2, 1)
+        >>> usage.bytes_written > 0
+        True
+        >>> usage.wall_time >= 0, usage.cpu_time >= 0
+        (True, True)
+
+        >>> with accounting.measure('site', 'user', conn):
+        ...     conn.cacheMinimize()
+        ...     print(conn.root()['data'])
+        <cipher.background.testing.Site object at ...>
+
+        >>> usage = accounting.usage()
+        >>> usage.iterations, usage.loads >= 1, usage.stores, usage.commits
+        (2, True, 2, 1)
+
+        >>> conn.close()
+        >>> db.close()
+
+    """
+
+
+class WorkerForTest(BackgroundWorkerThread):
+
+    accounting = ResourceAccounting()
+
+    iterations = 2
+
+    def scheduleNextWork(self):
+        self.iterations -= 1
+        return self.iterations >= 0
+
+    def doWork(self):
+        getSite().counter = getattr(getSite(), 'counter', 0) + 1
+
+
+def doctest_BackgroundWorkerThread_accounting():
+    """Test for BackgroundWorkerThread.measureUsage
+
+        >>> db = DB(MappingStorage())
+        >>> conn = db.open()
+        >>> site = conn.root()['site'] = Site()
+        >>> site.__name__ = 'mysite'
+        >>> transaction.commit()
+
+        >>> thread = WorkerForTest.forSite(site, 'someuser')
+        >>> thread.run()
+
+        >>> usage = thread.accounting.usage('mysite', 'someuser')
+        >>> usage.iterations, usage.commits
+        (2, 2)
+
+        >>> conn.close()
+        >>> db.close()
+
+    """
+
+
+def doctest_RollupThread():
+    """Test for RollupThread
+
+        >>> clock = FakeClock()
+        >>> accounting = ResourceAccounting(clock=clock)
+        >>> accounting.record('site1', 'alice', Usage(iterations=1, commits=1))
+        >>> clock.now = 3600
+
+        >>> logbuf = testing.setUpLogging(accounting_module.log)
+        >>> thread = RollupThread(accounting)
+        >>> thread.rollupOnce()
+        >>> print(logbuf.getvalue().strip())
+        Background work for site1 by alice in the last 3600 seconds:
+        1 iterations, 0.000s CPU, 0.000s wall, 0 loads, 0 stores,
+        0 bytes written, 1 commits
+
+    Errors in the callback are logged
+
+        >>> thread = RollupThread(accounting, callback=None)
+        >>> thread.rollupOnce()
+        >>> print(logbuf.getvalue().strip()) # doctest: +ELLIPSIS
+        Background work ...
+        Exception in resource accounting rollup
+        Traceback (most recent call last):
+          ...
+        TypeError: 'NoneType' object is not callable
+
+    """
+
+
+def setUp(test):
+    test.globs['thread_time'] = accounting_module.thread_time
+
+
+def tearDown(test):
+    accounting_module.thread_time = test.globs['thread_time']
+    testing.tearDownLogging(accounting_module.log)
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(
+        setUp=setUp, tearDown=tearDown,
+        optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS)
@@ -0,0 +1,255 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+
+import transaction
+from transaction.interfaces import TransientError
+from zope.component.hooks import getSite, setSite
+from zope.security.management import endInteraction
+
+from cipher.background import testing
+from cipher.background.batching import AdaptiveBatchSize, BatchWorkerThread
+from cipher.background.ratelimit import Budget, WriteRateLimiter
+from cipher.background.testing import FakeClock, SiteStub, createDatabase
+from cipher.background.thread import log
+
+
+class BatchWorkerThreadForTest(BatchWorkerThread):
+
+    target_duration = 1.0
+    initial_batch_size = 4
+
+    def __init__(self, *args, **kw):
+        super(BatchWorkerThreadForTest, self).__init__(*args, **kw)
+        self._clock = FakeClock()
+        self._items = list(range(20))
+        self._durations = []
+
+    def scheduleNextWork(self):
+        return bool(self._items)
+
+    def getNextBatch(self, size):
+        batch, self._items = self._items[:size], self._items[size:]
+        print('batch of %d: %s' % (size, batch))
+        return batch
+
+    def processItem(self, item):
+        self._clock.now += self._durations.pop(0) if self._durations else 0.1
+
+
+class WritingBatchWorker(BatchWorkerThreadForTest):
+
+    def processItem(self, item):
+        super(WritingBatchWorker, self).processItem(item)
+        getSite().title = 'item %d' % item
+
+
+def doctest_AdaptiveBatchSize_success():
+    """Test for AdaptiveBatchSize.success
+
+        >>> batch = AdaptiveBatchSize(target_duration=1.0, initial=10)
+        >>> batch.size
+        10
+
+    Fast transactions make the batch grow additively
+
+        >>> batch.success(0.2)
+        >>> batch.size
+        11
+        >>> batch.success(1.0)
+        >>> batch.size
+        12
+
+    Slow transactions make it shrink multiplicatively
+
+        >>> batch.success(1.5)
+        >>> batch.size
+        6
+        >>> batch.last_duration
+        1.5
+
+    """
+
+
+def doctest_AdaptiveBatchSize_partial_batches():
+    """Test for AdaptiveBatchSize.success
+
+    Batches that had fewer items than requested don't make the size grow
+
+        >>> batch = AdaptiveBatchSize(target_duration=1.0, initial=10)
+        >>> batch.success(0.2, 10)
+        >>> batch.size
+        11
+        >>> batch.success(0.2, 3)
+        >>> batch.success(0.0, 0)
+        >>> batch.size
+        11
+
+    but slow ones still make it shrink
+
+        >>> batch.success(1.5, 3)
+        >>> batch.size
+        5
+
+    """
+
+
+def doctest_AdaptiveBatchSize_conflict():
+    """Test for AdaptiveBatchSize.conflict
+
+        >>> batch = AdaptiveBatchSize(initial=10)
+        >>> batch.conflict()
+        >>> batch.size
+        5
+        >>> batch.conflicts
+        1
+
+    """
+
+
+def doctest_AdaptiveBatchSize_limits():
+    """Test for AdaptiveBatchSize limits
+
+        >>> batch = AdaptiveBatchSize(initial=50, minimum=2, maximum=10)
+        >>> batch.size
+        10
+        >>> batch.success(0)
+        >>> batch.size
+        10
+        >>> for n in range(5):
+        ...     batch.conflict()
+        >>> batch.size
+        2
+
+    """
+
+
+def doctest_BatchWorkerThread():
+    """Test for BatchWorkerThread
+
+        >>> site = SiteStub()
+        >>> thread = BatchWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.batch_size
+        4
+
+    Every item takes 0.1 seconds of our fake clock, so the batches grow
+
+        >>> thread.run()
+        batch of 4: [0, 1, 2, 3]
+        batch of 5: [4, 5, 6, 7, 8]
+        batch of 6: [9, 10, 11, 12, 13, 14]
+        batch of 7: [15, 16, 17, 18, 19]
+
+    The last batch wasn't full, so the size didn't grow any further
+
+        >>> thread.batch_size
+        7
+
+    The batch size is a part of the thread status
+
+        >>> thread.getStatus()['batch_size']
+        7
+
+    """
+
+
+def doctest_BatchWorkerThread_slow_transactions():
+    """Test for BatchWorkerThread
+
+        >>> site = SiteStub()
+        >>> thread = BatchWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread._durations = [0.1, 0.1, 2.0]
+
+    A slow transaction halves the batch size
+
+        >>> thread.run()
+        batch of 4: [0, 1, 2, 3]
+        batch of 2: [4, 5]
+        batch of 3: [6, 7, 8]
+        batch of 4: [9, 10, 11, 12]
+        batch of 5: [13, 14, 15, 16, 17]
+        batch of 6: [18, 19]
+
+    """
+
+
+def doctest_BatchWorkerThread_conflicts():
+    """Test for BatchWorkerThread
+
+        >>> site = SiteStub()
+        >>> thread = BatchWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.name = 'this thread'
+        >>> def processItem(item):
+        ...     raise TransientError('conflict')
+        >>> thread.processItem = processItem
+
+        >>> logbuf = testing.setUpLogging(log)
+        >>> thread._items = [1]
+        >>> thread.run()
+        batch of 4: [1]
+
+        >>> thread.batch_size
+        2
+        >>> thread.batch_controller.conflicts
+        1
+
+    """
+
+
+def doctest_BatchWorkerThread_write_limiter():
+    """Test for BatchWorkerThread with a write limiter
+
+        >>> db, conn = createDatabase()
+        >>> thread = WritingBatchWorker.forSite(conn.root()['site'], 'admin')
+        >>> thread._items = list(range(9))
+        >>> thread.write_limiter = limiter = WriteRateLimiter()
+        >>> limiter._clock = thread._clock
+        >>> def sleep(seconds):
+        ...     print('sleeping %.2f seconds' % seconds)
+        ...     thread._clock.now += seconds
+        >>> limiter._sleep = sleep
+        >>> limiter.setBudget(None, Budget(commit_rate=0.5))
+
+    Waiting for write budget makes the transactions take longer than
+    target_duration, but the batches still grow
+
+        >>> thread.run()
+        batch of 4: [0, 1, 2, 3]
+        batch of 5: [4, 5, 6, 7, 8]
+        sleeping 1.50 seconds
+
+        >>> thread.throttle_time
+        1.5
+        >>> thread.batch_size
+        6
+
+        >>> db.close()
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    testing.tearDownLogging(log)
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown)
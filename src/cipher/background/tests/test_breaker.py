@@ -0,0 +1,300 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+import sys
+
+import transaction
+from transaction.interfaces import TransientError
+from ZODB.MappingStorage import MappingStorage
+from ZODB.POSException import ConflictError
+from zope.component.hooks import setSite
+from zope.security.management import endInteraction
+
+from cipher.background import testing
+from cipher.background.breaker import (CircuitBreaker,
+                                       CircuitBreakerWorkerThread,
+                                       TracebackThrottle)
+from cipher.background.testing import FakeClock, SiteStub, createDatabase
+from cipher.background.thread import log
+
+
+def doctest_CircuitBreaker():
+    """Test for CircuitBreaker
+
+        >>> breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10,
+        ...                          max_reset_timeout=25)
+        >>> breaker._clock = FakeClock()
+        >>> breaker.state, breaker.allow()
+        ('closed', True)
+
+    Successes reset the failure count
+
+        >>> breaker.failure(), breaker.failure()
+        (False, False)
+        >>> breaker.success()
+        >>> breaker.failure(), breaker.failure(), breaker.state
+        (False, False, 'closed')
+
+    Too many consecutive failures open the breaker
+
+        >>> breaker.failure()
+        True
+        >>> breaker.state, breaker.allow(), breaker.retryIn()
+        ('open', False, 10.0)
+
+    After the timeout, one trial is allowed
+
+        >>> breaker._clock.now = 10
+        >>> breaker.allow(), breaker.state
+        (True, 'half-open')
+
+    If it fails, the breaker opens for longer
+
+        >>> breaker.failure()
+        True
+        >>> breaker.state, breaker.retryIn()
+        ('open', 20.0)
+        >>> breaker._clock.now = 30
+        >>> breaker.allow()
+        True
+        >>> breaker.failure()
+        True
+        >>> breaker.retryIn()
+        25
+
+    If it succeeds, the breaker closes
+
+        >>> breaker._clock.now = 55
+        >>> breaker.allow()
+        True
+        >>> breaker.success()
+        >>> breaker.state, breaker.failures, breaker.timeout
+        ('closed', 0, 10)
+
+    """
+
+
+def raiseError(message, exc_class=ValueError):
+    try:
+        raise exc_class(message)
+    except Exception:
+        return sys.exc_info()
+
+
+def doctest_TracebackThrottle():
+    """Test for TracebackThrottle
+
+        >>> throttle = TracebackThrottle(interval=60)
+        >>> throttle._clock = FakeClock()
+
+        >>> throttle.check(raiseError('oops'))
+        0
+        >>> throttle.check(raiseError('oops'))
+        >>> throttle.check(raiseError('oops'))
+
+    Different errors are not throttled together
+
+        >>> throttle.check(raiseError('other oops'))
+        0
+        >>> throttle.check(raiseError('oops', KeyError))
+        0
+
+    Once the interval passes, we get to know how many weren't logged
+
+        >>> throttle._clock.now = 60
+        >>> throttle.check(raiseError('oops'))
+        2
+        >>> throttle.check(raiseError('oops'))
+
+    """
+
+
+class WorkerForTest(CircuitBreakerWorkerThread):
+
+    failure_threshold = 2
+    reset_timeout = 10.0
+    repeat_log_interval = 1000
+
+    def __init__(self, *args, **kw):
+        super(WorkerForTest, self).__init__(*args, **kw)
+        self.breaker._clock = self.throttle._clock = clock = FakeClock()
+        self.results = []
+
+        def sleep(seconds):
+            print('sleeping for %g seconds' % seconds)
+            clock.now += seconds
+        self._wakeup.wait = sleep
+
+    def scheduleNextWork(self):
+        return bool(self.results) and not self.stopped
+
+    def doWork(self):
+        result = self.results.pop(0)
+        print(result)
+        if result == 'fail':
+            raise RuntimeError('storage is down')
+        if result == 'conflict':
+            raise ConflictError('conflict')
+
+
+class Disconnected(TransientError):
+    """Like ZEO's ClientDisconnected."""
+
+
+class FlakyStorage(object):
+    """Storage wrapper that fails all reads and writes while ``down``."""
+
+    down = False
+
+    def __init__(self, storage):
+        self._storage = storage
+
+    def __getattr__(self, name):
+        return getattr(self._storage, name)
+
+    def __len__(self):
+        return len(self._storage)
+
+    def _check(self):
+        if self.down:
+            raise Disconnected('storage is down')
+
+    def load(self, oid, version=''):
+        self._check()
+        return self._storage.load(oid, version)
+
+    def loadBefore(self, oid, tid):
+        self._check()
+        return self._storage.loadBefore(oid, tid)
+
+    def tpc_begin(self, transaction, *args):
+        self._check()
+        return self._storage.tpc_begin(transaction, *args)
+
+
+def doctest_CircuitBreakerWorkerThread():
+    """Test for CircuitBreakerWorkerThread
+
+        >>> thread = WorkerForTest.forSite(SiteStub(), 'someuser')
+        >>> thread.name = 'worker'
+        >>> logbuf = testing.setUpLogging(log)
+
+        >>> thread.results = ['fail', 'conflict', 'fail', 'fail', 'fail',
+        ...                   'ok', 'fail']
+        >>> thread.run()
+        fail
+        conflict
+        fail
+        sleeping for 10 seconds
+        fail
+        sleeping for 20 seconds
+        fail
+        sleeping for 40 seconds
+        ok
+        fail
+
+    Identical tracebacks are logged only once
+
+        >>> print(logbuf.getvalue()) # doctest: +ELLIPSIS
+        Exception in worker
+        Traceback (most recent call last):
+          ...
+        RuntimeError: storage is down
+        Exception in worker
+        Traceback (most recent call last):
+          ...
+        ZODB.POSException.ConflictError: conflict
+        Circuit breaker opened in worker after 2 failures, pausing for 10 seconds
+        Circuit breaker opened in worker after 3 failures, pausing for 20 seconds
+        Circuit breaker opened in worker after 4 failures, pausing for 40 seconds
+        Circuit breaker closed in worker
+        <BLANKLINE>
+
+    """
+
+
+def doctest_CircuitBreakerWorkerThread_stop():
+    """Test for CircuitBreakerWorkerThread.stop
+
+        >>> thread = WorkerForTest.forSite(SiteStub(), 'someuser')
+        >>> thread.breaker.failure_threshold = 1
+        >>> thread.results = ['fail', 'ok']
+        >>> thread._wakeup.wait = lambda timeout: thread.stop()
+        >>> logbuf = testing.setUpLogging(log)
+        >>> thread.run()
+        fail
+        >>> thread.results
+        ['ok']
+
+    """
+
+
+def doctest_CircuitBreakerWorkerThread_storage_down():
+    """Test for CircuitBreakerWorkerThread
+
+        >>> storage = FlakyStorage(MappingStorage())
+        >>> db, conn = createDatabase(storage)
+        >>> thread = WorkerForTest.forSite(conn.root()['site'], 'someuser')
+        >>> thread.name = 'worker'
+        >>> conn.close()
+        >>> logbuf = testing.setUpLogging(log)
+
+    Failures outside doWork() count too, e.g. when the site can't be
+    loaded because the storage is down.  Transient errors other than
+    conflicts are failures
+
+        >>> def sleep(seconds):
+        ...     print('sleeping for %g seconds' % seconds)
+        ...     thread.breaker._clock.now += seconds
+        ...     storage.down = False
+        >>> thread._wakeup.wait = sleep
+
+        >>> storage.down = True
+        >>> db.cacheMinimize()
+        >>> thread.results = ['ok']
+        >>> thread.run()
+        sleeping for 10 seconds
+        ok
+
+        >>> print(logbuf.getvalue()) # doctest: +ELLIPSIS
+        Exception in worker
+        Traceback (most recent call last):
+          ...
+        ...Disconnected: storage is down
+        Circuit breaker opened in worker after 2 failures, pausing for 10 seconds
+        Circuit breaker closed in worker
+        <BLANKLINE>
+
+        >>> thread.failure_count
+        2
+
+        >>> db.close()
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    testing.tearDownLogging(log)
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown)
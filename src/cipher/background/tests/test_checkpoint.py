@@ -0,0 +1,237 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+
+import transaction
+from zope.component.hooks import getSite, setSite
+from zope.security.management import endInteraction
+
+from cipher.background import testing
+from cipher.background.checkpoint import (CheckpointedWorkerThread, Progress,
+                                          getCheckpoint)
+from cipher.background.contextmanagers import ZopeSite, ZopeTransaction
+from cipher.background.testing import FakeClock, createDatabase
+from cipher.background.thread import log
+
+
+class CheckpointedWorkerThreadForTest(CheckpointedWorkerThread):
+
+    checkpoint_name = 'migration'
+    chunk_size = 3
+    progress_interval = 0
+
+    fail_at = None
+    failures = 1
+
+    def __init__(self, *args, **kw):
+        super(CheckpointedWorkerThreadForTest, self).__init__(*args, **kw)
+        self._clock = FakeClock()
+
+    def _sleep(self, seconds):
+        print('sleeping for %g seconds' % seconds)
+        self._clock.now += seconds
+
+    def estimateTotal(self):
+        return len(getSite().items)
+
+    def processChunk(self, cursor, size):
+        self._clock.now += 1
+        items = getSite().items
+        start = 0 if cursor is None else cursor + 1
+        chunk = items[start:start + size]
+        print('processing %s' % chunk)
+        if self.fail_at in chunk and self.failures:
+            self.failures -= 1
+            raise Exception('something happened')
+        getSite().migrated += len(chunk)
+        if start + size >= len(items):
+            return None, len(chunk)
+        return start + size - 1, len(chunk)
+
+
+def doctest_Progress():
+    """Test for Progress
+
+        >>> print(Progress(5, None, None))
+        5 items
+        >>> print(Progress(5, 20, None))
+        5/20 items (25%)
+        >>> print(Progress(5, 20, 0.5))
+        5/20 items (25%), 30 seconds left
+        >>> Progress(5, 20, 0.5).eta
+        30.0
+
+    """
+
+
+def doctest_CheckpointedWorkerThread():
+    """Test for CheckpointedWorkerThread
+
+        >>> db, conn = createDatabase(items=list(range(10)), migrated=0)
+        >>> site = conn.root()['site']
+        >>> thread = CheckpointedWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.name = 'migration'
+        >>> logbuf = testing.setUpLogging(log)
+
+    The job runs in chunks until it's finished
+
+        >>> thread.run()
+        processing [0, 1, 2]
+        processing [3, 4, 5]
+        processing [6, 7, 8]
+        processing [9]
+
+        >>> print(logbuf.getvalue().strip())
+        migration progress: 3/10 items (30%), 2 seconds left
+        migration progress: 6/10 items (60%), 1 seconds left
+        migration progress: 9/10 items (90%), 0 seconds left
+        migration finished: 10/10 items (100%), 0 seconds left
+
+        >>> transaction.abort()
+        >>> site.migrated
+        10
+
+    Finished jobs don't run again
+
+        >>> thread = CheckpointedWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.run()
+        >>> thread.finished
+        True
+
+    unless you restart them
+
+        >>> with ZopeSite(site):
+        ...     with ZopeTransaction():
+        ...         thread.restart()
+        >>> thread.run()
+        processing [0, 1, 2]
+        processing [3, 4, 5]
+        processing [6, 7, 8]
+        processing [9]
+
+        >>> db.close()
+
+    """
+
+
+def doctest_CheckpointedWorkerThread_resumes():
+    """Test for CheckpointedWorkerThread
+
+        >>> db, conn = createDatabase(items=list(range(10)), migrated=0)
+        >>> site = conn.root()['site']
+        >>> thread = CheckpointedWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.name = 'migration'
+        >>> thread.fail_at = 7
+        >>> logbuf = testing.setUpLogging(log)
+
+    When a chunk fails, it's retried
+
+        >>> thread.run()
+        processing [0, 1, 2]
+        processing [3, 4, 5]
+        processing [6, 7, 8]
+        sleeping for 1 seconds
+        processing [6, 7, 8]
+        processing [9]
+
+        >>> transaction.abort()
+        >>> site.migrated
+        10
+
+    A new thread (e.g. after a restart) resumes from the checkpoint
+
+        >>> with ZopeSite(site):
+        ...     with ZopeTransaction():
+        ...         thread.restart()
+        >>> thread = CheckpointedWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.chunk_size = 5
+        >>> thread.scheduleNextWork = lambda: thread.progress is None
+        >>> thread.run()
+        processing [0, 1, 2, 3, 4]
+
+        >>> thread = CheckpointedWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.run()
+        processing [5, 6, 7]
+        processing [8, 9]
+
+        >>> transaction.abort()
+        >>> checkpoint = getCheckpoint(site._p_jar.root(), 'migration')
+        >>> checkpoint.processed, checkpoint.cursor
+        (10, None)
+
+        >>> db.close()
+
+    """
+
+
+def doctest_CheckpointedWorkerThread_backoff():
+    """Test for CheckpointedWorkerThread
+
+        >>> db, conn = createDatabase(items=list(range(10)), migrated=0)
+        >>> site = conn.root()['site']
+        >>> thread = CheckpointedWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.name = 'migration'
+        >>> thread.max_retry_delay = 5
+        >>> thread.fail_at = 4
+        >>> thread.failures = 5
+        >>> logbuf = testing.setUpLogging(log)
+
+    A chunk that keeps failing is retried less and less often, instead of
+    in a tight loop
+
+        >>> thread.run()
+        processing [0, 1, 2]
+        processing [3, 4, 5]
+        sleeping for 1 seconds
+        processing [3, 4, 5]
+        sleeping for 2 seconds
+        processing [3, 4, 5]
+        sleeping for 4 seconds
+        processing [3, 4, 5]
+        sleeping for 5 seconds
+        processing [3, 4, 5]
+        sleeping for 5 seconds
+        processing [3, 4, 5]
+        processing [6, 7, 8]
+        processing [9]
+
+    Once a chunk succeeds, the delay is reset
+
+        >>> thread.consecutive_failures
+        0
+        >>> logbuf.getvalue().count('Exception in migration')
+        5
+
+        >>> transaction.abort()
+        >>> site.migrated
+        10
+        >>> db.close()
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    testing.tearDownLogging(log)
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown)
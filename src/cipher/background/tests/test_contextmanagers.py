@@ -19,56 +19,9 @@ from zope.component import hooks
 from zope.security.management import endInteraction, queryInteraction
 
 from cipher.background import contextmanagers
-
-
-class ConnectionStub(object):
-    def __init__(self, db, verbose=False):
-        self._db = db
-        self._db.opened += 1
-        self._verbose = verbose
-        if self._verbose:
-            print('Connection opened')
-    def close(self):
-        self._db.closed += 1
-        if self._verbose:
-            print('Connection closed')
-    def __repr__(self):
-        return '<ConnectionStub>'
-
-class DbStub(object):
-    opened = closed = 0
-    def __init__(self, verbose=False):
-        self._verbose = verbose
-        self._objects = {}
-    def open(self):
-        return ConnectionStub(self, verbose=self._verbose)
-
-class SiteStub(object):
-    def __init__(self, name=''):
-        self._p_jar = ConnectionStub(DbStub())
-        self._p_oid = 42
-        self._p_jar._db._objects[self._p_oid] = self
-        self._name = name
-    def getSiteManager(self):
-        return None
-    def __repr__(self):
-        return 'SiteStub(%s)' % repr(self._name)
-
-class DataManagerStub(object):
-    def __init__(self):
-        self.log = []
-    def abort(self, t):
-        print('aborted')
-        self.log.append('aborted')
-    def tpc_begin(self, t):
-        pass
-    def commit(self, t):
-        print('committed')
-        self.log.append('committed')
-    def tpc_vote(self, t):
-        pass
-    def tpc_finish(self, t):
-        pass
+from cipher.background import testing
+from cipher.background.testing import (ConnectionStub, DataManagerStub,
+                                       DbStub, SiteStub)
 
 
 def doctest_ZopeInteraction():
@@ -87,6 +40,37 @@ def doctest_ZopeInteraction():
     """
 
 
+def doctest_ZopeInteraction_resume():
+    """Test for ZopeInteraction
+
+    You can resume an interaction that was started elsewhere
+
+        >>> with contextmanagers.ZopeInteraction() as interaction:
+        ...     pass
+
+        >>> with contextmanagers.ZopeInteraction(
+        ...         interaction=interaction) as i:
+        ...     print(i is interaction)
+        ...     print(queryInteraction() is interaction)
+        True
+        True
+
+        >>> print(queryInteraction())
+        None
+
+    but not while some other interaction is active
+
+        >>> with contextmanagers.ZopeInteraction():
+        ...     with contextmanagers.ZopeInteraction(interaction=interaction):
+        ...         pass
+        ... # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+          ...
+        ExistingInteraction: ZopeInteraction called while another interaction is active.
+
+    """
+
+
 def doctest_ZodbConnection():
     """Test the ZodbConnection context manager.
 
@@ -99,6 +83,65 @@ def doctest_ZodbConnection():
     """
 
 
+def doctest_ZodbConnection_historical():
+    """Test the ZodbConnection context manager.
+
+        >>> db = DbStub(verbose=True)
+        >>> with contextmanagers.ZodbConnection(db, at='2013-03-06') as conn:
+        ...     print(conn)
+        Historical connection at=2013-03-06 before=None
+        Connection opened
+        <ConnectionStub>
+        Connection closed
+
+    """
+
+
+def doctest_ZodbConnection_prefetch():
+    """Test the ZodbConnection context manager.
+
+        >>> logbuf = testing.setUpLogging(testing.log)
+        >>> db = DbStub(verbose=True)
+        >>> with contextmanagers.ZodbConnection(db, prefetch=[1, 2]) as conn:
+        ...     print(conn)
+        Connection opened
+        <ConnectionStub>
+        Connection closed
+        >>> print(logbuf.getvalue().strip())
+        prefetching [1, 2]
+
+    The connection is closed even if prefetching fails
+
+        >>> class BrokenConnectionStub(ConnectionStub):
+        ...     def prefetch(self, oids):
+        ...         raise ValueError('disconnected')
+        >>> db = DbStub()
+        >>> db.open = lambda: BrokenConnectionStub(db)
+        >>> with contextmanagers.ZodbConnection(db, prefetch=[1, 2]) as conn:
+        ...     print(conn)
+        Traceback (most recent call last):
+          ...
+        ValueError: disconnected
+        >>> db.opened, db.closed
+        (1, 1)
+
+    """
+
+
+def doctest_ZodbConnection_transaction_manager():
+    """Test the ZodbConnection context manager.
+
+        >>> db = DbStub(verbose=True)
+        >>> tm = transaction.TransactionManager()
+        >>> with contextmanagers.ZodbConnection(db, transaction_manager=tm):
+        ...     pass
+        Connection with a private transaction manager
+        Connection opened
+        Connection closed
+
+    """
+
+
 def doctest_ZodbConnection_handles_exceptions():
     """Test the ZodbConnection context manager.
 
@@ -259,11 +302,59 @@ def doctest_ZopeTransaction_starts_new_transaction():
     """
 
 
+def doctest_ZopeTransaction_transaction_manager():
+    """Test the ZopeTransaction context manager.
+
+    You can use a transaction manager other than the thread's one
+
+        >>> tm = transaction.TransactionManager()
+        >>> with contextmanagers.ZopeTransaction(transaction_manager=tm) as t:
+        ...     print(t is tm.get())
+        ...     print(t is transaction.get())
+        ...     t.join(DataManagerStub())
+        True
+        False
+        committed
+
+    """
+
+
+def doctest_CurrentTransactionManager():
+    """Test the CurrentTransactionManager context manager.
+
+        >>> tm = transaction.TransactionManager()
+        >>> with contextmanagers.CurrentTransactionManager(tm) as m:
+        ...     print(m is tm)
+        ...     print(transaction.get() is tm.get())
+        ...     transaction.get().join(DataManagerStub())
+        ...     transaction.commit()
+        True
+        True
+        committed
+
+        >>> transaction.get() is tm.get()
+        False
+
+    The previous transaction manager is restored on exceptions too
+
+        >>> with contextmanagers.CurrentTransactionManager(tm):
+        ...     raise Exception()
+        Traceback (most recent call last):
+          ...
+        Exception
+
+        >>> transaction.get() is tm.get()
+        False
+
+    """
+
+
 def setUp(test):
     pass
 
 
 def tearDown(test):
+    testing.tearDownLogging(testing.log)
     endInteraction()
     hooks.setSite(None)
     transaction.abort()
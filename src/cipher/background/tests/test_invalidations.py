@@ -0,0 +1,259 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+
+import transaction
+from persistent import Persistent
+from ZODB.utils import p64, u64
+from zope.component.hooks import setSite
+from zope.security.management import endInteraction
+
+from cipher.background import testing
+from cipher.background.invalidations import (InvalidationWatcher,
+                                             InvalidationWorkerThread)
+from cipher.background.thread import log
+
+
+class Document(Persistent):
+    title = ''
+
+
+class Folder(Persistent):
+    pass
+
+
+def createDatabase():
+    db, conn = testing.createDatabase()
+    root = conn.root()
+    root['doc1'] = Document()
+    root['doc2'] = Document()
+    root['folder'] = Folder()
+    transaction.commit()
+    return db, conn
+
+
+def doctest_InvalidationWatcher_oids():
+    """Test for InvalidationWatcher
+
+        >>> db, conn = createDatabase()
+        >>> root = conn.root()
+        >>> watcher = InvalidationWatcher(db, oids=[root['doc1']._p_oid])
+
+    Nothing happened yet
+
+        >>> watcher.wait(0)
+        False
+        >>> watcher.poll()
+        set()
+
+    Changes to objects we don't watch wake us up, but are filtered out
+
+        >>> root['doc2'].title = 'changed'
+        >>> transaction.commit()
+        >>> watcher.wait(0)
+        True
+        >>> watcher.poll()
+        set()
+
+    Changes to watched objects are reported
+
+        >>> root['doc1'].title = 'changed'
+        >>> root['doc2'].title = 'changed again'
+        >>> transaction.commit()
+        >>> watcher.poll() == set([root['doc1']._p_oid])
+        True
+
+        >>> watcher.close()
+        >>> db.close()
+
+    """
+
+
+def doctest_InvalidationWatcher_classes():
+    """Test for InvalidationWatcher
+
+        >>> db, conn = createDatabase()
+        >>> root = conn.root()
+        >>> watcher = InvalidationWatcher(
+        ...     db, classes=[Document, 'cipher.background.testing.Site'])
+
+        >>> root['doc2'].title = 'changed'
+        >>> root['folder'].title = 'changed'
+        >>> root['site'].title = 'changed'
+        >>> transaction.commit()
+        >>> watcher.poll() == set([root['doc2']._p_oid, root['site']._p_oid])
+        True
+
+    Objects that can't be loaded any more (e.g. because a pack removed
+    them) are not interesting
+
+        >>> watcher.isInteresting(p64(1000))
+        False
+
+        >>> watcher.close()
+        >>> db.close()
+
+    """
+
+
+def doctest_InvalidationWatcher_invalidateCache():
+    """Test for InvalidationWatcher
+
+        >>> db, conn = createDatabase()
+        >>> watcher = InvalidationWatcher(db, oids=[conn.root()._p_oid])
+
+    When the storage loses track of invalidations, we can't tell what changed
+
+        >>> db._mvcc_storage.invalidateCache()
+        >>> watcher.wait(0)
+        True
+        >>> print(watcher.poll())
+        None
+
+        >>> watcher.close()
+        >>> db.close()
+
+    """
+
+
+class InvalidationWorkerThreadForTest(InvalidationWorkerThread):
+
+    coalesce_delay = 0
+
+    def doWork(self):
+        print(sorted(u64(oid) for oid in self.changed_oids))
+        self.stop()
+
+
+def doctest_InvalidationWatcher_unsupported_storage():
+    """Test for InvalidationWatcher
+
+    Storages like RelStorage implement IMVCCStorage themselves and don't
+    tell us about invalidations
+
+        >>> class RelStorageStub(object):
+        ...     pass
+        >>> class DBStub(object):
+        ...     _mvcc_storage = RelStorageStub()
+
+        >>> InvalidationWatcher(DBStub()) # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+          ...
+        TypeError: InvalidationWatcher doesn't support RelStorageStub, ...
+
+    """
+
+
+def doctest_InvalidationWorkerThread():
+    """Test for InvalidationWorkerThread
+
+        >>> db, conn = createDatabase()
+        >>> root = conn.root()
+        >>> thread = InvalidationWorkerThreadForTest.forSite(
+        ...     root['site'], 'someuser')
+        >>> thread.watched_oids = [root['doc1']._p_oid, root['doc2']._p_oid]
+
+    The watcher is created when the thread starts scheduling
+
+        >>> watcher = thread.getWatcher()
+
+    Changes are coalesced and handed to doWork()
+
+        >>> root['doc1'].title = 'changed'
+        >>> transaction.commit()
+        >>> root['doc2'].title = 'changed'
+        >>> transaction.commit()
+
+        >>> thread.run()
+        [2, 3]
+
+    Once stopped, the thread releases the watcher
+
+        >>> thread.watcher is None
+        True
+
+        >>> db.close()
+
+    """
+
+
+def doctest_InvalidationWorkerThread_stop():
+    """Test for InvalidationWorkerThread.stop
+
+        >>> db, conn = createDatabase()
+        >>> thread = InvalidationWorkerThreadForTest.forSite(
+        ...     conn.root()['site'], 'someuser')
+        >>> thread.start()
+        >>> thread.stop()
+        >>> thread.join(5)
+        >>> thread.is_alive()
+        False
+
+        >>> db.close()
+
+    """
+
+
+def doctest_InvalidationWorkerThread_exception():
+    """Test for InvalidationWorkerThread.run
+
+        >>> db, conn = createDatabase()
+        >>> thread = InvalidationWorkerThreadForTest.forSite(
+        ...     conn.root()['site'], 'someuser')
+        >>> thread.name = 'this thread'
+        >>> watcher = thread.getWatcher()
+        >>> close = watcher.close
+        >>> def closeAndTell():
+        ...     print('watcher closed')
+        ...     close()
+        >>> watcher.close = closeAndTell
+
+    The watcher is released even if the thread dies
+
+        >>> def poll():
+        ...     raise Exception('something happened')
+        >>> watcher.poll = poll
+        >>> watcher.wakeup()
+
+        >>> logbuf = testing.setUpLogging(log)
+        >>> thread.run()
+        watcher closed
+        >>> thread.watcher is None
+        True
+
+        >>> print(logbuf.getvalue().strip()) # doctest: +ELLIPSIS
+        Exception in this thread, thread terminated
+        Traceback (most recent call last):
+          ...
+        Exception: something happened
+
+        >>> db.close()
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    testing.tearDownLogging(log)
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown)
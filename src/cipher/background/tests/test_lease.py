@@ -0,0 +1,223 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+
+import transaction
+from zope.component.hooks import getSite, setSite
+from zope.security.management import endInteraction
+
+from cipher.background import testing
+from cipher.background.lease import LeaseManager, SingletonWorkerThread
+from cipher.background.testing import FakeClock, createDatabases
+from cipher.background.thread import log
+
+
+def doctest_LeaseManager():
+    """Test for LeaseManager
+
+        >>> db1, db2 = createDatabases()
+        >>> clock = FakeClock()
+        >>> node1 = LeaseManager(db1, 'node1', duration=30)
+        >>> node2 = LeaseManager(db2, 'node2', duration=30)
+        >>> node1._clock = node2._clock = clock
+
+    The first node to ask gets the lease
+
+        >>> node1.acquire('cleanup')
+        30.0
+        >>> node2.acquire('cleanup')
+        >>> node2.holder('cleanup')
+        'node1'
+
+    The holder can renew it
+
+        >>> clock.now = 20.0
+        >>> node1.acquire('cleanup')
+        50.0
+
+    Other leases are independent
+
+        >>> node2.acquire('reindex')
+        50.0
+
+    Once the lease expires, another node can take it over
+
+        >>> clock.now = 51.0
+        >>> node1.holder('cleanup')
+        >>> node2.acquire('cleanup')
+        81.0
+        >>> node1.acquire('cleanup')
+
+    Leases can be released
+
+        >>> node2.release('cleanup')
+        >>> node1.acquire('cleanup')
+        81.0
+
+    Releasing a lease you don't hold does nothing
+
+        >>> node2.release('cleanup')
+        >>> node2.holder('cleanup')
+        'node1'
+
+    You can list the leases that are currently held (the 'reindex' lease
+    has expired)
+
+        >>> node2.holders()
+        {'cleanup': 'node1'}
+        >>> node2.acquire('reindex')
+        81.0
+        >>> sorted(node2.holders().items())
+        [('cleanup', 'node1'), ('reindex', 'node2')]
+        >>> node2.holders('re')
+        {'reindex': 'node2'}
+        >>> node2.holders('x')
+        {}
+
+        >>> db1.close()
+        >>> db2.close()
+
+    """
+
+
+class SingletonWorkerThreadForTest(SingletonWorkerThread):
+
+    def __init__(self, *args, **kw):
+        super(SingletonWorkerThreadForTest, self).__init__(*args, **kw)
+        self._tasks = [None]
+
+    def scheduleNextWork(self):
+        return bool(self._tasks and self._tasks.pop())
+
+    def doWork(self):
+        print('did the work')
+        getSite().done_by = self.leases.node_id
+
+
+def doctest_SingletonWorkerThread():
+    """Test for SingletonWorkerThread
+
+        >>> db1, db2 = createDatabases()
+        >>> site = db1.open().root()['site']
+        >>> worker1 = SingletonWorkerThreadForTest(
+        ...     db1, site._p_oid, 'testsite', 'someuser')
+        >>> worker1.leases.node_id = 'node1'
+        >>> worker2 = SingletonWorkerThreadForTest(
+        ...     db2, site._p_oid, 'testsite', 'someuser')
+        >>> worker2.leases.node_id = 'node2'
+
+        >>> worker1.getLeaseName() # doctest: +NORMALIZE_WHITESPACE
+        'cipher.background.tests.test_lease.SingletonWorkerThreadForTest
+         for testsite'
+
+    Only the leader does the work
+
+        >>> worker1.renewLeases()
+        >>> worker2.renewLeases()
+        >>> worker1.holdsLease(), worker2.holdsLease()
+        (True, False)
+
+        >>> from cipher.background.contextmanagers import ZopeSite
+        >>> with ZopeSite(site):
+        ...     worker2.doWorkInTransaction()
+        ...     worker1.doWorkInTransaction()
+        did the work
+
+        >>> transaction.abort()
+        >>> site.done_by
+        'node1'
+
+        >>> db1.close()
+        >>> db2.close()
+
+    """
+
+
+def doctest_SingletonWorkerThread_run():
+    """Test for SingletonWorkerThread.run
+
+        >>> db1, db2 = createDatabases()
+        >>> conn = db2.open()
+        >>> site = conn.root()['site']
+        >>> worker = SingletonWorkerThreadForTest(
+        ...     db1, site._p_oid, 'testsite', 'someuser')
+        >>> worker._tasks = [True]
+
+        >>> worker.run()
+        did the work
+
+    The thread acquired the lease before starting and released it when done
+
+        >>> worker.leases.holder(worker.getLeaseName())
+
+        >>> transaction.abort()
+        >>> site.done_by == worker.leases.node_id
+        True
+
+        >>> conn.close()
+        >>> db1.close()
+        >>> db2.close()
+
+    """
+
+
+def doctest_SingletonWorkerThread_lease_lost():
+    """Test for SingletonWorkerThread.doWorkInTransaction
+
+        >>> db1, db2 = createDatabases()
+        >>> site = db1.open().root()['site']
+        >>> worker = SingletonWorkerThreadForTest(
+        ...     db1, site._p_oid, 'testsite', 'someuser')
+        >>> worker.leases.node_id = 'node1'
+        >>> worker.renewLeases()
+
+    If the lease expires while the work is being done, the transaction is
+    not committed
+
+        >>> def doWork():
+        ...     getSite().done_by = 'node1'
+        ...     worker.lease_expires = 0
+        >>> worker.doWork = doWork
+
+        >>> from cipher.background.contextmanagers import ZopeSite
+        >>> with ZopeSite(site):
+        ...     worker.doWorkInTransaction()
+        ... # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+          ...
+        LeaseLost: cipher.background...
+
+        >>> transaction.abort()
+        >>> getattr(site, 'done_by', None)
+
+        >>> db1.close()
+        >>> db2.close()
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    testing.tearDownLogging(log)
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown)
@@ -0,0 +1,346 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+import pprint
+import threading
+
+import transaction
+from persistent.list import PersistentList
+from zope.component.hooks import getSite, setSite
+from zope.security.management import endInteraction, queryInteraction
+
+from cipher.background import testing
+from cipher.background.multiplex import CooperativeExecutor, MultiplexedWorker
+from cipher.background.multiplex import log as executor_log
+from cipher.background.registry import registry
+from cipher.background.testing import FakeClock, createDatabase
+from cipher.background.thread import log
+
+
+class WorkerForTest(MultiplexedWorker):
+
+    verbose = True
+
+    def __init__(self, *args, **kw):
+        super(WorkerForTest, self).__init__(*args, **kw)
+        self.jobs = []
+        self.done = threading.Event()
+
+    def pollForWork(self):
+        if not self.jobs:
+            self.done.set()
+        return bool(self.jobs)
+
+    def doWork(self):
+        job = self.jobs.pop(0)
+        if self.verbose:
+            print('%s doing %s' % (self.user_name, job))
+            print('  private transaction: %s'
+                  % (transaction.get() is self.transaction_manager.get()))
+            print('  interaction: %s' % (queryInteraction() is not None))
+        if job == 'bad job':
+            raise ValueError(job)
+        getSite()._p_jar.root()[self.user_name].append(job)
+
+
+def makeWorker(site, user_name, jobs):
+    site._p_jar.root()[user_name] = PersistentList()
+    transaction.commit()
+    worker = WorkerForTest.forSite(site, user_name)
+    worker.jobs = list(jobs)
+    return worker
+
+
+def doctest_MultiplexedWorker_step():
+    """Test for MultiplexedWorker.step
+
+        >>> db, conn = createDatabase()
+        >>> site = conn.root()['site']
+        >>> alice = makeWorker(site, 'alice', ['a1', 'a2'])
+        >>> bob = makeWorker(site, 'bob', ['b1'])
+        >>> alice.transaction_manager is bob.transaction_manager
+        False
+
+    Every step does one job on the calling thread, in a transaction of the
+    worker's own transaction manager
+
+        >>> alice.step()
+        alice doing a1
+          private transaction: True
+          interaction: True
+        0
+        >>> bob.step()
+        bob doing b1
+          private transaction: True
+          interaction: True
+        0
+        >>> alice.step()
+        alice doing a2
+          private transaction: True
+          interaction: True
+        0
+
+    When there's no work, the worker asks to be polled again later
+
+        >>> alice.step()
+        1.0
+
+    Nothing is left behind in the calling thread
+
+        >>> print(getSite(), queryInteraction())
+        None None
+
+        >>> transaction.abort()
+        >>> list(conn.root()['alice']), list(conn.root()['bob'])
+        (['a1', 'a2'], ['b1'])
+
+    A stopped worker asks to be dropped
+
+        >>> alice.stop()
+        >>> print(alice.step())
+        None
+        >>> alice.getStatus()['alive']
+        False
+
+        >>> db.close()
+
+    """
+
+
+def doctest_MultiplexedWorker_step_failure():
+    """Test for MultiplexedWorker.step
+
+        >>> db, conn = createDatabase()
+        >>> site = conn.root()['site']
+        >>> worker = makeWorker(site, 'alice', ['bad job', 'good job'])
+        >>> worker.name = 'worker'
+        >>> logbuf = testing.setUpLogging(log)
+
+    Failures are logged and counted, like in ordinary worker threads
+
+        >>> worker.step()
+        alice doing bad job
+          private transaction: True
+          interaction: True
+        0
+        >>> print(logbuf.getvalue().splitlines()[0])
+        Exception in worker
+
+        >>> worker.step()
+        alice doing good job
+          private transaction: True
+          interaction: True
+        0
+
+        >>> status = worker.getStatus()
+        >>> status['iterations'], status['failures'], status['last_error']
+        (2, 1, 'ValueError: bad job')
+
+        >>> transaction.abort()
+        >>> list(conn.root()['alice'])
+        ['good job']
+
+        >>> db.close()
+
+    """
+
+
+def doctest_CooperativeExecutor_order():
+    """Test for CooperativeExecutor
+
+    We can drive the executor by hand to see in which order workers get
+    served
+
+        >>> db, conn = createDatabase()
+        >>> site = conn.root()['site']
+        >>> executor = CooperativeExecutor(threads=1)
+        >>> executor._clock = FakeClock()
+        >>> alice = makeWorker(site, 'alice', ['a1', 'a2'])
+        >>> bob = makeWorker(site, 'bob', ['b1', 'b2'])
+        >>> alice.verbose = bob.verbose = False
+        >>> alice.poll_interval = bob.poll_interval = 5
+        >>> executor.add(alice)
+        >>> executor.add(bob)
+
+        >>> def run(n):
+        ...     for i in range(n):
+        ...         worker = executor._next()
+        ...         executor.runStep(worker)
+        ...         print('%s: %s jobs left at %s' % (worker.user_name,
+        ...                                           len(worker.jobs),
+        ...                                           executor._clock()))
+
+    Busy workers take turns, and idle workers get polled less often
+
+        >>> run(6)
+        alice: 1 jobs left at 0.0
+        bob: 1 jobs left at 0.0
+        alice: 0 jobs left at 0.0
+        bob: 0 jobs left at 0.0
+        alice: 0 jobs left at 0.0
+        bob: 0 jobs left at 0.0
+
+        >>> executor._due[0][:1], executor._due[1][:1]
+        ((5.0,), (5.0,))
+
+        >>> executor._clock.now = 5
+        >>> alice.jobs.append('a3')
+        >>> run(2)
+        alice: 0 jobs left at 5
+        bob: 0 jobs left at 5
+        >>> executor._due[0][:1], executor._due[1][:1]
+        ((5,), (10,))
+
+    Removed workers are skipped
+
+        >>> executor.remove(alice)
+        >>> executor._clock.now = 10
+        >>> run(1)
+        bob: 0 jobs left at 10
+        >>> alice.getStatus()['state']
+        'stopped'
+
+        >>> executor.remove(bob)
+        >>> db.close()
+
+    """
+
+
+def doctest_CooperativeExecutor_getStatus():
+    """Test for CooperativeExecutor.getStatus
+
+        >>> db, conn = createDatabase()
+        >>> site = conn.root()['site']
+        >>> executor = CooperativeExecutor(threads=1)
+        >>> alice = makeWorker(site, 'alice', ['a1'])
+        >>> bob = makeWorker(site, 'bob', ['b1'])
+        >>> alice.verbose = bob.verbose = False
+        >>> executor.add(alice)
+        >>> executor.add(bob)
+
+    The queue depth is the number of workers waiting for their turn, not
+    counting the ones that are running
+
+        >>> status = executor.getStatus()
+        >>> status['running'], status['queue_depth']
+        (0, 2)
+        >>> worker = executor._next()
+        >>> status = executor.getStatus()
+        >>> status['running'], status['queue_depth']
+        (1, 1)
+        >>> executor.runStep(worker)
+        >>> status = executor.getStatus()
+        >>> status['running'], status['queue_depth']
+        (0, 2)
+
+        >>> executor.remove(alice)
+        >>> executor.remove(bob)
+        >>> db.close()
+
+    """
+
+
+def doctest_CooperativeExecutor_drops_broken_workers():
+    """Test for CooperativeExecutor
+
+        >>> executor = CooperativeExecutor()
+        >>> executor.name = 'executor'
+
+        >>> class BrokenWorker(MultiplexedWorker):
+        ...     def pollForWork(self):
+        ...         raise Exception('oops')
+
+        >>> db, conn = createDatabase()
+        >>> worker = BrokenWorker.forSite(conn.root()['site'], 'alice')
+        >>> worker.name = 'worker'
+        >>> executor.add(worker)
+        >>> worker in registry.workers()
+        True
+
+        >>> logbuf = testing.setUpLogging(executor_log)
+        >>> executor.runStep(executor._next())
+        >>> print(logbuf.getvalue().splitlines()[0])
+        Exception in executor, dropping worker
+
+        >>> executor.workers
+        set()
+        >>> worker in registry.workers()
+        False
+
+        >>> db.close()
+
+    """
+
+
+def doctest_CooperativeExecutor():
+    """Test for CooperativeExecutor
+
+    Many logical workers can share a couple of threads
+
+        >>> db, conn = createDatabase()
+        >>> site = conn.root()['site']
+        >>> workers = [
+        ...     makeWorker(site, 'user%d' % n, ['job0', 'job1', 'job2'])
+        ...     for n in range(10)]
+
+        >>> executor = CooperativeExecutor(threads=2)
+        >>> for worker in workers:
+        ...     worker.verbose = False
+        ...     executor.add(worker)
+        >>> executor.start()
+        >>> executor in registry.workers()
+        True
+
+        >>> all(worker.done.wait(10) for worker in workers)
+        True
+        >>> executor.stop()
+        >>> executor in registry.workers()
+        False
+
+        >>> pprint.pprint(executor.getStatus())
+        {'class_name': 'CooperativeExecutor',
+         'name': 'cooperative executor',
+         'queue_depth': 10,
+         'running': 0,
+         'threads': 0,
+         'workers': 10}
+
+    Every worker committed its own transactions
+
+        >>> transaction.abort()
+        >>> sorted(set(tuple(conn.root()['user%d' % n]) for n in range(10)))
+        [('job0', 'job1', 'job2')]
+
+        >>> for worker in workers:
+        ...     executor.remove(worker)
+        >>> db.close()
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    testing.tearDownLogging(log)
+    testing.tearDownLogging(executor_log)
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown)
@@ -0,0 +1,148 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+
+import transaction
+
+from cipher.background import testing
+from cipher.background.contextmanagers import ZopeTransaction
+from cipher.background.outbox import Outbox, log
+
+
+def doctest_Outbox_sends_after_commit():
+    """Test for Outbox.add
+
+        >>> transport = testing.TransportStub()
+        >>> outbox = Outbox(transport)
+        >>> outbox.start()
+
+        >>> with ZopeTransaction():
+        ...     outbox.add('hello')
+        ...     outbox.add('world')
+        ...     transport.messages
+        []
+
+        >>> outbox.flush()
+        >>> transport.messages
+        ['hello', 'world']
+        >>> outbox.sent
+        2
+
+        >>> outbox.stop()
+
+    """
+
+
+def doctest_Outbox_drops_messages_on_abort():
+    """Test for Outbox.add
+
+        >>> transport = testing.TransportStub()
+        >>> outbox = Outbox(transport)
+        >>> outbox.start()
+
+        >>> with ZopeTransaction():
+        ...     outbox.add('hello')
+        ...     raise Exception('something happened')
+        Traceback (most recent call last):
+          ...
+        Exception: something happened
+
+        >>> outbox.add('never committed')
+        >>> transaction.abort()
+
+        >>> outbox.flush()
+        >>> transport.messages
+        []
+
+        >>> outbox.stop()
+
+    """
+
+
+def doctest_Outbox_batches():
+    """Test for Outbox batching
+
+    Messages queued before the senders start go out in batches
+
+        >>> transport = testing.TransportStub()
+        >>> outbox = Outbox(transport, batch_size=3)
+        >>> with ZopeTransaction():
+        ...     for n in range(5):
+        ...         outbox.add(n)
+
+        >>> outbox.start()
+        >>> outbox.stop()
+        >>> transport.batches
+        [[0, 1, 2], [3, 4]]
+
+    """
+
+
+def doctest_Outbox_retries():
+    """Test for Outbox.deliver
+
+        >>> transport = testing.TransportStub(failures=2)
+        >>> outbox = Outbox(transport, retry_delay=0.5)
+        >>> outbox._sleep = lambda delay: print('sleeping %s' % delay)
+
+        >>> logbuf = testing.setUpLogging(log)
+        >>> outbox.deliver(['hello'])
+        sleeping 0.5
+        sleeping 1.0
+
+        >>> print(logbuf.getvalue().strip())
+        Failed to send 1 messages (attempt 1), retrying
+        Failed to send 1 messages (attempt 2), retrying
+
+        >>> transport.messages
+        ['hello']
+
+    """
+
+
+def doctest_Outbox_gives_up():
+    """Test for Outbox.deliver
+
+        >>> transport = testing.TransportStub(failures=5)
+        >>> outbox = Outbox(transport, max_attempts=2)
+        >>> outbox._sleep = lambda delay: None
+
+        >>> logbuf = testing.setUpLogging(log)
+        >>> outbox.deliver(['hello', 'world'])
+
+        >>> print(logbuf.getvalue().strip()) # doctest: +ELLIPSIS
+        Failed to send 2 messages (attempt 1), retrying
+        Giving up on 2 messages after 2 attempts
+        Traceback (most recent call last):
+          ...
+        RuntimeError: transport failure
+
+        >>> outbox.failed
+        2
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    testing.tearDownLogging(log)
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown)
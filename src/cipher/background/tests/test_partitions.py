@@ -0,0 +1,315 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+
+import transaction
+from zope.component.hooks import setSite
+from zope.security.management import endInteraction
+
+from cipher.background import testing
+from cipher.background.contextmanagers import ZopeSite
+from cipher.background.partitions import (PartitionedJobQueue,
+                                          PartitionedWorkerThread,
+                                          getJobQueue)
+from cipher.background.testing import FakeClock, createDatabases
+from cipher.background.thread import log
+from cipher.background.tracing import TraceContext
+
+
+class PartitionedWorkerThreadForTest(PartitionedWorkerThread):
+
+    queue_name = 'jobs'
+    partitions = 4
+
+    def processJob(self, job):
+        print('%s: %s' % (self.leases.node_id, job))
+
+
+def createWorker(db, node_id, clock):
+    conn = db.open()
+    site = conn.root()['site']
+    conn.close()
+    worker = PartitionedWorkerThreadForTest(db, site._p_oid, 'testsite',
+                                            'someuser')
+    worker.leases.node_id = node_id
+    worker.leases._clock = worker._clock = clock
+    return worker
+
+
+def doctest_PartitionedJobQueue():
+    """Test for PartitionedJobQueue
+
+        >>> queue = PartitionedJobQueue(4)
+        >>> for n in range(10):
+        ...     queue.put(n, key='same key')
+        >>> len(queue)
+        10
+        >>> [len(partition) for partition in queue.partitions]
+        [0, 0, 0, 10]
+
+    Jobs come out of a partition in order
+
+        >>> partition = queue.partitions[3]
+        >>> [partition.pop() for n in range(11)]
+        [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, None]
+
+    Jobs without a key are spread randomly
+
+        >>> for n in range(100):
+        ...     queue.put(n)
+        >>> len([p for p in queue.partitions if len(p)])
+        4
+
+    """
+
+
+def doctest_PartitionedWorkerThread_renewLeases():
+    """Test for PartitionedWorkerThread.renewLeases
+
+        >>> db1, db2 = createDatabases()
+        >>> clock = FakeClock()
+        >>> worker1 = createWorker(db1, 'node1', clock)
+        >>> worker2 = createWorker(db2, 'node2', clock)
+
+    A lonely node takes all the partitions
+
+        >>> worker1.renewLeases()
+        >>> sorted(worker1.owned)
+        [0, 1, 2, 3]
+
+    When another node joins, it gets nothing at first
+
+        >>> worker2.renewLeases()
+        >>> sorted(worker2.owned)
+        []
+
+    but the first node gives up partitions it has too many of
+
+        >>> clock.now = 10.0
+        >>> worker1.renewLeases()
+        >>> sorted(worker1.owned)
+        [0, 1]
+        >>> worker2.renewLeases()
+        >>> sorted(worker2.owned)
+        [2, 3]
+
+    When a node dies, the other one takes over its partitions once the
+    leases expire
+
+        >>> clock.now = 35.0
+        >>> worker2.renewLeases()
+        >>> sorted(worker2.owned)
+        [2, 3]
+        >>> clock.now = 45.0
+        >>> worker2.renewLeases()
+        >>> sorted(worker2.owned)
+        [0, 1, 2, 3]
+
+        >>> db1.close()
+        >>> db2.close()
+
+    """
+
+
+def doctest_PartitionedWorkerThread_renewLeases_conflict():
+    """Test for PartitionedWorkerThread.renewLeases
+
+        >>> db1, db2 = createDatabases()
+        >>> clock = FakeClock()
+        >>> worker = createWorker(db1, 'node1', clock)
+        >>> worker.renewLeases()
+        >>> sorted(worker.owned)
+        [0, 1, 2, 3]
+
+    A conflict while renewing a lease loses track of the partition
+
+        >>> acquire = worker.leases.acquire
+        >>> def conflicting_acquire(name):
+        ...     if name.endswith('partition 1'):
+        ...         return None # LeaseManager._run got a TransientError
+        ...     return acquire(name)
+        >>> worker.leases.acquire = conflicting_acquire
+        >>> clock.now = 10.0
+        >>> worker.renewLeases()
+        >>> sorted(worker.owned)
+        [0, 2, 3]
+
+    but we still hold the lease, so we pick the partition up again the next
+    time
+
+        >>> del worker.leases.acquire
+        >>> clock.now = 20.0
+        >>> worker.renewLeases()
+        >>> sorted(worker.owned)
+        [0, 1, 2, 3]
+
+        >>> db1.close()
+        >>> db2.close()
+
+    """
+
+
+def doctest_PartitionedWorkerThread_doWork():
+    """Test for PartitionedWorkerThread.doWork
+
+        >>> db1, db2 = createDatabases()
+        >>> clock = FakeClock()
+        >>> worker1 = createWorker(db1, 'node1', clock)
+        >>> worker2 = createWorker(db2, 'node2', clock)
+        >>> worker1.owned = {0: 30.0, 1: 30.0}
+        >>> worker2.owned = {2: 30.0, 3: 30.0}
+
+        >>> conn = db1.open()
+        >>> queue = getJobQueue(conn.root(), 'jobs', partitions=4)
+        >>> for n in range(8):
+        ...     queue.put('job %d' % n, key=n)
+        >>> transaction.commit()
+        >>> [len(partition) for partition in queue.partitions]
+        [2, 2, 2, 2]
+
+    Every node processes the jobs from its own partitions, round-robin
+
+        >>> def work(worker):
+        ...     with ZopeSite(conn.root()['site']):
+        ...         worker.doWorkInTransaction()
+        ...     return worker.idle
+
+        >>> while not work(worker1):
+        ...     pass
+        node1: job 4
+        node1: job 0
+        node1: job 6
+        node1: job 2
+
+        >>> while not work(worker2):
+        ...     pass
+        node2: job 5
+        node2: job 1
+        node2: job 7
+        node2: job 3
+
+        >>> len(queue)
+        0
+
+        >>> db1.close()
+        >>> db2.close()
+
+    """
+
+
+def doctest_PartitionedWorkerThread_doWork_traced():
+    """Test for PartitionedWorkerThread.doWork
+
+    Jobs can carry a trace context
+
+        >>> db1, db2 = createDatabases()
+        >>> worker = createWorker(db1, 'node1', FakeClock())
+        >>> worker.owned = {0: 30.0, 1: 30.0, 2: 30.0, 3: 30.0}
+
+        >>> conn = db1.open()
+        >>> queue = getJobQueue(conn.root(), 'jobs', partitions=4)
+        >>> queue.put('job', trace=TraceContext('trace1', 'span1', 0.0))
+        >>> transaction.commit()
+
+    The worker joins the trace and processes the job itself
+
+        >>> worker.traceJob = lambda context: print('tracing', context)
+        >>> with ZopeSite(conn.root()['site']):
+        ...     worker.doWorkInTransaction()
+        tracing <TraceContext trace1/span1>
+        node1: job
+
+        >>> db1.close()
+        >>> db2.close()
+
+    """
+
+
+def doctest_PartitionedWorkerThread_lease_lost():
+    """Test for PartitionedWorkerThread.doWork
+
+        >>> db1, db2 = createDatabases()
+        >>> clock = FakeClock()
+        >>> worker = createWorker(db1, 'node1', clock)
+        >>> worker.owned = {0: 30.0, 1: 30.0, 2: 30.0, 3: 30.0}
+
+        >>> conn = db1.open()
+        >>> getJobQueue(conn.root(), 'jobs', partitions=4).put('job')
+        >>> transaction.commit()
+
+    If we lose the partition while processing the job, the job stays in
+    the queue
+
+        >>> def processJob(job):
+        ...     clock.now = 60.0
+        >>> worker.processJob = processJob
+        >>> with ZopeSite(conn.root()['site']):
+        ...     worker.doWorkInTransaction()
+        ... # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+          ...
+        LeaseLost: jobs partition ...
+
+        >>> len(getJobQueue(conn.root(), 'jobs'))
+        1
+
+        >>> db1.close()
+        >>> db2.close()
+
+    """
+
+
+def doctest_PartitionedWorkerThread_run():
+    """Test for PartitionedWorkerThread.run
+
+        >>> db1, db2 = createDatabases()
+        >>> worker = createWorker(db1, 'node1', FakeClock())
+        >>> worker.poll_interval = 0
+
+        >>> conn = db1.open()
+        >>> getJobQueue(conn.root(), 'jobs', partitions=4).put('job')
+        >>> transaction.commit()
+
+        >>> def processJob(job):
+        ...     print('processing %s' % job)
+        ...     worker.stop()
+        >>> worker.processJob = processJob
+        >>> worker.run()
+        processing job
+
+    The leases are released when the thread terminates
+
+        >>> worker.leases.holders()
+        {}
+
+        >>> db1.close()
+        >>> db2.close()
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    testing.tearDownLogging(log)
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown)
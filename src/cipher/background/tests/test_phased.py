@@ -0,0 +1,317 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+
+import transaction
+from zope.component.hooks import getSite, setSite
+from zope.security.management import queryInteraction, endInteraction
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # Python 2 BBB, without the futures backport
+    ProcessPoolExecutor = None
+
+from cipher.background import testing
+from cipher.background.phased import TwoPhaseWorkerThread
+from cipher.background.testing import DataManagerStub, SiteStub
+from cipher.background.thread import log
+
+
+class TwoPhaseWorkerThreadForTest(TwoPhaseWorkerThread):
+
+    def __init__(self, *args, **kw):
+        super(TwoPhaseWorkerThreadForTest, self).__init__(*args, **kw)
+        self._tasks = [3, 2, 1]
+
+    def scheduleNextWork(self):
+        return bool(self._tasks)
+
+    def readData(self):
+        print('read: site=%s, description=%r' % (
+            getSite() is not None, transaction.get().description))
+        return self._tasks.pop()
+
+    def compute(self, data):
+        print('compute %s: site=%s, interaction=%s, connections open=%d' % (
+            data, getSite() is not None, queryInteraction() is not None,
+            self.site_db.opened - self.site_db.closed))
+        return data * 10
+
+    def applyResult(self, data, result):
+        print('apply %s: site=%s, description=%r' % (
+            result, getSite() is not None, transaction.get().description))
+        getSite().patients[data] = result
+
+    def doCleanup(self):
+        print('cleanup')
+
+
+class ExecutorStub(object):
+
+    def submit(self, fn, *args):
+        print('submitted %s%r' % (fn.__name__, args))
+        return FutureStub(fn(*args))
+
+
+class FutureStub(object):
+
+    def __init__(self, result):
+        self._result = result
+
+    def result(self):
+        return self._result
+
+
+def doctest_TwoPhaseWorkerThread_run():
+    """Test for TwoPhaseWorkerThread.run
+
+        >>> site = SiteStub()
+        >>> thread = TwoPhaseWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.name = 'my thread'
+        >>> thread._tasks = [1]
+
+    The computation runs with no site and no open connection
+
+        >>> thread.run()
+        read: site=True, description='my thread read'
+        compute 1: site=False, interaction=False, connections open=1
+        apply 10: site=True, description='my thread'
+        cleanup
+
+        >>> site.patients
+        {1: 10}
+
+    (The one connection we see open is the one SiteStub keeps for itself.)
+    The read phase and the write phase get a connection each
+
+        >>> site._p_jar.db().opened
+        3
+        >>> site._p_jar.db().closed
+        2
+
+    """
+
+
+def doctest_TwoPhaseWorkerThread_hooks():
+    """Test for TwoPhaseWorkerThread.run
+
+    The phases run in iterations of the main loop, like doWork() in other
+    worker threads, so the registry, the counters and the other hooks of
+    BackgroundWorkerThread apply
+
+        >>> from cipher.background.registry import registry
+        >>> site = SiteStub()
+        >>> thread = TwoPhaseWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.name = 'my thread'
+        >>> thread._tasks = [2, 1]
+
+        >>> def readData():
+        ...     print('%s, registered: %s' % (thread.state,
+        ...                                   thread in registry.workers()))
+        ...     return thread._tasks.pop()
+        >>> thread.readData = readData
+
+        >>> def applyResult(data, result):
+        ...     print(thread.state)
+        >>> thread.applyResult = applyResult
+
+        >>> thread.run()
+        preparing, registered: True
+        compute 1: site=False, interaction=False, connections open=1
+        working
+        cleanup
+        preparing, registered: True
+        compute 2: site=False, interaction=False, connections open=1
+        working
+        cleanup
+
+        >>> status = thread.getStatus()
+        >>> status['iterations'], status['failures'], status['state']
+        (2, 0, 'stopped')
+        >>> thread in registry.workers()
+        False
+
+    """
+
+
+def doctest_TwoPhaseWorkerThread_executor():
+    """Test for TwoPhaseWorkerThread.run
+
+        >>> site = SiteStub()
+        >>> thread = TwoPhaseWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.name = 'my thread'
+        >>> thread._tasks = [1]
+        >>> thread.executor = ExecutorStub()
+
+        >>> thread.run()
+        read: site=True, description='my thread read'
+        submitted compute(1,)
+        compute 1: site=False, interaction=False, connections open=1
+        apply 10: site=True, description='my thread'
+        cleanup
+
+    """
+
+
+def multiplyByTen(data):
+    return data * 10
+
+
+class ProcessPoolWorkerForTest(TwoPhaseWorkerThreadForTest):
+
+    computeFunction = staticmethod(multiplyByTen)
+
+
+if ProcessPoolExecutor is not None:
+
+    def doctest_TwoPhaseWorkerThread_ProcessPoolExecutor():
+        """Test for TwoPhaseWorkerThread.run
+
+        The thread can't be pickled, so a ProcessPoolExecutor runs
+        computeFunction instead of compute()
+
+            >>> site = SiteStub()
+            >>> thread = ProcessPoolWorkerForTest.forSite(site, 'someuser')
+            >>> thread.name = 'my thread'
+            >>> thread._tasks = [2, 1]
+            >>> thread.executor = executor = ProcessPoolExecutor(1)
+
+            >>> thread.run()
+            read: site=True, description='my thread read'
+            apply 10: site=True, description='my thread'
+            cleanup
+            read: site=True, description='my thread read'
+            apply 20: site=True, description='my thread'
+            cleanup
+
+            >>> executor.shutdown()
+
+        """
+
+
+def doctest_TwoPhaseWorkerThread_validateResult():
+    """Test for TwoPhaseWorkerThread.run
+
+        >>> site = SiteStub()
+        >>> thread = TwoPhaseWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.name = 'my thread'
+        >>> thread.validateResult = lambda data, result: data != 2
+
+        >>> logbuf = testing.setUpLogging(log)
+
+    Invalid results are not applied
+
+        >>> thread.run()
+        read: site=True, description='my thread read'
+        compute 1: site=False, interaction=False, connections open=1
+        apply 10: site=True, description='my thread'
+        cleanup
+        read: site=True, description='my thread read'
+        compute 2: site=False, interaction=False, connections open=1
+        cleanup
+        read: site=True, description='my thread read'
+        compute 3: site=False, interaction=False, connections open=1
+        apply 30: site=True, description='my thread'
+        cleanup
+
+        >>> print(logbuf.getvalue().strip())
+        Discarding stale result in my thread
+
+        >>> sorted(site.patients.items())
+        [(1, 10), (3, 30)]
+
+    """
+
+
+def doctest_TwoPhaseWorkerThread_exception_handling():
+    """Test for TwoPhaseWorkerThread.run
+
+        >>> site = SiteStub()
+        >>> thread = TwoPhaseWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.name = 'this thread'
+        >>> thread._tasks = [1]
+
+        >>> def compute(data):
+        ...     raise Exception('something happened')
+        >>> thread.compute = compute
+
+        >>> logbuf = testing.setUpLogging(log)
+        >>> states = []
+        >>> thread.setState = states.append
+
+    What if an exception happens during the computation?
+
+        >>> thread.run()
+        read: site=True, description='this thread read'
+        cleanup
+
+    The write phase is skipped
+
+        >>> 'working' in states, 'committing' in states
+        (False, False)
+
+    The exception is mentioned in the log
+
+        >>> print(logbuf.getvalue().strip()) # doctest: +ELLIPSIS
+        Exception in this thread
+        Traceback (most recent call last):
+          ...
+        Exception: something happened
+
+    and counted
+
+        >>> thread.getStatus()['failures']
+        1
+
+    and all the connections we opened were closed
+
+        >>> site._p_jar.db().opened - site._p_jar.db().closed
+        1
+
+        >>> queryInteraction()
+        >>> getSite()
+
+    """
+
+
+def doctest_TwoPhaseWorkerThread_readPhase_aborts():
+    """Test for TwoPhaseWorkerThread.readPhase
+
+        >>> site = SiteStub()
+        >>> thread = TwoPhaseWorkerThread.forSite(site, 'someuser')
+        >>> thread.readData = lambda: transaction.get().join(DataManagerStub())
+
+    Changes made during the read phase are never committed
+
+        >>> thread.readPhase()
+        aborted
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    testing.tearDownLogging(log)
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown)
@@ -0,0 +1,237 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+import pprint
+
+import transaction
+from zope.component.hooks import getSite, setSite
+from zope.security.management import endInteraction
+
+from cipher.background import testing
+from cipher.background.ratelimit import Budget, WriteRateLimiter
+from cipher.background.testing import FakeClock, createDatabase
+from cipher.background.thread import BackgroundWorkerThread, log
+
+
+def createLimiter(budget=None):
+    limiter = WriteRateLimiter()
+    limiter._clock = clock = FakeClock()
+
+    def sleep(seconds):
+        print('sleeping %.2f seconds' % seconds)
+        clock.now += seconds
+
+    limiter._sleep = sleep
+    limiter.setBudget(None, budget)
+    return limiter
+
+
+class WorkerForTest(BackgroundWorkerThread):
+
+    iterations = 3
+
+    def scheduleNextWork(self):
+        return self.iteration_count < self.iterations
+
+    def doWork(self):
+        if self.iteration_count < 2:
+            getSite().title = 'x' * 1000
+
+
+def doctest_WriteRateLimiter_wait():
+    """Test for WriteRateLimiter.wait
+
+        >>> limiter = createLimiter(Budget(commit_rate=2, burst=1.5))
+
+    Up to ``burst`` seconds worth of commits can happen without waiting
+
+        >>> limiter.wait('Worker')
+        0.0
+        >>> limiter.wait('Worker')
+        0.0
+        >>> limiter.wait('Worker')
+        0.0
+
+    then the commits are spaced out
+
+        >>> limiter.wait('Worker')
+        sleeping 0.50 seconds
+        0.5
+        >>> limiter.wait('Worker')
+        sleeping 0.50 seconds
+        0.5
+
+        >>> pprint.pprint(limiter.stats())
+        {'Worker': {'bytes_written': 0, 'commits': 0, 'waited': 1.0, 'waits': 2}}
+
+    """
+
+
+def doctest_WriteRateLimiter_bytes():
+    """Test for WriteRateLimiter.charge
+
+        >>> limiter = createLimiter(Budget(byte_rate=1000))
+
+    Commits are allowed as long as the byte budget isn't in debt
+
+        >>> limiter.wait()
+        0.0
+        >>> limiter.charge(bytes_written=3000)
+        >>> limiter.wait()
+        sleeping 2.00 seconds
+        2.0
+        >>> limiter.charge(bytes_written=500)
+        >>> limiter.wait()
+        sleeping 0.50 seconds
+        0.5
+
+        >>> limiter.stats()[None]['bytes_written']
+        3500
+
+    """
+
+
+def doctest_WriteRateLimiter_class_budgets():
+    """Test for WriteRateLimiter.setBudget
+
+    Worker classes can have budgets of their own, on top of the
+    process-wide one
+
+        >>> limiter = createLimiter(Budget(commit_rate=10))
+        >>> limiter.setBudget('SlowWorker', Budget(commit_rate=1))
+        >>> limiter.getBudget('SlowWorker').commit_rate
+        1
+
+        >>> limiter.wait('SlowWorker')
+        0.0
+        >>> limiter.wait('SlowWorker')
+        sleeping 1.00 seconds
+        1.0
+
+    Other classes only compete for the process-wide budget
+
+        >>> for n in range(9):
+        ...     _ = limiter.wait('FastWorker')
+        >>> print('%.2f' % limiter.wait('FastWorker'))
+        sleeping 0.10 seconds
+        0.10
+
+    Budgets can be removed
+
+        >>> limiter.setBudget('SlowWorker', None)
+        >>> limiter.setBudget(None, None)
+        >>> for n in range(100):
+        ...     _ = limiter.wait('SlowWorker')
+
+    """
+
+
+def doctest_WriteRateLimiter_reportLatency():
+    """Test for WriteRateLimiter.reportLatency
+
+        >>> limiter = createLimiter(Budget(commit_rate=10))
+
+    Latency feedback is off by default
+
+        >>> limiter.reportLatency(5.0)
+        >>> limiter.factor
+        1.0
+
+        >>> limiter.target_latency = 0.5
+        >>> limiter.latency_smoothing = 0.5
+
+    Rates go down quickly while foreground requests are slow
+
+        >>> limiter.reportLatency(1.0)
+        >>> limiter.factor
+        0.5
+
+    but not more often than every ``adjust_interval`` seconds
+
+        >>> limiter.reportLatency(1.0)
+        >>> limiter.factor
+        0.5
+
+        >>> limiter._clock.now = 1.0
+        >>> limiter.reportLatency(1.0)
+        >>> limiter.factor
+        0.25
+        >>> limiter.latency
+        1.0
+
+        >>> for n in range(10):
+        ...     _ = limiter.wait()
+        >>> print('%.2f' % limiter.wait())
+        sleeping 0.40 seconds
+        0.40
+
+    and they recover slowly once the latency is below the target
+
+        >>> limiter._clock.now = 10.0
+        >>> limiter.reportLatency(0.0)
+        >>> print('%.2f %.2f' % (limiter.latency, limiter.factor))
+        0.50 0.35
+        >>> limiter._clock.now = 11.0
+        >>> limiter.reportLatency(0.0)
+        >>> print('%.2f %.2f' % (limiter.latency, limiter.factor))
+        0.25 0.45
+
+    """
+
+
+def doctest_BackgroundWorkerThread_write_limiter():
+    """Test for BackgroundWorkerThread with a write limiter
+
+        >>> db, conn = createDatabase()
+        >>> worker = WorkerForTest.forSite(conn.root()['site'], 'admin')
+        >>> worker.write_limiter = limiter = createLimiter(
+        ...     Budget(commit_rate=1, byte_rate=1e6))
+        >>> logbuf = testing.setUpLogging(log)
+
+    Every commit waits for write budget, and what it writes is accounted
+    for
+
+        >>> worker.run()
+        sleeping 1.00 seconds
+
+    Read-only iterations don't wait
+
+        >>> stats = limiter.stats()['WorkerForTest']
+        >>> stats['commits'], stats['waits'], stats['waited']
+        (2, 1, 1.0)
+        >>> stats['bytes_written'] > 1000
+        True
+
+        >>> print(logbuf.getvalue())
+        <BLANKLINE>
+
+        >>> db.close()
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    testing.tearDownLogging(log)
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown)
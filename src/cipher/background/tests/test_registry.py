@@ -0,0 +1,166 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+import gc
+import pprint
+
+import transaction
+from zope.component.hooks import setSite
+from zope.security.management import endInteraction
+
+from cipher.background import testing
+from cipher.background.outbox import Outbox
+from cipher.background.registry import WorkerRegistry, registry
+from cipher.background.testing import FakeClock, SiteStub
+from cipher.background.thread import BackgroundWorkerThread, log
+
+
+class WorkerStub(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def getStatus(self):
+        return dict(name=self.name)
+
+
+def doctest_WorkerRegistry():
+    """Test for WorkerRegistry
+
+        >>> registry = WorkerRegistry()
+        >>> one, two = WorkerStub('one'), WorkerStub('two')
+        >>> registry.register(two)
+        >>> registry.register(one)
+        >>> registry.snapshot()
+        [{'name': 'two'}, {'name': 'one'}]
+
+        >>> registry.unregister(two)
+        >>> registry.unregister(two)
+        >>> registry.snapshot()
+        [{'name': 'one'}]
+
+    Workers are held weakly
+
+        >>> del one
+        >>> _ = gc.collect()
+        >>> registry.snapshot()
+        []
+
+    """
+
+
+class WorkerForTest(BackgroundWorkerThread):
+
+    registry = WorkerRegistry()
+    jobs = ['good job', 'bad job']
+
+    def __init__(self, *args, **kw):
+        super(WorkerForTest, self).__init__(*args, **kw)
+        self._clock = FakeClock()
+
+    def scheduleNextWork(self):
+        self.printStatus()
+        return bool(self.jobs)
+
+    def doWork(self):
+        self._clock.now += 1
+        self.current_job = self.jobs.pop(0)
+        self.printStatus()
+        if self.current_job == 'bad job':
+            raise ValueError(self.current_job)
+
+    def doCleanup(self):
+        self.printStatus()
+
+    def printStatus(self):
+        status = self.registry.snapshot()[0]
+        print('%(state)s since %(state_since)s, job %(current_job)s'
+              ' started at %(job_started)s' % status)
+
+
+def doctest_BackgroundWorkerThread_getStatus():
+    """Test for BackgroundWorkerThread.getStatus
+
+        >>> thread = WorkerForTest.forSite(SiteStub(), 'someuser')
+        >>> thread.name = 'worker'
+        >>> logbuf = testing.setUpLogging(log)
+
+        >>> thread.run()
+        scheduling since 0.0, job None started at None
+        working since 0.0, job good job started at 0.0
+        cleaning up since 1.0, job good job started at 0.0
+        scheduling since 1.0, job None started at None
+        working since 1.0, job bad job started at 1.0
+        cleaning up since 2.0, job bad job started at 1.0
+        scheduling since 2.0, job None started at None
+
+    The thread unregisters itself when it terminates
+
+        >>> thread.registry.snapshot()
+        []
+        >>> pprint.pprint(thread.getStatus())
+        {'alive': False,
+         'class_name': 'WorkerForTest',
+         'current_job': None,
+         'failures': 1,
+         'iterations': 2,
+         'job_started': None,
+         'last_error': 'ValueError: bad job',
+         'last_error_time': 2.0,
+         'name': 'worker',
+         'queue_depth': None,
+         'site_name': 'testsite',
+         'state': 'stopped',
+         'state_since': 2.0,
+         'user_name': 'someuser'}
+
+    """
+
+
+def doctest_Outbox_getStatus():
+    """Test for Outbox.getStatus
+
+        >>> outbox = Outbox(testing.TransportStub(), threads=2)
+        >>> outbox.start()
+        >>> outbox in registry.workers()
+        True
+        >>> pprint.pprint(outbox.getStatus())
+        {'class_name': 'Outbox',
+         'failed': 0,
+         'name': 'outbox (TransportStub)',
+         'queue_depth': 0,
+         'sent': 0,
+         'threads': 2}
+
+        >>> outbox.stop()
+        >>> outbox in registry.workers()
+        False
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    testing.tearDownLogging(log)
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown)
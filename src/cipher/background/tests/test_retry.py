@@ -0,0 +1,233 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+
+import transaction
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+from transaction.interfaces import TransientError
+from zope.component.hooks import getSite, setSite
+from zope.security.management import endInteraction
+
+from cipher.background import testing
+from cipher.background.contextmanagers import ZopeSite
+from cipher.background.retry import (FailedJob, RetryQueue,
+                                     RetryingWorkerThread, getRetryQueue)
+from cipher.background.testing import FakeClock, Site
+from cipher.background.thread import log
+
+
+def doctest_RetryQueue():
+    """Test for RetryQueue
+
+        >>> queue = RetryQueue()
+        >>> entry = FailedJob('job')
+        >>> queue.failed(entry, 'oops', now=100, max_attempts=3, delay=10)
+        True
+        >>> entry.attempts, entry.last_error
+        (1, 'oops')
+
+        >>> queue.nextDue()
+        110.0
+        >>> print(queue.popDue(now=105))
+        None
+        >>> queue.popDue(now=110) is entry
+        True
+
+    Every failure doubles the delay
+
+        >>> queue.failed(entry, 'oops again', now=120, max_attempts=3,
+        ...              delay=10)
+        True
+        >>> queue.nextDue()
+        140.0
+        >>> queue.popDue(now=140) is entry
+        True
+
+    After too many attempts the job becomes a dead letter
+
+        >>> queue.failed(entry, 'oops once more', now=150, max_attempts=3,
+        ...              delay=10)
+        False
+        >>> len(queue.scheduled), len(queue.dead)
+        (0, 1)
+        >>> entry.first_failure, entry.last_failure, entry.last_error
+        (100, 150, 'oops once more')
+
+    Dead letters can be replayed
+
+        >>> key = queue.dead.minKey()
+        >>> queue.replay(key, now=200) is entry
+        True
+        >>> entry.attempts
+        0
+        >>> queue.popDue(now=200) is entry
+        True
+
+    """
+
+
+def doctest_RetryQueue_max_delay():
+    """Test for RetryQueue.failed
+
+        >>> queue = RetryQueue()
+        >>> entry = FailedJob('job')
+        >>> entry.attempts = 20
+        >>> queue.failed(entry, 'oops', now=0, max_attempts=100, delay=10,
+        ...              max_delay=3600)
+        True
+        >>> queue.nextDue()
+        3600.0
+
+    """
+
+
+class RetryingWorkerThreadForTest(RetryingWorkerThread):
+
+    max_attempts = 2
+    retry_delay = 10.0
+
+    def __init__(self, *args, **kw):
+        super(RetryingWorkerThreadForTest, self).__init__(*args, **kw)
+        self._clock = FakeClock()
+
+    def getNextJob(self):
+        jobs = getSite().jobs
+        if jobs:
+            job = jobs.pop(0)
+            getSite()._p_changed = True
+            return job
+
+    def processJob(self, job):
+        print('processing %s' % job)
+        getSite().done.append(job)
+        getSite()._p_changed = True
+        if job.startswith('bad'):
+            raise ValueError(job)
+        if job.startswith('conflict'):
+            raise TransientError(job)
+
+
+def createWorker(jobs):
+    db = DB(MappingStorage())
+    conn = db.open()
+    site = conn.root()['site'] = Site()
+    site.jobs = list(jobs)
+    site.done = []
+    transaction.commit()
+    worker = RetryingWorkerThreadForTest.forSite(site, 'someuser')
+    worker.name = 'worker'
+    return worker, site
+
+
+def work(worker, site):
+    with ZopeSite(site):
+        worker.doWorkInTransaction()
+    transaction.abort()
+
+
+def doctest_RetryingWorkerThread():
+    """Test for RetryingWorkerThread.doWork
+
+        >>> worker, site = createWorker(['bad job', 'good job'])
+        >>> logbuf = testing.setUpLogging(log)
+
+    A failing job is rolled back, but removed from its source
+
+        >>> work(worker, site)
+        processing bad job
+        >>> site.jobs, site.done
+        (['good job'], [])
+
+        >>> print(logbuf.getvalue().strip()) # doctest: +ELLIPSIS
+        Job failed in worker
+        Traceback (most recent call last):
+          ...
+        ValueError: bad job
+
+    and scheduled for a retry
+
+        >>> queue = getRetryQueue(site._p_jar.root(), worker.getRetryQueueName())
+        >>> queue.nextDue()
+        10.0
+
+    Meanwhile we keep processing other jobs
+
+        >>> work(worker, site)
+        processing good job
+        >>> work(worker, site)
+        >>> site.done
+        ['good job']
+
+    When the retry is due, the job is processed again
+
+        >>> worker._clock.now = 10
+        >>> work(worker, site)
+        processing bad job
+
+    and since it failed too many times, it became a dead letter
+
+        >>> len(queue.scheduled), len(queue.dead)
+        (0, 1)
+        >>> entry = queue.dead[queue.dead.minKey()]
+        >>> entry.job, entry.attempts, entry.last_error
+        ('bad job', 2, 'ValueError: bad job')
+
+        >>> print(logbuf.getvalue().strip().splitlines()[-1])
+        Giving up on job in worker after 2 attempts
+
+        >>> site._p_jar.db().close()
+
+    """
+
+
+def doctest_RetryingWorkerThread_conflicts():
+    """Test for RetryingWorkerThread.doWork
+
+        >>> worker, site = createWorker(['conflict'])
+        >>> logbuf = testing.setUpLogging(log)
+
+    Conflicts abort the transaction, so the job stays in its source
+
+        >>> work(worker, site) # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+          ...
+        TransientError: conflict
+
+        >>> site.jobs
+        ['conflict']
+        >>> queue = getRetryQueue(site._p_jar.root(), worker.getRetryQueueName())
+        >>> transaction.abort()
+        >>> len(queue.scheduled)
+        0
+
+        >>> site._p_jar.db().close()
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    testing.tearDownLogging(log)
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown)
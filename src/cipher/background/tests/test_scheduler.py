@@ -0,0 +1,229 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+import threading
+import time
+
+import transaction
+from zope.component.hooks import setSite
+from zope.security.management import endInteraction
+
+from cipher.background.scheduler import (FairScheduler, FairShareWorkerThread,
+                                         Quota)
+from cipher.background.testing import FakeClock, SiteStub
+
+
+def waitFor(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.001)
+
+
+def runJobs(scheduler, jobs):
+    """Queue jobs for a full scheduler, then return the order they ran in.
+
+    ``jobs`` is a list of (site_name, user_name, job name, cost).
+    """
+    order = []
+    scheduler.capacity = 1
+    scheduler.acquire('admin', 'admin')
+
+    def job(site_name, user_name, name, cost):
+        with scheduler.slot(site_name, user_name, cost):
+            order.append(name)
+
+    threads = []
+    for n, args in enumerate(jobs):
+        thread = threading.Thread(target=job, args=args)
+        thread.start()
+        threads.append(thread)
+        waitFor(lambda: sum(waiting for running, waiting, served
+                            in scheduler.stats().values()) == n + 1)
+    scheduler.release('admin', 'admin')
+    for thread in threads:
+        thread.join()
+    return order
+
+
+def doctest_FairScheduler():
+    """Test for FairScheduler
+
+    Tenants take turns, no matter how much work each of them queues
+
+        >>> scheduler = FairScheduler()
+        >>> runJobs(scheduler, [('a', 'u', 'a1', 1), ('a', 'u', 'a2', 1),
+        ...                     ('a', 'u', 'a3', 1), ('b', 'u', 'b1', 1),
+        ...                     ('b', 'v', 'bv1', 1), ('b', 'u', 'b2', 1)])
+        ['a1', 'b1', 'bv1', 'a2', 'b2', 'a3']
+
+        >>> sorted(scheduler.stats().items())
+        [(('a', 'u'), (0, 0, 3)), (('admin', 'admin'), (0, 0, 1)),
+         (('b', 'u'), (0, 0, 2)), (('b', 'v'), (0, 0, 1))]
+
+    """
+
+
+def doctest_FairScheduler_weights():
+    """Test for FairScheduler
+
+    Tenants with a higher weight get more turns
+
+        >>> scheduler = FairScheduler()
+        >>> scheduler.setQuota('a', quota=Quota(weight=2))
+        >>> runJobs(scheduler, [('a', 'u', 'a1', 1), ('a', 'u', 'a2', 1),
+        ...                     ('a', 'u', 'a3', 1), ('a', 'u', 'a4', 1),
+        ...                     ('b', 'u', 'b1', 1), ('b', 'u', 'b2', 1)])
+        ['a1', 'a2', 'b1', 'a3', 'a4', 'b2']
+
+    and expensive work takes more turns
+
+        >>> scheduler = FairScheduler()
+        >>> runJobs(scheduler, [('a', 'u', 'a1', 3), ('a', 'u', 'a2', 1),
+        ...                     ('b', 'u', 'b1', 1), ('b', 'u', 'b2', 1),
+        ...                     ('b', 'u', 'b3', 1)])
+        ['b1', 'b2', 'a1', 'b3', 'a2']
+
+    Weights must be positive, or the tenant would never get a turn
+
+        >>> Quota(weight=0)
+        Traceback (most recent call last):
+          ...
+        ValueError: weight must be positive, got 0
+        >>> Quota(weight=-1)
+        Traceback (most recent call last):
+          ...
+        ValueError: weight must be positive, got -1
+
+    """
+
+
+def doctest_FairScheduler_max_concurrent():
+    """Test for FairScheduler
+
+        >>> scheduler = FairScheduler(capacity=3)
+        >>> scheduler.setQuota('a', 'u', Quota(max_concurrent=2))
+
+        >>> scheduler.acquire('a', 'u', timeout=0)
+        True
+        >>> scheduler.acquire('a', 'u', timeout=0)
+        True
+
+    The tenant has used up its share, but others can still get slots
+
+        >>> scheduler.acquire('a', 'u', timeout=0)
+        False
+        >>> scheduler.acquire('a', 'v', timeout=0)
+        True
+
+        >>> scheduler.release('a', 'u')
+        >>> scheduler.acquire('a', 'u', timeout=0)
+        True
+
+    """
+
+
+def doctest_FairScheduler_rate():
+    """Test for FairScheduler
+
+        >>> scheduler = FairScheduler(capacity=10)
+        >>> scheduler._clock = FakeClock()
+        >>> scheduler.setQuota('a', quota=Quota(rate=0.5, burst=2))
+
+        >>> [scheduler.acquire('a', 'u', timeout=0) for n in range(3)]
+        [True, True, False]
+
+    Tokens are refilled over time
+
+        >>> scheduler._clock.now = 1.0
+        >>> scheduler.acquire('a', 'u', timeout=0)
+        False
+        >>> scheduler._clock.now = 2.0
+        >>> scheduler.acquire('a', 'u', timeout=0)
+        True
+
+    Work more expensive than the burst size is allowed, but incurs a debt
+
+        >>> scheduler._clock.now = 10.0
+        >>> scheduler.acquire('a', 'u', cost=4, timeout=0)
+        True
+        >>> scheduler._clock.now = 13.0
+        >>> scheduler.acquire('a', 'u', timeout=0)
+        False
+        >>> scheduler._clock.now = 16.0
+        >>> scheduler.acquire('a', 'u', timeout=0)
+        True
+
+    """
+
+
+def doctest_FairScheduler_rate_waits():
+    """Test for FairScheduler
+
+        >>> scheduler = FairScheduler()
+        >>> scheduler.setQuota('a', quota=Quota(rate=100))
+        >>> scheduler.acquire('a', 'u')
+        True
+
+    Waiters wake up when tokens get refilled
+
+        >>> start = time.time()
+        >>> scheduler.acquire('a', 'u')
+        True
+        >>> time.time() - start > 0.005
+        True
+
+    """
+
+
+class WorkerForTest(FairShareWorkerThread):
+
+    iterations = 1
+
+    def scheduleNextWork(self):
+        self.iterations -= 1
+        return self.iterations >= 0
+
+    def doWork(self):
+        print(self.scheduler.stats())
+
+
+def doctest_FairShareWorkerThread():
+    """Test for FairShareWorkerThread
+
+        >>> site = SiteStub()
+        >>> thread = WorkerForTest.forSite(site, 'someuser')
+        >>> thread.scheduler = FairScheduler()
+        >>> thread.run()
+        {('testsite', 'someuser'): (1, 0, 1)}
+
+        >>> thread.scheduler.stats()
+        {('testsite', 'someuser'): (0, 0, 1)}
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown,
+                                optionflags=doctest.NORMALIZE_WHITESPACE)
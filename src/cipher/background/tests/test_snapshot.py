@@ -0,0 +1,173 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+import threading
+
+import transaction
+from zope.component.hooks import getSite, setSite
+from zope.security.management import endInteraction
+
+from cipher.background import testing
+from cipher.background.snapshot import SnapshotWorkerThread
+from cipher.background.testing import createDatabase
+from cipher.background.thread import log
+
+
+class SnapshotWorkerThreadForTest(SnapshotWorkerThread):
+
+    def __init__(self, *args, **kw):
+        super(SnapshotWorkerThreadForTest, self).__init__(*args, **kw)
+        self._tasks = [None]
+        self.scanned_by = set()
+
+    def scheduleNextWork(self):
+        return bool(self._tasks and self._tasks.pop())
+
+    def getChunks(self):
+        keys = sorted(getSite().values)
+        return [keys[n:n + 3] for n in range(0, len(keys), 3)]
+
+    def scanChunk(self, chunk):
+        self.scanned_by.add(threading.current_thread().name)
+        values = getSite().values
+        return sum(values[key] for key in chunk)
+
+    def compute(self, data):
+        return sum(data)
+
+    def applyResult(self, data, result):
+        getSite().total = result
+
+
+def doctest_SnapshotWorkerThread():
+    """Test for SnapshotWorkerThread
+
+        >>> db, conn = createDatabase(values=dict((n, n) for n in range(10)))
+        >>> site = conn.root()['site']
+        >>> thread = SnapshotWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread._tasks = [True]
+        >>> thread.run()
+
+        >>> transaction.abort()
+        >>> site.total
+        45
+        >>> thread.snapshot == db.lastTransaction()
+        False
+
+    The report is stored in a separate transaction made after the snapshot
+
+        >>> [h['description'] for h in db.history(site._p_oid, size=2)]
+        ['background worker thread (SnapshotWorkerThreadForTest) for testsite', '']
+
+        >>> db.close()
+
+    """
+
+
+def doctest_SnapshotWorkerThread_snapshot_at():
+    """Test for SnapshotWorkerThread
+
+        >>> db, conn = createDatabase(values=dict((n, n) for n in range(10)))
+        >>> site = conn.root()['site']
+        >>> tid = db.lastTransaction()
+
+        >>> site.values[100] = 100
+        >>> site._p_changed = True
+        >>> transaction.commit()
+
+    You can produce a report as of a given transaction
+
+        >>> thread = SnapshotWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.snapshot_at = tid
+        >>> thread._tasks = [True]
+        >>> thread.run()
+
+        >>> transaction.abort()
+        >>> site.total
+        45
+
+        >>> db.close()
+
+    """
+
+
+def doctest_SnapshotWorkerThread_scan_threads():
+    """Test for SnapshotWorkerThread
+
+        >>> db, conn = createDatabase(values=dict((n, n) for n in range(10)))
+        >>> site = conn.root()['site']
+        >>> thread = SnapshotWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.name = 'reporter'
+        >>> thread.scan_threads = 2
+        >>> thread._tasks = [True]
+        >>> thread.run()
+
+        >>> transaction.abort()
+        >>> site.total
+        45
+        >>> thread.scanned_by <= set(['reporter scanner 0',
+        ...                           'reporter scanner 1'])
+        True
+
+        >>> db.close()
+
+    """
+
+
+def doctest_SnapshotWorkerThread_scan_errors():
+    """Test for SnapshotWorkerThread
+
+        >>> db, conn = createDatabase(values=dict((n, n) for n in range(10)))
+        >>> site = conn.root()['site']
+        >>> thread = SnapshotWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.name = 'reporter'
+        >>> thread.scan_threads = 3
+        >>> thread._tasks = [True]
+        >>> def scanChunk(chunk):
+        ...     raise Exception('something happened')
+        >>> thread.scanChunk = scanChunk
+
+        >>> logbuf = testing.setUpLogging(log)
+        >>> thread.run()
+
+    Errors in scanner threads are reported by the worker
+
+        >>> print(logbuf.getvalue().strip()) # doctest: +ELLIPSIS
+        Exception in reporter
+        Traceback (most recent call last):
+          ...
+        Exception: something happened
+
+        >>> transaction.abort()
+        >>> getattr(site, 'total', None)
+
+        >>> db.close()
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    testing.tearDownLogging(log)
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown)
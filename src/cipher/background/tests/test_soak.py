@@ -0,0 +1,211 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+import os
+import shutil
+import tempfile
+
+import transaction
+from ZODB.FileStorage import FileStorage
+from ZODB.MappingStorage import MappingStorage
+from ZODB.POSException import StorageError
+from zope.component.hooks import setSite
+from zope.security.management import endInteraction
+
+from cipher.background import testing
+from cipher.background.soak import (Faults, FaultInjectingStorage,
+                                    SoakHarness, SoakResult, SoakWorker)
+from cipher.background.thread import log
+
+
+def doctest_Faults():
+    """Test for Faults
+
+        >>> faults = Faults(conflict_rate=1.0, load_error_rate=0.5, seed=42)
+        >>> faults.happens('conflict')
+        True
+        >>> faults.happens('commit_error')
+        False
+        >>> n = sum(faults.happens('load_error') for i in range(1000))
+        >>> 400 < n < 600
+        True
+        >>> faults.injected['conflict']
+        1
+
+    """
+
+
+def doctest_FaultInjectingStorage():
+    """Test for FaultInjectingStorage
+
+        >>> faults = Faults(conflict_rate=1.0, load_error_rate=1.0,
+        ...                 commit_error_rate=1.0)
+        >>> storage = FaultInjectingStorage(MappingStorage(), faults)
+
+    Faults are injected only while enabled
+
+        >>> storage.loadBefore(b'\\0' * 8, b'\\xff' * 8)
+        Traceback (most recent call last):
+          ...
+        ZODB.POSException.POSKeyError: 0x00
+
+        >>> storage.enabled = True
+        >>> storage.loadBefore(b'\\0' * 8, b'\\xff' * 8)
+        Traceback (most recent call last):
+          ...
+        ZODB.POSException.StorageError: injected load error
+        >>> storage.store(b'\\0' * 8, None, b'', '', None)
+        Traceback (most recent call last):
+          ...
+        ZODB.POSException.ConflictError: injected conflict (oid 0x00)
+        >>> storage.tpc_vote(None)
+        Traceback (most recent call last):
+          ...
+        ZODB.POSException.StorageError: injected commit error
+
+    """
+
+
+def doctest_SoakResult():
+    """Test for SoakResult
+
+        >>> result = SoakResult(jobs=5, elapsed=2.0,
+        ...                     latencies=[0.5, 0.1, 0.2, 0.4, 0.3],
+        ...                     retries=3, given_up=0, lost=0, duplicated=0,
+        ...                     opened=10, closed=9, injected={'conflict': 3})
+        >>> print(result.report())
+        jobs:           5
+        committed:      5
+        retries:        3
+        given up:       0
+        lost:           0
+        duplicated:     0
+        throughput:     2.5 jobs/s
+        latency p50:    300.0 ms
+        latency p95:    500.0 ms
+        latency p99:    500.0 ms
+        connections:    10 opened, 9 closed, 1 leaked
+        injected:       3 conflict
+
+    """
+
+
+def doctest_SoakHarness():
+    """Test for SoakHarness
+
+        >>> logbuf = testing.setUpLogging(log)
+        >>> faults = Faults(conflict_rate=0.05, load_error_rate=0.02,
+        ...                 commit_error_rate=0.02, slow_commit_rate=0.02,
+        ...                 slow_commit_delay=0.001, cleanup_error_rate=0.05,
+        ...                 seed=1)
+        >>> harness = SoakHarness(workers=4, jobs=100, faults=faults)
+        >>> result = harness.run()
+
+    Every job gets committed exactly once, despite the faults
+
+        >>> len(result.latencies), result.lost, result.duplicated
+        (100, 0, 0)
+        >>> result.retries > 0
+        True
+
+    and no connections leak
+
+        >>> result.leaked
+        0
+
+    """
+
+
+class SiteLoadErrorWorker(SoakWorker):
+
+    def getSite(self, connection):
+        if self.harness.faults.happens('load_error'):
+            raise StorageError('injected load error')
+        return super(SiteLoadErrorWorker, self).getSite(connection)
+
+
+def doctest_SoakHarness_load_errors():
+    """Test for SoakHarness
+
+        >>> logbuf = testing.setUpLogging(log)
+        >>> faults = Faults(load_error_rate=0.3, seed=1)
+        >>> harness = SoakHarness(workers=2, jobs=20, faults=faults,
+        ...                       max_attempts=100)
+        >>> harness.worker_class = SiteLoadErrorWorker
+        >>> result = harness.run()
+
+    Load errors can happen outside the work transaction (e.g. while loading
+    the site); those jobs are retried too
+
+        >>> len(result.latencies), result.lost, result.duplicated
+        (20, 0, 0)
+        >>> result.retries > 0, result.leaked
+        (True, 0)
+
+    """
+
+
+def doctest_SoakHarness_timeout():
+    """Test for SoakHarness
+
+        >>> logbuf = testing.setUpLogging(log)
+        >>> harness = SoakHarness(workers=2, jobs=10, timeout=0)
+        >>> result = harness.run()
+
+    Jobs that don't get done before the deadline are reported as lost
+    instead of making us wait forever
+
+        >>> len(result.latencies), result.lost
+        (0, 10)
+
+    """
+
+
+def doctest_SoakHarness_FileStorage():
+    """Test for SoakHarness
+
+        >>> logbuf = testing.setUpLogging(log)
+        >>> tmpdir = tempfile.mkdtemp()
+        >>> storage = FileStorage(os.path.join(tmpdir, 'Data.fs'))
+        >>> faults = Faults(conflict_rate=0.5, seed=1)
+        >>> harness = SoakHarness(storage, workers=2, jobs=20, faults=faults,
+        ...                       max_attempts=1)
+        >>> result = harness.run()
+
+    Jobs that fail too many times are given up on, but not lost
+
+        >>> result.given_up > 0, result.lost, result.duplicated
+        (True, 0, 0)
+        >>> len(result.latencies) + result.given_up
+        20
+
+        >>> shutil.rmtree(tmpdir)
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    testing.tearDownLogging(log)
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown)
@@ -13,46 +13,17 @@
 ##############################################################################
 from __future__ import print_function
 import doctest
+import logging
 
 import transaction
 from zope.component.hooks import getSite, setSite
 from zope.security.management import queryInteraction, endInteraction
 
 from cipher.background import testing
+from cipher.background.testing import SiteStub
 from cipher.background.thread import BackgroundWorkerThread, log
 
 
-class SiteStub(object):
-    __name__ = 'testsite'
-    def __init__(self):
-        self._p_jar = ConnectionStub(DbStub())
-        self._p_oid = 42
-        self._p_jar._db._objects[self._p_oid] = self
-        self.patients = {}
-    def getSiteManager(self):
-        return None
-
-class ConnectionStub(object):
-    def __init__(self, db, verbose=False):
-        self._db = db
-        self._db.opened += 1
-        self._verbose = verbose
-    def db(self):
-        return self._db
-    def get(self, oid):
-        return self._db._objects[oid]
-    def close(self):
-        self._db.closed += 1
-
-class DbStub(object):
-    opened = closed = 0
-    def __init__(self, verbose=False):
-        self._verbose = verbose
-        self._objects = {}
-    def open(self):
-        return ConnectionStub(self, verbose=self._verbose)
-
-
 class BackgroundWorkerThreadForTest(BackgroundWorkerThread):
 
     def __init__(self, *args, **kw):
@@ -259,6 +230,39 @@ def doctest_BackgroundWorkerThread_run_outer_exception_handling():
     """
 
 
+def doctest_BackgroundWorkerThread_run_setup_exception_handling():
+    """Test for BackgroundWorkerThread.run
+
+        >>> site = SiteStub()
+        >>> thread = BackgroundWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread.name = 'this thread'
+
+        >>> logbuf = testing.setUpLogging(log)
+
+    What if an exception happens before we get a working connection (e.g.
+    the storage is down)?
+
+        >>> def prepareWork(self):
+        ...     raise Exception('storage is down')
+        >>> thread.prepareWork = prepareWork.__get__(thread)
+
+        >>> thread.run()
+
+    The thread is terminated rather than retrying in a tight loop (see
+    CircuitBreakerWorkerThread for a thread that backs off instead)
+
+        >>> print(logbuf.getvalue().strip()) # doctest: +ELLIPSIS
+        scheduling a task
+        Exception in this thread, thread terminated
+        Traceback (most recent call last):
+          ...
+        Exception: storage is down
+
+        >>> testing.tearDownLogging(log)
+
+    """
+
+
 def doctest_BackgroundWorkerThread_scheduleNextWork():
     """Test for BackgroundWorkerThread.scheduleNextWork
 
@@ -273,6 +277,38 @@ def doctest_BackgroundWorkerThread_scheduleNextWork():
     """
 
 
+def doctest_BackgroundWorkerThread_run_prefetch():
+    """Test for BackgroundWorkerThread.run
+
+        >>> site = SiteStub()
+        >>> thread = BackgroundWorkerThreadForTest.forSite(site, 'someuser')
+        >>> thread._tasks = [None]
+
+    (the connection stub logs to cipher.background.testing)
+
+        >>> logger = logging.getLogger('cipher.background')
+        >>> logbuf = testing.setUpLogging(logger)
+
+    Objects the job needs are prefetched when the connection is opened,
+    and objects the next job will need before doWork() is called
+
+        >>> thread.getPrefetchOids = lambda: [1, 2]
+        >>> thread.getNextPrefetchOids = lambda: [3]
+        >>> thread.doWork = lambda: log.info('working')
+        >>> thread.run()
+
+        >>> print(logbuf.getvalue().strip())
+        scheduling a task
+        prefetching [1, 2]
+        prefetching [3]
+        working
+        no tasks left to schedule
+
+        >>> testing.tearDownLogging(logger)
+
+    """
+
+
 def setUp(test):
     pass
 
@@ -0,0 +1,276 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+import itertools
+import json
+import os
+import shutil
+import tempfile
+
+import transaction
+from persistent.list import PersistentList
+from zope.component.hooks import getSite, setSite
+from zope.security.management import endInteraction
+
+from cipher.background import testing
+from cipher.background.testing import FakeClock, createDatabase
+from cipher.background.thread import BackgroundWorkerThread, log
+from cipher.background.tracing import (FileExporter, InMemoryExporter, Span,
+                                       Traced, Tracer)
+
+
+def createTracer(exporter=None):
+    tracer = Tracer(exporter)
+    tracer._clock = FakeClock()
+    ids = itertools.count(1)
+    tracer.newId = lambda: 'id%d' % next(ids)
+    return tracer
+
+
+def printTrace(spans):
+    for span in spans:
+        line = '%-18s %-4s parent %-4s %s..%s %s' % (
+            span.name, span.span_id, span.parent_id, span.start, span.end,
+            ' '.join('%s=%s' % item
+                     for item in sorted(span.attributes.items())))
+        print(line.rstrip())
+
+
+class WorkerForTest(BackgroundWorkerThread):
+
+    jobs = 2
+
+    def __init__(self, *args, **kw):
+        super(WorkerForTest, self).__init__(*args, **kw)
+        self._clock = FakeClock()
+
+    def scheduleNextWork(self):
+        return self.iteration_count < self.jobs
+
+    def doWork(self):
+        self._clock.now += 1
+        traced = getSite()._p_jar.root()['jobs'].pop(0)
+        self.traceJob(traced.context)
+        self.current_job = traced.job
+        self._clock.now += 2
+        if traced.job == 'bad job':
+            raise ValueError(traced.job)
+
+    def doCleanup(self):
+        self._clock.now += 1
+
+
+def doctest_Tracer_enqueue():
+    """Test for Tracer.enqueue
+
+        >>> tracer = createTracer()
+        >>> context = tracer.enqueue(txn=transaction.get(), queue='jobs')
+        >>> context
+        <TraceContext id1/id2>
+        >>> context.enqueued
+        0.0
+
+    The enqueue span is finished when the transaction commits
+
+        >>> tracer._clock.now = 0.5
+        >>> transaction.commit()
+        >>> printTrace(tracer.exporter.spans)
+        enqueue            id2  parent None 0.0..0.5 queue=jobs
+
+    and forgotten if it's aborted
+
+        >>> tracer.exporter.clear()
+        >>> context = tracer.enqueue()
+        >>> transaction.abort()
+        >>> tracer.exporter.spans
+        []
+
+    """
+
+
+def doctest_BackgroundWorkerThread_tracing():
+    """Test for BackgroundWorkerThread with a tracer
+
+        >>> db, conn = createDatabase()
+        >>> tracer = createTracer()
+        >>> conn.root()['jobs'] = PersistentList(
+        ...     [Traced('good job', tracer.enqueue()),
+        ...      Traced('bad job', tracer.enqueue())])
+        >>> tracer._clock.now = 0.5
+        >>> transaction.commit()
+
+        >>> worker = WorkerForTest.forSite(conn.root()['site'], 'admin')
+        >>> worker.name = 'worker'
+        >>> worker._clock.now = 10
+        >>> worker.tracer = tracer
+        >>> logbuf = testing.setUpLogging(log)
+        >>> worker.run()
+
+    We can tell how long every job waited and where the time was spent
+
+        >>> printTrace(tracer.exporter.trace('id1'))
+        enqueue            id2  parent None 0.0..0.5
+        queue wait         id9  parent id2  0.0..10
+        iteration          id6  parent id2  10..14 job=good job thread_name=worker
+        opening connection id7  parent id6  10..10
+        working            id8  parent id6  10..13
+        committing         id10 parent id6  13..13
+        cleaning up        id11 parent id6  13..14
+
+        >>> printTrace(tracer.exporter.trace('id3'))
+        enqueue            id4  parent None 0.0..0.5
+        queue wait         id16 parent id4  0.0..14
+        iteration          id13 parent id4  14..18 error=ValueError: bad job job=bad job thread_name=worker
+        opening connection id14 parent id13 14..14
+        working            id15 parent id13 14..17
+        cleaning up        id17 parent id13 17..18
+
+    The trace id is stored in the extended info of the work transaction
+    (the other transaction was aborted, and the cleanup ones didn't change
+    anything)
+
+        >>> for txn in db.storage.iterator():
+        ...     print(txn.extension.get('trace_id'))
+        None
+        None
+        None
+        id1
+
+        >>> db.close()
+
+    """
+
+
+def doctest_BackgroundWorkerThread_tracing_untraced_jobs():
+    """Test for BackgroundWorkerThread with a tracer
+
+    Iterations that don't get a trace context start a trace of their own
+
+        >>> db, conn = createDatabase()
+        >>> conn.root()['jobs'] = PersistentList([Traced('job', None)])
+        >>> transaction.commit()
+
+        >>> worker = WorkerForTest.forSite(conn.root()['site'], 'admin')
+        >>> worker.name = 'worker'
+        >>> worker.jobs = 1
+        >>> worker.tracer = tracer = createTracer()
+        >>> worker.run()
+        >>> printTrace(tracer.exporter.trace('id1'))
+        iteration          id2  parent None 0.0..4.0 job=job thread_name=worker
+        opening connection id3  parent id2  0.0..0.0
+        working            id4  parent id2  0.0..3.0
+        committing         id5  parent id2  3.0..3.0
+        cleaning up        id6  parent id2  3.0..4.0
+
+        >>> db.close()
+
+    """
+
+
+class BrokenExporter(object):
+
+    def export(self, spans):
+        raise RuntimeError('disk full')
+
+
+def doctest_BackgroundWorkerThread_tracing_export_errors():
+    """Test for BackgroundWorkerThread with a tracer
+
+        >>> db, conn = createDatabase()
+        >>> conn.root()['jobs'] = PersistentList([Traced('job1', None),
+        ...                                       Traced('job2', None)])
+        >>> transaction.commit()
+
+        >>> worker = WorkerForTest.forSite(conn.root()['site'], 'admin')
+        >>> worker.name = 'worker'
+        >>> worker.tracer = createTracer(BrokenExporter())
+        >>> logbuf = testing.setUpLogging(log)
+
+    Errors in the exporter are logged, but don't stop the thread
+
+        >>> worker.run()
+        >>> worker.iteration_count, worker.failure_count
+        (2, 0)
+        >>> print(logbuf.getvalue()) # doctest: +ELLIPSIS
+        Could not export trace in worker
+        Traceback (most recent call last):
+          ...
+        RuntimeError: disk full
+        Could not export trace in worker
+        Traceback (most recent call last):
+          ...
+        RuntimeError: disk full
+        <BLANKLINE>
+
+        >>> transaction.abort()
+        >>> list(conn.root()['jobs'])
+        []
+
+        >>> db.close()
+
+    """
+
+
+def doctest_InMemoryExporter():
+    """Test for InMemoryExporter
+
+        >>> exporter = InMemoryExporter(max_spans=3)
+        >>> exporter.export([Span('t1', 's%d' % n, None, 'queue wait', 0, n)
+        ...                  for n in range(5)])
+        >>> exporter.spans
+        [<Span queue wait 0+2>, <Span queue wait 0+3>, <Span queue wait 0+4>]
+        >>> exporter.durations('queue wait')
+        [2, 3, 4]
+        >>> exporter.durations('iteration')
+        []
+
+    """
+
+
+def doctest_FileExporter():
+    """Test for FileExporter
+
+        >>> tmpdir = tempfile.mkdtemp(prefix='cipher.background-test-')
+        >>> filename = os.path.join(tmpdir, 'traces.jsonl')
+        >>> exporter = FileExporter(filename)
+        >>> exporter.export([Span('t1', 's1', None, 'enqueue', 0, 1),
+        ...                  Span('t1', 's2', 's1', 'queue wait', 0, 5,
+        ...                       dict(queue='jobs'))])
+        >>> exporter.export([])
+
+        >>> with open(filename) as f:
+        ...     for line in f:
+        ...         print(sorted(json.loads(line).items()))
+        [('attributes', {}), ('end', 1), ('name', 'enqueue'), ('parent_id', None), ('span_id', 's1'), ('start', 0), ('trace_id', 't1')]
+        [('attributes', {'queue': 'jobs'}), ('end', 5), ('name', 'queue wait'), ('parent_id', 's1'), ('span_id', 's2'), ('start', 0), ('trace_id', 't1')]
+
+        >>> shutil.rmtree(tmpdir)
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    testing.tearDownLogging(log)
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown)
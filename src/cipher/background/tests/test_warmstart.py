@@ -0,0 +1,160 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+from __future__ import print_function
+import doctest
+import os
+import shutil
+import tempfile
+
+import transaction
+from ZODB.utils import p64
+from zope.component.hooks import getSite, setSite
+from zope.security.management import endInteraction
+
+from cipher.background.testing import Site, createDatabase
+from cipher.background.warmstart import (HotOids, WarmStartWorkerThread,
+                                         warmUp)
+
+
+def doctest_HotOids():
+    """Test for HotOids
+
+        >>> hot = HotOids(max_size=2)
+        >>> hot.record([p64(1), p64(2)])
+        >>> hot.record([p64(2), p64(3)])
+        >>> hot.record([p64(3)])
+        >>> [oid.lstrip(b'\\0') for oid in hot.top()]
+        [b'\\x02', b'\\x03']
+
+    When there are too many OIDs, the least loaded ones are forgotten
+
+        >>> hot.record([p64(4), p64(5)])
+        >>> len(hot.counts)
+        2
+        >>> [oid.lstrip(b'\\0') for oid in hot.top()]
+        [b'\\x02', b'\\x03']
+
+    The counts can be saved and loaded
+
+        >>> tmpdir = tempfile.mkdtemp()
+        >>> filename = os.path.join(tmpdir, 'hot-oids.json')
+        >>> hot.save(filename)
+        >>> other = HotOids()
+        >>> other.load(filename)
+        >>> other.counts == hot.counts
+        True
+
+    Missing or broken files are ignored
+
+        >>> with open(filename, 'w') as f:
+        ...     _ = f.write('garbage')
+        >>> other.load(filename)
+        >>> other.load(os.path.join(tmpdir, 'nosuchfile'))
+
+        >>> shutil.rmtree(tmpdir)
+
+    """
+
+
+def doctest_warmUp():
+    """Test for warmUp
+
+        >>> db, conn = createDatabase(data=[Site() for n in range(3)])
+        >>> oids = [obj._p_oid for obj in conn.root()['site'].data]
+        >>> conn.close()
+        >>> conn = db.open()
+        >>> conn.cacheMinimize()
+        >>> [conn.get(oid)._p_status for oid in oids]
+        ['ghost', 'ghost', 'ghost']
+
+        >>> warmUp(conn, oids + [p64(1000)])
+        3
+        >>> [conn.get(oid)._p_status for oid in oids]
+        ['saved', 'saved', 'saved']
+
+        >>> warmUp(conn, [])
+        0
+
+        >>> conn.close()
+        >>> db.close()
+
+    """
+
+
+class WorkerForTest(WarmStartWorkerThread):
+
+    iterations = 1
+
+    def scheduleNextWork(self):
+        self.iterations -= 1
+        return self.iterations >= 0
+
+    def doWork(self):
+        for obj in getSite().data[:2]:
+            obj._p_activate()
+
+
+def doctest_WarmStartWorkerThread():
+    """Test for WarmStartWorkerThread
+
+        >>> db, conn = createDatabase(data=[Site() for n in range(3)])
+        >>> oids = [obj._p_oid for obj in conn.root()['site'].data]
+        >>> conn.close()
+        >>> tmpdir = tempfile.mkdtemp()
+        >>> filename = os.path.join(tmpdir, 'hot-oids.json')
+
+        >>> db.cacheMinimize()
+        >>> thread = WorkerForTest(db, p64(1), 'site', 'someuser')
+        >>> thread.hot_oids_file = filename
+        >>> thread.run()
+
+    The objects loaded by doWork() were recorded and saved
+
+        >>> set(oids[:2]) <= set(thread.hot_oids.top())
+        True
+        >>> oids[2] in thread.hot_oids.top()
+        False
+        >>> os.path.exists(filename)
+        True
+
+    The next worker loads them before doing any work
+
+        >>> db.cacheMinimize()
+        >>> WorkerForTest.hot_oids_file = filename
+        >>> thread = WorkerForTest(db, p64(1), 'site', 'someuser')
+        >>> del WorkerForTest.hot_oids_file
+        >>> conn = db.open()
+        >>> site = thread.getSite(conn)
+        >>> [conn.get(oid)._p_status for oid in oids]
+        ['saved', 'saved', 'ghost']
+
+        >>> conn.close()
+        >>> db.close()
+        >>> shutil.rmtree(tmpdir)
+
+    """
+
+
+def setUp(test):
+    pass
+
+
+def tearDown(test):
+    setSite(None)
+    endInteraction()
+    transaction.abort()
+
+
+def test_suite():
+    return doctest.DocTestSuite(setUp=setUp, tearDown=tearDown)
@@ -11,16 +11,33 @@
 # FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
+import sys
 import threading
 import logging
+import time
+from contextlib import contextmanager
 
-from .contextmanagers import (ZopeInteraction, ZodbConnection, ZopeSite,
-                              ZopeTransaction)
+from zope.component import hooks
+
+from .contextmanagers import (CurrentTransactionManager, ZopeInteraction,
+                              ZodbConnection, ZopeSite, ZopeTransaction)
+from .registry import (CLEANING_UP, COMMITTING, IDLE, OPENING, SCHEDULING,
+                       STOPPED, THROTTLED, WORKING, registry)
 
 
 log = logging.getLogger(__name__)
 
 
+@contextmanager
+def _nothing():
+    yield
+
+
+def _describeException():
+    exc_type, exc_value = sys.exc_info()[:2]
+    return '%s: %s' % (exc_type.__name__, exc_value)
+
+
 class BackgroundWorkerThread(threading.Thread):
     """A background thread that can access the ZODB and a local site.
 
@@ -45,6 +62,44 @@ class BackgroundWorkerThread(threading.Thread):
 
     log = log  # let subclasses use a different logger if they want
 
+    registry = registry
+
+    # Use a private transaction manager instead of the thread's one; it is
+    # also made the current one while doing work (see multiplex)
+    transaction_manager = None
+
+    # Introspection (see getStatus()); subclasses can set current_job to a
+    # short description of the job they're working on, and queue_depth to
+    # the number of jobs waiting, if they know it cheaply
+    state = IDLE
+    state_since = None
+    current_job = None
+    job_started = None
+    iteration_count = 0
+    failure_count = 0
+    last_error = None
+    last_error_time = None
+    queue_depth = None
+
+    _clock = staticmethod(time.time)
+
+    # Set to a ResourceAccounting (see cipher.background.accounting) to
+    # record the resources used by every iteration
+    accounting = None
+
+    # Set to a Tracer (see cipher.background.tracing) to record the time
+    # spent in every state of every iteration; trace is the IterationTrace
+    # of the iteration in progress
+    tracer = None
+    trace = None
+
+    # Set to a WriteRateLimiter (see cipher.background.ratelimit) to wait
+    # for write budget before every commit; set it on BackgroundWorkerThread
+    # itself to throttle all the worker threads in the process;
+    # throttle_time is the number of seconds the last commit waited for it
+    write_limiter = None
+    throttle_time = 0
+
     def __init__(self, site_db, site_oid, site_name, user_name, daemon=True):
         """Create a thread."""
         self.site_db = site_db
@@ -92,34 +147,205 @@ class BackgroundWorkerThread(threading.Thread):
 
     def run(self):
         """Main loop of the thread."""
+        self.registry.register(self)
         try:
-            while self.scheduleNextWork():
+            while self._scheduleNextWork():
+                self.runIteration()
+        except:
+            self.log.exception("Exception in %s, thread terminated" % self.name)
+        finally:
+            self.setState(STOPPED)
+            self.registry.unregister(self)
+
+    def runIteration(self):
+        """Do one unit of work (after scheduleNextWork() returned True)."""
+        self.job_started = self._clock()
+        if self.tracer is not None:
+            self.trace = self.tracer.startIteration(self.job_started)
+        tm = self.transaction_manager
+        if tm is not None:
+            current_tm = CurrentTransactionManager(tm)
+        else:
+            current_tm = _nothing()
+        failures = self.failure_count
+        with self.workSlot():
+            with current_tm:
+                self.prepareWork()
                 with ZopeInteraction():
-                    with ZodbConnection(self.site_db) as conn:
+                    self.setState(OPENING)
+                    with ZodbConnection(
+                            self.site_db,
+                            prefetch=self.getPrefetchOids(),
+                            transaction_manager=tm) as conn:
                         try:
-                            with ZopeSite(self.getSite(conn)):
-                                try:
-                                    with ZopeTransaction(
-                                            user=self.user_name,
-                                            note=self.getTransactionNote()):
-                                        self.doWork()
-                                finally:
-                                    # Do the cleanup in a new transaction, as
-                                    # the current one may be doomed or
-                                    # something.  Also do it while the site
-                                    # is available, since we may need to access
-                                    # local utilities during the cleanup
-                                    with ZopeTransaction(
-                                            user=self.user_name,
-                                            note=self.getCleanupNote()):
-                                        self.doCleanup()
+                            self.doWorkInSite(conn)
                         except:
-                            # Note: log the exception while the ZODB connection
-                            # is still open; we may need it for repr() of
-                            # objects in various __traceback_info__s.
-                            self.log.exception("Exception in %s" % self.name)
-        except:
-            self.log.exception("Exception in %s, thread terminated" % self.name)
+                            # Note: log the exception while the ZODB
+                            # connection is still open; we may need it for
+                            # repr() of objects in various
+                            # __traceback_info__s.
+                            self.iterationFailed()
+        if self.failure_count == failures:
+            self.iterationSucceeded()
+        self.iteration_count += 1
+        if self.trace is not None:
+            try:
+                self.trace.finish(self._clock(), thread_name=self.name,
+                                  job=self.current_job)
+            except Exception:
+                self.log.exception("Could not export trace in %s"
+                                   % self.name)
+            self.trace = None
+        self.current_job = self.job_started = None
+        self.setState(IDLE)
+
+    def doWorkInSite(self, conn):
+        """Do the work and the cleanup with the site set."""
+        with ZopeSite(self.getSite(conn)):
+            with self.measureUsage(conn):
+                try:
+                    self.doWorkInTransaction()
+                finally:
+                    # Do the cleanup in a new transaction, as the current one
+                    # may be doomed or something.  Also do it while the site
+                    # is available, since we may need to access local
+                    # utilities during the cleanup
+                    self.setState(CLEANING_UP)
+                    with ZopeTransaction(
+                            user=self.user_name,
+                            note=self.getCleanupNote(),
+                            transaction_manager=self.transaction_manager):
+                        self.doCleanup()
+
+    def _scheduleNextWork(self):
+        self.setState(SCHEDULING)
+        try:
+            return self.scheduleNextWork()
+        finally:
+            self.setState(IDLE)
+
+    def setState(self, state):
+        """Record what the thread is doing (see cipher.background.registry)."""
+        self.state = state
+        self.state_since = self._clock()
+        if self.trace is not None:
+            self.trace.enter(state, self.state_since)
+
+    def getStatus(self):
+        """Return a dict describing what the thread is doing.
+
+        Cheap and safe to call from other threads.
+        """
+        return dict(
+            name=self.name,
+            class_name=self.__class__.__name__,
+            site_name=self.site_name,
+            user_name=self.user_name,
+            alive=self.is_alive(),
+            state=self.state,
+            state_since=self.state_since,
+            current_job=self.current_job,
+            job_started=self.job_started,
+            iterations=self.iteration_count,
+            failures=self.failure_count,
+            last_error=self.last_error,
+            last_error_time=self.last_error_time,
+            queue_depth=self.queue_depth,
+        )
+
+    def iterationFailed(self):
+        """Record and log the exception that interrupted an iteration.
+
+        Called from an exception handler.
+        """
+        self.failure_count += 1
+        self.last_error = _describeException()
+        self.last_error_time = self._clock()
+        self.logException()
+        if self.trace is not None:
+            self.trace.error = self.last_error
+
+    def iterationSucceeded(self):
+        """Called after an iteration that didn't fail.
+
+        Does nothing by default.
+        """
+
+    def logException(self):
+        """Log the exception that interrupted an iteration of the main loop.
+
+        Called from an exception handler, while the ZODB connection is
+        still open.
+        """
+        self.log.exception("Exception in %s" % self.name)
+
+    def workSlot(self):
+        """Wait for permission to do one iteration of the main loop.
+
+        Returns a context manager that is held for the whole iteration,
+        before a ZODB connection is opened.  Does not wait by default.
+        """
+        return _nothing()
+
+    def measureUsage(self, conn):
+        """Measure the resources used by one iteration of the main loop.
+
+        Returns a context manager.  Records the usage in ``self.accounting``
+        under our site and user names, if set.
+        """
+        if self.accounting is None:
+            return _nothing()
+        return self.accounting.measure(self.site_name, self.user_name, conn)
+
+    def doWorkInTransaction(self):
+        """Call doWork() inside a fresh ZODB transaction.
+
+        Commits on success, aborts on exception.  Subclasses can extend
+        this to observe the duration or the outcome of the transaction.
+        """
+        self.throttle_time = 0
+        with ZopeTransaction(user=self.user_name,
+                             note=self.getTransactionNote(),
+                             transaction_manager=self.transaction_manager
+                             ) as txn:
+            self.prefetchNext()
+            self.beginWork()
+            self.setState(WORKING)
+            self.doWork()
+            if self.trace is not None:
+                txn.setExtendedInfo('trace_id', self.trace.trace_id)
+            if self.write_limiter is not None:
+                self.setState(THROTTLED)
+                self.throttle_time = self.write_limiter.throttle(
+                    hooks.getSite()._p_jar, self.__class__.__name__, txn)
+            self.setState(COMMITTING)
+
+    def beginWork(self):
+        """Called at the start of the work transaction, before doWork().
+
+        A good place to add before-commit hooks to the transaction.  Does
+        nothing by default.
+        """
+
+    def traceJob(self, context):
+        """Make the current iteration a part of a job's trace.
+
+        Call it from doWork() with the TraceContext that came with the job
+        (see cipher.background.tracing).  Does nothing if there's no tracer
+        or no context.
+        """
+        if self.trace is not None:
+            self.trace.join(context)
+
+    def prefetchNext(self):
+        """Start prefetching the objects the next job is going to need.
+
+        With a storage that prefetches asynchronously (like ZEO), this
+        overlaps the loading with the current doWork().
+        """
+        oids = self.getNextPrefetchOids()
+        if oids:
+            hooks.getSite()._p_jar.prefetch(oids)
 
     def scheduleNextWork(self):
         """Sleep until some work is available.
@@ -131,6 +357,31 @@ class BackgroundWorkerThread(threading.Thread):
         """
         return False
 
+    def prepareWork(self):
+        """Prepare the next unit of work.
+
+        Called after scheduleNextWork(), in the work slot but with no
+        interaction, ZODB connection or site.  Does nothing by default.
+        """
+
+    def getPrefetchOids(self):
+        """Return OIDs (or persistent objects) doWork() is going to need.
+
+        Called after scheduleNextWork(), without a ZODB connection.  They
+        are all prefetched in one go right after opening a connection, if
+        the storage supports that (ZEO does), instead of being loaded one
+        by one.  Returns nothing by default.
+        """
+        return ()
+
+    def getNextPrefetchOids(self):
+        """Return OIDs the job after the current one is going to need.
+
+        Called before doWork(), in the same transaction.  Returns nothing
+        by default; override it if you know what the next job is.
+        """
+        return ()
+
     def doWork(self):
         """Perform the work.
 
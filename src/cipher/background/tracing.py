@@ -0,0 +1,252 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Tracing background jobs from enqueue to commit.
+
+Example::
+
+    tracer = Tracer(FileExporter('/var/log/myapp/traces.jsonl'))
+
+    # in the producer's transaction
+    getJobQueue(root, 'mail').put(job, trace=tracer.enqueue())
+
+    class MailSender(PartitionedWorkerThread):
+        tracer = tracer
+
+Every iteration of a worker thread with a tracer produces an 'iteration'
+span with one child span per state it went through ('opening connection',
+'working', 'committing', 'cleaning up').  If the job it processed came with
+a trace context, the spans join the producer's trace, and a 'queue wait'
+span covers the time from the enqueue until the worker picked the job up.
+The producer's 'enqueue' span ends when its transaction commits, so the
+time it took for the job to become visible is the difference between the
+end of the 'enqueue' span and the start of the 'iteration' span.
+
+The trace id is stored in the extended info of the work transaction, under
+``trace_id``.
+"""
+
+import binascii
+import json
+import os
+import threading
+import time
+
+import transaction
+
+from .registry import IDLE, STOPPED
+
+
+def newId():
+    """Return a new random trace or span id."""
+    return binascii.hexlify(os.urandom(8)).decode('ascii')
+
+
+class TraceContext(object):
+    """What a job needs to carry to join its producer's trace.
+
+    Plain, picklable data, so it can be stored in the ZODB with the job.
+    """
+
+    def __init__(self, trace_id, span_id=None, enqueued=None):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.enqueued = enqueued
+
+    def __repr__(self):
+        return '<TraceContext %s/%s>' % (self.trace_id, self.span_id)
+
+
+class Traced(object):
+    """A job with a trace context attached."""
+
+    def __init__(self, job, context):
+        self.job = job
+        self.context = context
+
+    def __repr__(self):
+        return 'Traced(%r, %r)' % (self.job, self.context)
+
+
+class Span(object):
+    """A timed operation that is part of a trace."""
+
+    def __init__(self, trace_id, span_id, parent_id, name, start, end=None,
+                 attributes=None):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start = start
+        self.end = end
+        self.attributes = dict(attributes or {})
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def asDict(self):
+        return dict(trace_id=self.trace_id, span_id=self.span_id,
+                    parent_id=self.parent_id, name=self.name,
+                    start=self.start, end=self.end,
+                    attributes=self.attributes)
+
+    def __repr__(self):
+        return '<Span %s %s+%s>' % (self.name, self.start, self.duration)
+
+
+class InMemoryExporter(object):
+    """Keeps the last ``max_spans`` finished spans in memory."""
+
+    def __init__(self, max_spans=10000):
+        self.max_spans = max_spans
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        with self._lock:
+            self.spans.extend(spans)
+            del self.spans[:-self.max_spans]
+
+    def clear(self):
+        with self._lock:
+            del self.spans[:]
+
+    def trace(self, trace_id):
+        """Return the spans of one trace, in order of their start."""
+        with self._lock:
+            spans = [s for s in self.spans if s.trace_id == trace_id]
+        return sorted(spans, key=lambda s: s.start)
+
+    def durations(self, name):
+        """Return the durations of all spans with a given name.
+
+        Compare e.g. the percentiles of 'queue wait' with those of
+        'iteration' to see whether jobs are slow because of queueing or
+        because of the work itself.
+        """
+        with self._lock:
+            return [s.duration for s in self.spans if s.name == name]
+
+
+class FileExporter(object):
+    """Appends finished spans to a file, one JSON object per line."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(s.asDict(), sort_keys=True) + '\n'
+                        for s in spans)
+        with self._lock:
+            with open(self.filename, 'a') as f:
+                f.write(lines)
+
+
+class IterationTrace(object):
+    """Collects the spans of one iteration of a worker thread.
+
+    The spans are exported when the iteration is finished, by which time
+    we know which trace they belong to.
+    """
+
+    def __init__(self, tracer, start, name='iteration'):
+        self.tracer = tracer
+        self.trace_id = tracer.newId()
+        self.parent_id = None
+        self.span = Span(None, tracer.newId(), None, name, start)
+        self.spans = []
+        self.current = None
+        self.error = None
+
+    def enter(self, state, now):
+        """Record a state change of the worker thread."""
+        if self.current is not None:
+            self.current.end = now
+            self.current = None
+        if state not in (IDLE, STOPPED):
+            self.current = Span(None, self.tracer.newId(), self.span.span_id,
+                                state, now)
+            self.spans.append(self.current)
+
+    def join(self, context):
+        """Make this iteration a part of the job's trace."""
+        if context is None or self.parent_id is not None:
+            return
+        self.trace_id = context.trace_id
+        self.parent_id = context.span_id
+        if context.enqueued is not None:
+            self.spans.append(Span(None, self.tracer.newId(), self.parent_id,
+                                   'queue wait', context.enqueued,
+                                   self.span.start))
+
+    def finish(self, now, **attributes):
+        self.enter(IDLE, now)
+        self.span.end = now
+        self.span.parent_id = self.parent_id
+        self.span.attributes.update(attributes)
+        if self.error is not None:
+            self.span.attributes['error'] = self.error
+        spans = [self.span] + self.spans
+        for span in spans:
+            span.trace_id = self.trace_id
+        self.tracer.export(spans)
+
+
+class Tracer(object):
+    """Creates trace contexts for jobs and hands finished spans to an
+    exporter.
+
+    The exporter can be anything with an ``export(spans)`` method; it's
+    called from worker threads, so it ought to be thread-safe and quick.
+    """
+
+    _clock = staticmethod(time.time)
+
+    newId = staticmethod(newId)
+
+    def __init__(self, exporter=None):
+        if exporter is None:
+            exporter = InMemoryExporter()
+        self.exporter = exporter
+
+    def enqueue(self, txn=None, **attributes):
+        """Start a trace for a job that is about to be enqueued.
+
+        Returns a TraceContext to store with the job.  The 'enqueue' span
+        ends when ``txn`` (by default the current transaction) commits, and
+        is not exported if it never does.
+        """
+        if txn is None:
+            txn = transaction.get()
+        now = self._clock()
+        span = Span(self.newId(), self.newId(), None, 'enqueue', now,
+                    attributes=attributes)
+        txn.addAfterCommitHook(self._committed, (span, ))
+        return TraceContext(span.trace_id, span.span_id, now)
+
+    def _committed(self, status, span):
+        span.end = self._clock()
+        if not status:
+            span.attributes['error'] = 'commit failed'
+        self.export([span])
+
+    def startIteration(self, start):
+        """Start collecting the spans of one iteration of a worker."""
+        return IterationTrace(self, start)
+
+    def export(self, spans):
+        self.exporter.export(spans)
@@ -0,0 +1,186 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Warming up ZODB caches of background workers after a restart."""
+
+import binascii
+import json
+import os
+import time
+import weakref
+
+from ZODB.POSException import POSKeyError
+from zope.component import hooks
+
+from .thread import BackgroundWorkerThread
+
+
+class HotOids(object):
+    """Counts how often objects are loaded.
+
+    Keeps the counts of at most ``max_size`` OIDs (it's allowed to grow
+    to twice that before the least used ones are forgotten).
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.counts = {}
+
+    def record(self, oids):
+        for oid in oids:
+            self.counts[oid] = self.counts.get(oid, 0) + 1
+        if len(self.counts) > 2 * self.max_size:
+            self.counts = dict(self._top(self.max_size))
+
+    def _top(self, n):
+        items = sorted(self.counts.items(),
+                       key=lambda item: (-item[1], item[0]))
+        return items[:n]
+
+    def top(self, n=None):
+        """Return the n most often loaded OIDs, most loaded first."""
+        return [oid for oid, count in self._top(n or self.max_size)]
+
+    def save(self, filename):
+        """Save the counts to a file (atomically)."""
+        data = dict((binascii.hexlify(oid).decode('ascii'), count)
+                    for oid, count in self._top(self.max_size))
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, filename)
+
+    def load(self, filename):
+        """Load counts saved by save(), if the file exists."""
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+        for hexoid, count in data.items():
+            oid = binascii.unhexlify(hexoid.encode('ascii'))
+            self.counts[oid] = self.counts.get(oid, 0) + count
+
+
+class _LoadRecorder(object):
+    """Remembers the OIDs loaded through a storage."""
+
+    def __init__(self, storage):
+        self.oids = set()
+        self._load = storage.load
+
+    def load(self, oid, *args):
+        self.oids.add(oid)
+        return self._load(oid, *args)
+
+
+def getLoadRecorder(conn):
+    """Return a _LoadRecorder for a ZODB connection.
+
+    The recorder is installed into the connection's storage instance the
+    first time.  Returns None if the storage can't be instrumented.
+    """
+    storage = conn._storage
+    recorder = getattr(storage, '_cipher_load_recorder', None)
+    if recorder is None:
+        try:
+            recorder = _LoadRecorder(storage)
+            storage.load = recorder.load
+            storage._cipher_load_recorder = recorder
+        except AttributeError:
+            return None
+    return recorder
+
+
+def warmUp(conn, oids, activate=True):
+    """Prefetch objects into a connection.
+
+    Asks the storage to prefetch all the objects in one go (if it supports
+    that, like ZEO does), and then loads them into the connection's cache
+    unless ``activate`` is false.  Objects that can't be loaded (e.g.
+    because they were deleted) are skipped.
+    """
+    oids = list(oids)
+    if not oids:
+        return 0
+    conn.prefetch(oids)
+    if not activate:
+        return 0
+    loaded = 0
+    for oid in oids:
+        try:
+            conn.get(oid)._p_activate()
+        except (POSKeyError, KeyError):
+            continue
+        loaded += 1
+    return loaded
+
+
+class WarmStartWorkerThread(BackgroundWorkerThread):
+    """A background thread that warms up its ZODB cache.
+
+    Records the objects every doWork() loads, and saves the
+    ``prefetch_count`` most often loaded ones to ``hot_oids_file`` every
+    ``save_interval`` seconds and when the thread terminates.  When the
+    thread first uses a connection, it loads those objects into it before
+    doing any work.
+    """
+
+    hot_oids_file = None
+    prefetch_count = 1000
+    save_interval = 300.0
+
+    def __init__(self, *args, **kw):
+        super(WarmStartWorkerThread, self).__init__(*args, **kw)
+        self.hot_oids = HotOids(self.prefetch_count)
+        if self.hot_oids_file:
+            self.hot_oids.load(self.hot_oids_file)
+        self._warm = weakref.WeakKeyDictionary()
+        self._last_save = self._clock()
+
+    def getSite(self, connection):
+        if connection not in self._warm:
+            self._warm[connection] = True
+            count = warmUp(connection, self.hot_oids.top(self.prefetch_count))
+            if count:
+                self.log.debug("Prefetched %d objects in %s"
+                               % (count, self.name))
+        return super(WarmStartWorkerThread, self).getSite(connection)
+
+    def doWorkInTransaction(self):
+        recorder = getLoadRecorder(hooks.getSite()._p_jar)
+        if recorder is not None:
+            recorder.oids.clear()
+        try:
+            super(WarmStartWorkerThread, self).doWorkInTransaction()
+        finally:
+            if recorder is not None:
+                self.hot_oids.record(recorder.oids)
+                recorder.oids.clear()
+            if self._clock() - self._last_save >= self.save_interval:
+                self.saveHotOids()
+
+    def saveHotOids(self):
+        self._last_save = self._clock()
+        if not self.hot_oids_file:
+            return
+        try:
+            self.hot_oids.save(self.hot_oids_file)
+        except EnvironmentError:
+            self.log.exception("Could not save hot OIDs of %s" % self.name)
+
+    def run(self):
+        try:
+            super(WarmStartWorkerThread, self).run()
+        finally:
+            self.saveHotOids()